@@ -0,0 +1,184 @@
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from stub_upstream import StubUpstream
+
+#
+# Hermetic load test of the weather API. Starts the stub upstream, starts the service
+# under Flask and/or Tornado pointed at it, hits every route and reports throughput and
+# latency percentiles. Nothing leaves the machine.
+#
+#   python benchmark/run.py --requests 200 --concurrency 8 --latency 0.15 --json before.json
+#
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CITIES = ['Tallinn', 'Tartu', 'Pärnu', 'Narva', 'Viljandi', 'Rakvere', 'Haapsalu', 'Kuressaare',
+          'Helsinki', 'Riga', 'Vilnius', 'Stockholm', 'Oslo', 'Berlin', 'Paris', 'London']
+
+COORDINATES = ['59.4372,24.7454', '58.3780,26.7290', '58.3859,24.4971', '59.3797,28.1791',
+               '60.1699,24.9384', '56.9496,24.1052', '54.6872,25.2797', '59.3293,18.0686']
+
+ROUTES = {
+    'location': '/et/{city}',
+    'current': '/et/{city}/current',
+    'forecast': '/et/{city}/forecast',
+    'basic': '/et/{city}/basic',
+    'coordinates': '/et/coordinates/{coordinates}',
+    'coordinates-current': '/et/coordinates/{coordinates}/current',
+    'coordinates-forecast': '/et/coordinates/{coordinates}/forecast',
+    'coordinates-basic': '/et/coordinates/{coordinates}/basic',
+    'map-estonia': '/et/map/estonia',
+    'map-europe': '/et/map/europe',
+}
+
+SERVERS = {
+    'flask': [sys.executable, '-c',
+              'import os, darksky_api; '
+              'darksky_api.app.run(host="127.0.0.1", port=int(os.environ["APP_PORT"]), threaded=True)'],
+    'tornado': [sys.executable, 'tornado_app.py'],
+}
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def waitForPort(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with %s' % process.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start on port %d' % port)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def load(port, template, requests, concurrency):
+    """Send `requests` requests for the route from `concurrency` keep-alive connections"""
+    latencies = []
+    errors = []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            path = template.format(city=CITIES[i % len(CITIES)], coordinates=COORDINATES[i % len(COORDINATES)])
+            path = quote(path)
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+                status = 0
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != 200:
+                    errors.append(status)
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'throughput': len(latencies) / duration if duration else 0.0,
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000}
+
+
+def benchmark(server, stub, routes, requests, concurrency):
+    port = freePort()
+    workdir = tempfile.mkdtemp(prefix='pm-weather-bench-')
+    environment = dict(os.environ, **stub.environment())
+    environment.update({'APP_PORT': str(port),
+                        'PREWARM_ENABLED': '0',
+                        'GEOCODING_CACHE_PATH': os.path.join(workdir, 'geocoding_cache.sqlite'),
+                        'CACHE_SNAPSHOT_PATH': os.path.join(workdir, 'cache_snapshot.gz')})
+    process = subprocess.Popen(SERVERS[server], cwd=ROOT, env=environment,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = {}
+    try:
+        waitForPort(port, process)
+        for route in routes:
+            before = dict(stub.calls)
+            result = load(port, ROUTES[route], requests, concurrency)
+            result['upstream'] = dict((name, stub.calls[name] - before[name]) for name in stub.calls)
+            results[route] = result
+            report(server, route, result)
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def report(server, route, result):
+    print('%-8s %-22s %6d req %4d err %9.1f req/s   p50 %8.1f ms   p95 %8.1f ms   p99 %8.1f ms   upstream %s' % (
+        server, route, result['requests'], result['errors'], result['throughput'],
+        result['p50'], result['p95'], result['p99'],
+        ' '.join('%s=%d' % item for item in sorted(result['upstream'].items()))))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hermetic benchmark of the weather API against a stub upstream')
+    parser.add_argument('--servers', default='flask,tornado', help='comma separated, flask and/or tornado')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='comma separated, from: ' + ', '.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent connections')
+    parser.add_argument('--latency', type=float, default=0.1, help='stub upstream delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='random +- seconds on the stub delay')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    stub = StubUpstream(args.latency, args.jitter).start()
+    results = {}
+    for server in args.servers.split(','):
+        results[server] = benchmark(server, stub, args.routes.split(','), args.requests, args.concurrency)
+    stub.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
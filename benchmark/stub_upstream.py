@@ -0,0 +1,142 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+#
+# Local stand-in for DarkSky, Geonames and Nominatim, serving the recorded responses
+# in fixtures/ with a configurable delay. Point the service at it with
+#
+#   DARK_SKY_URL=http://127.0.0.1:<port>/forecast/
+#   GEONAMES_URL=http://127.0.0.1:<port>/searchJSON?q=
+#   NOMINATIM_DOMAIN=127.0.0.1:<port> NOMINATIM_SCHEME=http
+#
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return json.load(f)
+
+
+# Stable made-up coordinates for a place name, so every city gets its own forecast
+def coordinatesFor(name):
+    digest = hashlib.sha1(name.lower().encode('utf-8')).digest()
+    lat = 35 + digest[0] / 255.0 * 35
+    lng = -10 + digest[1] / 255.0 * 50
+    return '%.5f' % lat, '%.5f' % lng
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.count(self.path)
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path.startswith('/forecast/'):
+            coordinates = url.path.rsplit('/', 1)[-1]
+            try:
+                lat, lng = (float(value) for value in coordinates.split(','))
+            except ValueError:
+                return self.send(400, {'code': 400, 'error': 'The given location is invalid.'})
+            body = dict(server.darksky, latitude=lat, longitude=lng)
+        elif url.path == '/searchJSON':
+            name = query.get('q', [''])[0]
+            if name.lower().startswith('nowhere'):
+                body = {'totalResultsCount': 0, 'geonames': []}
+            else:
+                lat, lng = coordinatesFor(name)
+                result = dict(server.geonames['geonames'][0], lat=lat, lng=lng, name=name.split(',')[0].title())
+                body = dict(server.geonames, geonames=[result])
+        elif url.path == '/reverse':
+            body = dict(server.nominatim, lat=query.get('lat', [''])[0], lon=query.get('lon', [''])[0])
+        else:
+            return self.send(404, {'error': 'not found'})
+        self.send(200, body)
+
+    def send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StubUpstream(ThreadingHTTPServer):
+    """
+    Stub upstream server, started on a background thread.
+
+    :param latency: Seconds every response is delayed
+    :type latency: `float`
+    :param jitter: Up to this many seconds are randomly added to or taken off the delay
+    :type jitter: `float`
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.1, jitter=0.02, host='127.0.0.1', port=0):
+        super(StubUpstream, self).__init__((host, port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.darksky = fixture('darksky.json')
+        self.geonames = fixture('geonames.json')
+        self.nominatim = fixture('nominatim.json')
+        self.calls = {'darksky': 0, 'geonames': 0, 'nominatim': 0}
+        self.lock = threading.Lock()
+
+    def count(self, path):
+        if path.startswith('/forecast/'):
+            upstream = 'darksky'
+        elif path.startswith('/searchJSON'):
+            upstream = 'geonames'
+        else:
+            upstream = 'nominatim'
+        with self.lock:
+            self.calls[upstream] += 1
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def environment(self):
+        """Environment variables that point the service at this stub"""
+        return {'DARK_SKY_URL': 'http://%s/forecast/' % self.address,
+                'GEONAMES_URL': 'http://%s/searchJSON?q=' % self.address,
+                'NOMINATIM_DOMAIN': self.address,
+                'NOMINATIM_SCHEME': 'http'}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='stub-upstream', daemon=True).start()
+        return self
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve recorded DarkSky/Geonames/Nominatim responses')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    args = parser.parse_args()
+    stub = StubUpstream(args.latency, args.jitter, port=args.port)
+    for name, value in sorted(stub.environment().items()):
+        print('%s=%s' % (name, value))
+    stub.serve_forever()
@@ -0,0 +1,379 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+
+#
+# Storage behind ForecastCache and GeocodingCache. A backend maps a key to
+# `(value, stored)`, where `stored` is the time.time() the value was set; the
+# caches decide what is fresh. All backends have the same methods:
+#
+#   get(key)                 -> (value, stored) or None
+#   set(key, value, stored)
+#   items()                  -> [(key, value, stored), ...]
+#   clear()
+#   len(backend)
+#
+# MemoryBackend keeps the values in this process. SQLiteBackend and
+# SharedMemoryBackend keep them in a file every worker on the host opens, so a
+# value fetched by one worker is a hit in all of them.
+#
+
+
+def keyText(key):
+    # Cache keys are strings or tuples of strings, e.g. (coordinates, lang)
+    if isinstance(key, tuple):
+        return '\t'.join(key)
+    return key
+
+
+def textKey(text):
+    # The other way around, for the backends that store the key as text
+    if '\t' in text:
+        return tuple(text.split('\t'))
+    return text
+
+
+# Returned by SerializedBackend.memoized when the value has to be decoded
+MISSING = object()
+
+
+def dumpValue(value):
+    return json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+
+def loadValue(data):
+    return json.loads(data.decode('utf-8'))
+
+
+class MemoryBackend:
+    """
+    In-process LRU store. Values are kept as they are, nothing is serialized.
+
+    :param maxsize: Maximum number of entries before the least recently used is evicted, `None` for no limit
+    :type maxsize: `int` or `None`
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, stored):
+        with self.lock:
+            self.entries[key] = (value, stored)
+            self.entries.move_to_end(key)
+            while self.maxsize is not None and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def items(self):
+        with self.lock:
+            return [(key, value, stored) for key, (value, stored) in self.entries.items()]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SerializedBackend:
+    """
+    Base of the backends that store bytes. Values are written with `dumps` and
+    read with `loads`. The last `decoded` values read are kept as objects, so
+    a value that has not been written again since is returned without decoding
+    it (and is the same object every time, memoized views on it included).
+    """
+
+    def __init__(self, dumps=dumpValue, loads=loadValue, decoded=256):
+        self.dumps = dumps
+        self.loads = loads
+        self.decodedSize = decoded
+        self.decoded = OrderedDict()
+        self.decodedLock = threading.Lock()
+
+    def memoized(self, key, stamp):
+        """The decoded value of `key` if it was decoded from the write identified by `stamp`, else `MISSING`"""
+        with self.decodedLock:
+            entry = self.decoded.get(key)
+            if entry is None or entry[1] != stamp:
+                return MISSING
+            self.decoded.move_to_end(key)
+            return entry[0]
+
+    def memoize(self, key, stamp, data):
+        """Decode `data`, the value of `key` from the write identified by `stamp`, and keep it"""
+        value = self.loads(data)
+        with self.decodedLock:
+            self.decoded[key] = (value, stamp)
+            self.decoded.move_to_end(key)
+            while len(self.decoded) > self.decodedSize:
+                self.decoded.popitem(last=False)
+        return value
+
+    def forget(self):
+        with self.decodedLock:
+            self.decoded.clear()
+
+
+class SQLiteBackend(SerializedBackend):
+    """
+    Store in a SQLite file, in WAL mode so the workers read while one writes.
+
+    :param path: SQLite database file, created if missing
+    :type path: `str`
+    :param maxsize: Maximum number of entries, the oldest are deleted beyond it. `None` for no limit
+    :type maxsize: `int` or `None`
+    """
+
+    # Entries over maxsize are deleted once every this many writes
+    prune_every = 64
+
+    def __init__(self, path, maxsize=None, dumps=dumpValue, loads=loadValue, decoded=256):
+        super(SQLiteBackend, self).__init__(dumps, loads, decoded)
+        self.path = path
+        self.maxsize = maxsize
+        self.writes = 0
+        self.open()
+        # A SQLite connection must not be used across a fork, with gunicorn --preload
+        # every worker opens its own
+        os.register_at_fork(after_in_child=self.open)
+
+    def open(self):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, stored REAL)')
+        self.db.commit()
+
+    def get(self, key):
+        key = keyText(key)
+        with self.lock:
+            row = self.db.execute('SELECT stored FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value = self.memoized(key, row[0])
+        if value is not MISSING:
+            return value, row[0]
+        with self.lock:
+            row = self.db.execute('SELECT value, stored FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return self.memoize(key, row[1], row[0]), row[1]
+
+    def set(self, key, value, stored):
+        data = self.dumps(value)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache (key, value, stored) VALUES (?, ?, ?)',
+                            (keyText(key), data, stored))
+            self.writes += 1
+            if self.maxsize is not None and self.writes % self.prune_every == 0:
+                self.db.execute('DELETE FROM cache WHERE key IN '
+                                '(SELECT key FROM cache ORDER BY stored DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+            self.db.commit()
+
+    def items(self):
+        with self.lock:
+            rows = self.db.execute('SELECT key, value, stored FROM cache').fetchall()
+        return [(textKey(key), self.loads(value), stored) for key, value, stored in rows]
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM cache')
+            self.db.commit()
+        self.forget()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+
+SHARED_MAGIC = b'SHC1'
+# magic, buckets, ways, data size, write position
+SHARED_HEADER = struct.Struct('<4sIIQQ')
+# key hash, stored, absolute data position, key length, value length
+SHARED_SLOT = struct.Struct('<QdQII')
+
+
+def keyHash(key):
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1
+
+
+class SharedMemoryBackend(SerializedBackend):
+    """
+    Store in a memory-mapped file shared by all workers on the host. Put it
+    on tmpfs (/dev/shm) and it never touches the disk.
+
+    The file holds a set-associative index (`buckets` buckets of `ways`
+    slots, the oldest slot of a full bucket is replaced) and a ring buffer
+    of `size` bytes for the keys and values. Positions in the ring only ever
+    grow, so an entry whose bytes have been written over is recognized by
+    its position alone. Readers take a shared and writers an exclusive
+    `flock` on the file. Unchanged values are not copied out of the map
+    again, see `SerializedBackend`.
+
+    :param path: The shared file, created (or reset if its layout differs) on first use
+    :type path: `str`
+    :param buckets: Number of index buckets
+    :type buckets: `int`
+    :param ways: Slots per bucket
+    :type ways: `int`
+    :param size: Bytes of the ring buffer
+    :type size: `int`
+    """
+
+    def __init__(self, path, buckets=1024, ways=4, size=64 * 1024 * 1024, dumps=dumpValue, loads=loadValue,
+                 decoded=256):
+        super(SharedMemoryBackend, self).__init__(dumps, loads, decoded)
+        self.path = path
+        self.buckets = buckets
+        self.ways = ways
+        self.size = size
+        self.indexStart = SHARED_HEADER.size
+        self.dataStart = self.indexStart + buckets * ways * SHARED_SLOT.size
+        self.fd = None
+        self.open()
+        # flock only excludes other open file descriptions, and a forked worker shares its
+        # parent's. With gunicorn --preload every worker opens the file again.
+        os.register_at_fork(after_in_child=self.open)
+
+    def open(self):
+        if self.fd is not None:
+            self.mm.close()
+            os.close(self.fd)
+        self.lock = threading.Lock()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        length = self.dataStart + self.size
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self.fd, SHARED_HEADER.size, 0)
+            if len(header) < SHARED_HEADER.size or \
+                    SHARED_HEADER.unpack(header)[:4] != (SHARED_MAGIC, self.buckets, self.ways, self.size) or \
+                    os.fstat(self.fd).st_size != length:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, length)
+                os.pwrite(self.fd, SHARED_HEADER.pack(SHARED_MAGIC, self.buckets, self.ways, self.size, 0), 0)
+            self.mm = mmap.mmap(self.fd, length)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def position(self):
+        return SHARED_HEADER.unpack_from(self.mm, 0)[4]
+
+    def slot(self, i):
+        return SHARED_SLOT.unpack_from(self.mm, self.indexStart + i * SHARED_SLOT.size)
+
+    def live(self, slot, head):
+        # The entry is intact until the write position is a full ring past its start
+        return slot[0] != 0 and head <= slot[2] + self.size
+
+    def find(self, key, digest, head):
+        """Index of the slot holding `key`, or `None`"""
+        first = (digest % self.buckets) * self.ways
+        for i in range(first, first + self.ways):
+            slot = self.slot(i)
+            if slot[0] == digest and self.live(slot, head):
+                start = self.dataStart + slot[2] % self.size
+                if self.mm[start:start + slot[3]] == key:
+                    return i
+        return None
+
+    def get(self, key):
+        key = keyText(key).encode('utf-8')
+        digest = keyHash(key)
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                i = self.find(key, digest, self.position())
+                if i is None:
+                    return None
+                slot = self.slot(i)
+                # The position identifies the write
+                value = self.memoized(key, slot[2])
+                if value is MISSING:
+                    start = self.dataStart + slot[2] % self.size + slot[3]
+                    data = self.mm[start:start + slot[4]]
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        if value is MISSING:
+            value = self.memoize(key, slot[2], data)
+        return value, slot[1]
+
+    def set(self, key, value, stored):
+        key = keyText(key).encode('utf-8')
+        data = self.dumps(value)
+        length = len(key) + len(data)
+        if length > self.size:
+            return
+        digest = keyHash(key)
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                head = self.position()
+                # Entries are contiguous, one that does not fit before the end starts over at the beginning
+                if head % self.size + length > self.size:
+                    head += self.size - head % self.size
+                start = self.dataStart + head % self.size
+                self.mm[start:start + len(key)] = key
+                self.mm[start + len(key):start + length] = data
+
+                i = self.find(key, digest, head + length)
+                if i is None:
+                    first = (digest % self.buckets) * self.ways
+                    slots = [(self.live(self.slot(i), head + length), self.slot(i)[1], i)
+                             for i in range(first, first + self.ways)]
+                    i = min(slots)[2]
+                SHARED_SLOT.pack_into(self.mm, self.indexStart + i * SHARED_SLOT.size,
+                                      digest, stored, head, len(key), len(data))
+                SHARED_HEADER.pack_into(self.mm, 0, SHARED_MAGIC, self.buckets, self.ways, self.size, head + length)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def items(self):
+        rows = []
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                head = self.position()
+                for i in range(self.buckets * self.ways):
+                    slot = self.slot(i)
+                    if self.live(slot, head):
+                        start = self.dataStart + slot[2] % self.size
+                        rows.append((self.mm[start:start + slot[3]], self.mm[start + slot[3]:start + slot[3] + slot[4]],
+                                     slot[1]))
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return [(textKey(key.decode('utf-8')), self.loads(data), stored) for key, data, stored in rows]
+
+    def clear(self):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                self.mm[self.indexStart:self.dataStart] = bytes(self.dataStart - self.indexStart)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.forget()
+
+    def __len__(self):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                head = self.position()
+                return sum(1 for i in range(self.buckets * self.ways) if self.live(self.slot(i), head))
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
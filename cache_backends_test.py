@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from cache_backends import SharedMemoryBackend, SQLiteBackend, dumpValue, loadValue
+from cache_snapshot import CacheSnapshot
+from forecast_cache import ForecastCache
+from geocoding_cache import GeocodingCache
+
+
+class SharedMemoryBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_wrap_around(self):
+        # Every entry is about 100 bytes, so the 2 KB ring wraps many times over
+        backend = SharedMemoryBackend(self.path, buckets=64, ways=4, size=2048)
+        for i in range(200):
+            backend.set(('city%d' % i, 'et'), 'x' * 80 + str(i), float(i))
+            # The entry just written is always intact
+            self.assertEqual(backend.get(('city%d' % i, 'et')), ('x' * 80 + str(i), float(i)))
+        # Entries written over are gone, never read back corrupted
+        self.assertIsNone(backend.get(('city0', 'et')))
+        live = [i for i in range(200) if backend.get(('city%d' % i, 'et')) is not None]
+        self.assertTrue(live)
+        self.assertEqual(live, list(range(live[0], 200)))
+        for i in live:
+            self.assertEqual(backend.get(('city%d' % i, 'et'))[0], 'x' * 80 + str(i))
+        self.assertEqual(len(backend), len(live))
+
+    def test_bucket_replacement(self):
+        backend = SharedMemoryBackend(self.path, buckets=1, ways=2, size=4096)
+        backend.set('a', 1, 1.0)
+        backend.set('b', 2, 2.0)
+        # Writing a key again replaces its own slot
+        backend.set('a', 3, 3.0)
+        self.assertEqual(backend.get('a'), (3, 3.0))
+        self.assertEqual(backend.get('b'), (2, 2.0))
+        # A full bucket gives up its oldest entry
+        backend.set('c', 4, 4.0)
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), (3, 3.0))
+        self.assertEqual(backend.get('c'), (4, 4.0))
+        self.assertEqual(len(backend), 2)
+
+    def test_items(self):
+        backend = SharedMemoryBackend(self.path, buckets=16, ways=4, size=4096)
+        backend.set(('tallinn', 'et'), {'version': 'a'}, 1.0)
+        backend.set('59.437,24.745', None, 2.0)
+        self.assertEqual(sorted(backend.items(), key=repr),
+                         sorted([(('tallinn', 'et'), {'version': 'a'}, 1.0), ('59.437,24.745', None, 2.0)], key=repr))
+
+    def test_shared_between_instances(self):
+        first = SharedMemoryBackend(self.path, buckets=16, ways=4, size=4096)
+        second = SharedMemoryBackend(self.path, buckets=16, ways=4, size=4096)
+        first.set('a', 1, 1.0)
+        self.assertEqual(second.get('a'), (1, 1.0))
+        second.set('a', 2, 2.0)
+        self.assertEqual(first.get('a'), (2, 2.0))
+
+
+class SQLiteBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_prune(self):
+        backend = SQLiteBackend(os.path.join(self.directory, 'cache.sqlite'), maxsize=10)
+        for i in range(backend.prune_every * 2):
+            backend.set(('city%d' % i, 'et'), i, float(i))
+        # Pruned on the last write, the newest are kept
+        self.assertEqual(len(backend), 10)
+        self.assertEqual(sorted(key for key, value, stored in backend.items()),
+                         sorted(('city%d' % i, 'et') for i in range(backend.prune_every * 2 - 10,
+                                                                    backend.prune_every * 2)))
+        self.assertIsNone(backend.get(('city0', 'et')))
+
+
+class CacheSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        cache = ForecastCache(ttl=900, stale_ttl=3600,
+                              backend=SharedMemoryBackend(os.path.join(self.directory, 'a'), size=4096))
+        cache.set(('59.437,24.745', 'et'), {'currently': {'temperature': 3.4}})
+        cache.backend.set(('expired', 'et'), {}, time.time() - 7200)
+        snapshot = CacheSnapshot(os.path.join(self.directory, 'snapshot.gz'))
+        snapshot.add('forecast', cache, dumpValue, loadValue)
+        snapshot.write()
+
+        restored = ForecastCache(ttl=900, stale_ttl=3600,
+                                 backend=SharedMemoryBackend(os.path.join(self.directory, 'b'), size=4096))
+        snapshot = CacheSnapshot(os.path.join(self.directory, 'snapshot.gz'))
+        snapshot.add('forecast', restored, dumpValue, loadValue)
+        self.assertEqual(snapshot.load(), {'forecast': 1})
+        self.assertEqual(restored.peek(('59.437,24.745', 'et')), {'currently': {'temperature': 3.4}})
+        self.assertIsNone(restored.peek(('expired', 'et')))
+
+
+class ForecastCacheTest(unittest.TestCase):
+    def test_counted_from_threads(self):
+        cache = ForecastCache()
+        cache.set('a', 1)
+
+        def lookups():
+            for i in range(2000):
+                cache.peek('a')
+                cache.peek('b')
+
+        threads = [threading.Thread(target=lookups) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.stats(), {'hit': 16000, 'stale': 0, 'miss': 16000})
+
+
+class GeocodingCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reopened_after_fork(self):
+        cache = GeocodingCache(os.path.join(self.directory, 'geocoding.sqlite'))
+        parent = cache.db
+        pid = os.fork()
+        if pid == 0:
+            # Exit code 1 if the worker kept the parent's connection
+            reopened = cache.db is not parent
+            cache.set('Tartu', '58.3776,26.729')
+            os._exit(0 if reopened else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertIs(cache.db, parent)
+        self.assertEqual(cache.entries()[0][:2], ('tartu', '58.3776,26.729'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import atexit
+import gzip
+import json
+import os
+import threading
+import time
+import zlib
+
+SNAPSHOT_VERSION = 1
+
+
+class CacheSnapshot:
+    """
+    Periodic snapshot of the caches, so a new instance starts warm.
+
+    The file is gzipped text, one entry per line: the JSON list
+    `[cache, key, stored]`, a tab, and the value as the cache's `dumps` wrote
+    it. It is written every `interval` seconds and when the process exits,
+    to a temporary file first so a reader never sees half of it. `load()`
+    hands the entries to each cache's `restore`, which skips what has
+    expired.
+
+    Every cache added needs `entries()` and `restore(entries)`, see
+    ForecastCache and GeocodingCache.
+
+    :param path: Snapshot file
+    :type path: `str`
+    :param interval: Seconds between writes, `0` to only write at exit
+    :type interval: `float`
+    """
+
+    def __init__(self, path, interval=300):
+        self.path = path
+        self.interval = interval
+        self.caches = {}
+
+    def add(self, name, cache, dumps, loads):
+        """Include `cache` under `name`, its values written with `dumps` and read with `loads` (bytes)"""
+        self.caches[name] = (cache, dumps, loads)
+
+    def write(self):
+        temporary = '%s.%d.tmp' % (self.path, os.getpid())
+        with gzip.open(temporary, 'wb', compresslevel=5) as f:
+            f.write(json.dumps({'version': SNAPSHOT_VERSION, 'written': time.time()}).encode('utf-8') + b'\n')
+            for name, (cache, dumps, loads) in self.caches.items():
+                for key, value, stored in cache.entries():
+                    f.write(json.dumps([name, key, stored], ensure_ascii=False).encode('utf-8') + b'\t' +
+                            dumps(value) + b'\n')
+        os.replace(temporary, self.path)
+
+    def load(self):
+        """Restore the entries of the last snapshot. Returns how many were restored, by cache."""
+        entries = dict((name, []) for name in self.caches)
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                header = json.loads(f.readline().decode('utf-8'))
+                if header.get('version') != SNAPSHOT_VERSION:
+                    return {}
+                for line in f:
+                    meta, data = line.rstrip(b'\n').split(b'\t', 1)
+                    name, key, stored = json.loads(meta.decode('utf-8'))
+                    if name not in self.caches:
+                        continue
+                    if isinstance(key, list):
+                        key = tuple(key)
+                    entries[name].append((key, self.caches[name][2](data), stored))
+        except (OSError, EOFError, ValueError, zlib.error):
+            # Missing, truncated or from an older layout: start with what was read
+            pass
+        return dict((name, self.caches[name][0].restore(rows)) for name, rows in entries.items())
+
+    def save(self):
+        # A snapshot that cannot be written is skipped, the next one may succeed
+        try:
+            self.write()
+        except OSError:
+            pass
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+
+    def start(self):
+        atexit.register(self.save)
+        if self.interval:
+            threading.Thread(target=self.run, name='cache-snapshot', daemon=True).start()
+            # The timer thread stays in the gunicorn master under --preload, so every worker
+            # starts one for its own caches. write() goes through a temporary file per
+            # process, two workers never write the same file at once.
+            os.register_at_fork(after_in_child=self.forked)
+
+    def forked(self):
+        threading.Thread(target=self.run, name='cache-snapshot', daemon=True).start()
@@ -1,18 +1,47 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, abort, Blueprint, jsonify, make_response
+from flask import Flask, abort, Blueprint, g, jsonify, make_response, request, Response
 from flask_cors import CORS
 from location_class import DarkSky
 from geonames_parser import Geonames
-from geopy.geocoders import Nominatim
+from forecast_cache import ForecastCache
+from cache_snapshot import CacheSnapshot
+from cache_backends import MemoryBackend, SharedMemoryBackend, SQLiteBackend, dumpValue, loadValue
+from geocoding_cache import GeocodingCache
+from single_flight import SingleFlight
+from upstream_pool import FanOutPool
+from prewarm import PrewarmScheduler
+from http_client import UpstreamClient
+from rendered_body import FORMATS, RenderedBody, msgpack, negotiate, negotiateFormat
+from field_projection import fieldTree, parseFields, project
+from reverse_geocoder import Place, ReverseGeocoder
+from spatial_index import SpatialIndex, checkCoordinates, formatCoordinates
+from gazetteer import Gazetteer, SUGGEST_LIMIT
+from forecast_columns import STATS, SUMMARY_FIELDS, summarize
+from forecast_grid import GRID_FIELDS, Grid, packBinary, packJson
+from map_snapshot import MapSnapshot
+from metrics import Metrics
+from upstream_guard import UpstreamGuard, UpstreamUnavailable, background, inBackground
+from hedging import LatencyWindow, hedge
+from werkzeug.exceptions import BadRequest, HTTPException
 from urllib import error
-from multiprocessing.dummy import Pool as ThreadPool
+from http.client import responses
 from functools import partial
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+import deadline
+import hashlib
 import multiprocessing
+import socket
+import tempfile
+import threading
 import time
 import urllib.request
 import json
 import urllib
 import os
+import signal
+import sys
 import urllib.parse
 
 
@@ -51,15 +80,329 @@ APP_URL_PREFIX = ''
 if 'APP_URL_PREFIX' in os.environ:
     APP_URL_PREFIX = os.environ['APP_URL_PREFIX']
 
+FORECAST_CACHE_TTL = 900
+if 'FORECAST_CACHE_TTL' in os.environ:
+    FORECAST_CACHE_TTL = int(os.environ['FORECAST_CACHE_TTL'])
+
+FORECAST_CACHE_STALE_TTL = 3600
+if 'FORECAST_CACHE_STALE_TTL' in os.environ:
+    FORECAST_CACHE_STALE_TTL = int(os.environ['FORECAST_CACHE_STALE_TTL'])
+
+FORECAST_CACHE_SIZE = 1024
+if 'FORECAST_CACHE_SIZE' in os.environ:
+    FORECAST_CACHE_SIZE = int(os.environ['FORECAST_CACHE_SIZE'])
+
+CACHE_BACKEND = 'memory'
+if 'CACHE_BACKEND' in os.environ:
+    CACHE_BACKEND = os.environ['CACHE_BACKEND']
+
+CACHE_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+if 'CACHE_DIR' in os.environ:
+    CACHE_DIR = os.environ['CACHE_DIR']
+
+CACHE_SHARED_SIZE = 128
+if 'CACHE_SHARED_SIZE' in os.environ:
+    CACHE_SHARED_SIZE = int(os.environ['CACHE_SHARED_SIZE'])
+
+GEOCODING_CACHE_PATH = 'geocoding_cache.sqlite'
+if 'GEOCODING_CACHE_PATH' in os.environ:
+    GEOCODING_CACHE_PATH = os.environ['GEOCODING_CACHE_PATH']
+
+GEOCODING_CACHE_NEGATIVE_TTL = 86400
+if 'GEOCODING_CACHE_NEGATIVE_TTL' in os.environ:
+    GEOCODING_CACHE_NEGATIVE_TTL = int(os.environ['GEOCODING_CACHE_NEGATIVE_TTL'])
+
+CACHE_SNAPSHOT_PATH = 'cache_snapshot.gz'
+if 'CACHE_SNAPSHOT_PATH' in os.environ:
+    CACHE_SNAPSHOT_PATH = os.environ['CACHE_SNAPSHOT_PATH']
+
+CACHE_SNAPSHOT_INTERVAL = 300
+if 'CACHE_SNAPSHOT_INTERVAL' in os.environ:
+    CACHE_SNAPSHOT_INTERVAL = float(os.environ['CACHE_SNAPSHOT_INTERVAL'])
+
+PREWARM_ENABLED = True
+if 'PREWARM_ENABLED' in os.environ:
+    PREWARM_ENABLED = os.environ['PREWARM_ENABLED'] not in ('0', 'false', 'False')
+
+PREWARM_LEAD = 60
+if 'PREWARM_LEAD' in os.environ:
+    PREWARM_LEAD = int(os.environ['PREWARM_LEAD'])
+
+PREWARM_BUDGET = 60
+if 'PREWARM_BUDGET' in os.environ:
+    PREWARM_BUDGET = int(os.environ['PREWARM_BUDGET'])
+
+UPSTREAM_CONNECT_TIMEOUT = 3
+if 'UPSTREAM_CONNECT_TIMEOUT' in os.environ:
+    UPSTREAM_CONNECT_TIMEOUT = float(os.environ['UPSTREAM_CONNECT_TIMEOUT'])
+
+UPSTREAM_READ_TIMEOUT = 10
+if 'UPSTREAM_READ_TIMEOUT' in os.environ:
+    UPSTREAM_READ_TIMEOUT = float(os.environ['UPSTREAM_READ_TIMEOUT'])
+
+UPSTREAM_POOL_SIZE = 16
+if 'UPSTREAM_POOL_SIZE' in os.environ:
+    UPSTREAM_POOL_SIZE = int(os.environ['UPSTREAM_POOL_SIZE'])
+
+REQUEST_DEADLINE = 20
+if 'REQUEST_DEADLINE' in os.environ:
+    REQUEST_DEADLINE = float(os.environ['REQUEST_DEADLINE'])
+
+UPSTREAM_HEDGE = set()
+if 'UPSTREAM_HEDGE' in os.environ:
+    UPSTREAM_HEDGE = set(name.strip() for name in os.environ['UPSTREAM_HEDGE'].split(',') if name.strip())
+
+UPSTREAM_HEDGE_QUANTILE = 0.95
+if 'UPSTREAM_HEDGE_QUANTILE' in os.environ:
+    UPSTREAM_HEDGE_QUANTILE = float(os.environ['UPSTREAM_HEDGE_QUANTILE'])
+
+GAZETTEER_DATA = None
+if 'GAZETTEER_DATA' in os.environ:
+    GAZETTEER_DATA = os.environ['GAZETTEER_DATA']
+
+GAZETTEER_ALTERNATE_NAMES = False
+if 'GAZETTEER_ALTERNATE_NAMES' in os.environ:
+    GAZETTEER_ALTERNATE_NAMES = os.environ['GAZETTEER_ALTERNATE_NAMES'] not in ('0', 'false', 'False')
+
+REVERSE_GEOCODER_DATA = None
+if 'REVERSE_GEOCODER_DATA' in os.environ:
+    REVERSE_GEOCODER_DATA = os.environ['REVERSE_GEOCODER_DATA']
+
+REVERSE_GEOCODER_MAX_DISTANCE = 25
+if 'REVERSE_GEOCODER_MAX_DISTANCE' in os.environ:
+    REVERSE_GEOCODER_MAX_DISTANCE = float(os.environ['REVERSE_GEOCODER_MAX_DISTANCE'])
+
+REVERSE_GEOCODER_FALLBACK = True
+if 'REVERSE_GEOCODER_FALLBACK' in os.environ:
+    REVERSE_GEOCODER_FALLBACK = os.environ['REVERSE_GEOCODER_FALLBACK'] not in ('0', 'false', 'False')
+
+REVERSE_CACHE_TTL = 30 * 86400
+if 'REVERSE_CACHE_TTL' in os.environ:
+    REVERSE_CACHE_TTL = int(os.environ['REVERSE_CACHE_TTL'])
+
+REVERSE_CACHE_NEGATIVE_TTL = 3600
+if 'REVERSE_CACHE_NEGATIVE_TTL' in os.environ:
+    REVERSE_CACHE_NEGATIVE_TTL = int(os.environ['REVERSE_CACHE_NEGATIVE_TTL'])
+
+SPATIAL_PRECISION = 6
+if 'SPATIAL_PRECISION' in os.environ:
+    SPATIAL_PRECISION = int(os.environ['SPATIAL_PRECISION'])
+
+SPATIAL_RADIUS = 1.0
+if 'SPATIAL_RADIUS' in os.environ:
+    SPATIAL_RADIUS = float(os.environ['SPATIAL_RADIUS'])
+
+DARK_SKY_BUDGET = 600
+if 'DARK_SKY_BUDGET' in os.environ:
+    DARK_SKY_BUDGET = float(os.environ['DARK_SKY_BUDGET'])
+
+DARK_SKY_BURST = 600
+if 'DARK_SKY_BURST' in os.environ:
+    DARK_SKY_BURST = int(os.environ['DARK_SKY_BURST'])
+
+GEONAMES_BUDGET = 15
+if 'GEONAMES_BUDGET' in os.environ:
+    GEONAMES_BUDGET = float(os.environ['GEONAMES_BUDGET'])
+
+GEONAMES_BURST = 200
+if 'GEONAMES_BURST' in os.environ:
+    GEONAMES_BURST = int(os.environ['GEONAMES_BURST'])
+
+NOMINATIM_BUDGET = 60
+if 'NOMINATIM_BUDGET' in os.environ:
+    NOMINATIM_BUDGET = float(os.environ['NOMINATIM_BUDGET'])
+
+NOMINATIM_BURST = 10
+if 'NOMINATIM_BURST' in os.environ:
+    NOMINATIM_BURST = int(os.environ['NOMINATIM_BURST'])
+
+UPSTREAM_BACKGROUND_RESERVE = 0.5
+if 'UPSTREAM_BACKGROUND_RESERVE' in os.environ:
+    UPSTREAM_BACKGROUND_RESERVE = float(os.environ['UPSTREAM_BACKGROUND_RESERVE'])
+
+UPSTREAM_BREAKER_FAILURES = 5
+if 'UPSTREAM_BREAKER_FAILURES' in os.environ:
+    UPSTREAM_BREAKER_FAILURES = int(os.environ['UPSTREAM_BREAKER_FAILURES'])
+
+UPSTREAM_BREAKER_RESET = 30
+if 'UPSTREAM_BREAKER_RESET' in os.environ:
+    UPSTREAM_BREAKER_RESET = float(os.environ['UPSTREAM_BREAKER_RESET'])
+
+METRICS_DIR = None
+if 'METRICS_DIR' in os.environ:
+    METRICS_DIR = os.environ['METRICS_DIR']
+
+METRICS_FLUSH_INTERVAL = 5
+if 'METRICS_FLUSH_INTERVAL' in os.environ:
+    METRICS_FLUSH_INTERVAL = float(os.environ['METRICS_FLUSH_INTERVAL'])
+
 CPU_COUNT = multiprocessing.cpu_count()
+
+# Warning header of responses built from forecasts served past their expiry
+STALE_WARNING = '110 - "Response is Stale"'
+
+# Maximum number of serialized views memoized per cached forecast document, map or map
+# version; the least recently used is evicted past it
+RENDERED_VIEWS_LIMIT = 64
+
+BATCH_LIMIT = 50
+if 'BATCH_LIMIT' in os.environ:
+    BATCH_LIMIT = int(os.environ['BATCH_LIMIT'])
+
+GRID_LIMIT = 256
+if 'GRID_LIMIT' in os.environ:
+    GRID_LIMIT = int(os.environ['GRID_LIMIT'])
+
+UPSTREAM_WORKERS = 16
+if 'UPSTREAM_WORKERS' in os.environ:
+    UPSTREAM_WORKERS = int(os.environ['UPSTREAM_WORKERS'])
+
+MAP_FANOUT_LIMIT = 8
+if 'MAP_FANOUT_LIMIT' in os.environ:
+    MAP_FANOUT_LIMIT = int(os.environ['MAP_FANOUT_LIMIT'])
+
+MAP_SNAPSHOT_HISTORY = 64
+if 'MAP_SNAPSHOT_HISTORY' in os.environ:
+    MAP_SNAPSHOT_HISTORY = int(os.environ['MAP_SNAPSHOT_HISTORY'])
+
+MAP_SNAPSHOT_RECHECK = 60
+if 'MAP_SNAPSHOT_RECHECK' in os.environ:
+    MAP_SNAPSHOT_RECHECK = float(os.environ['MAP_SNAPSHOT_RECHECK'])
+
 DARK_SKY_URL = 'https://api.darksky.net/forecast/'
+if 'DARK_SKY_URL' in os.environ:
+    DARK_SKY_URL = os.environ['DARK_SKY_URL']
+
+LANGUAGES = ['et', 'en', 'ru', 'lv']
+
+# Metric label of the upstream each document class comes from
+UPSTREAMS = {DarkSky: 'darksky', Geonames: 'geonames'}
 
 bp = Blueprint('weather', __name__,
                template_folder='templates')
 
 GEONAMES_URL = 'http://api.geonames.org/searchJSON?q='
+if 'GEONAMES_URL' in os.environ:
+    GEONAMES_URL = os.environ['GEONAMES_URL']
+
+NOMINATIM_DOMAIN = 'nominatim.openstreetmap.org'
+if 'NOMINATIM_DOMAIN' in os.environ:
+    NOMINATIM_DOMAIN = os.environ['NOMINATIM_DOMAIN']
+
+NOMINATIM_SCHEME = 'https'
+if 'NOMINATIM_SCHEME' in os.environ:
+    NOMINATIM_SCHEME = os.environ['NOMINATIM_SCHEME']
+
+metrics = Metrics(METRICS_DIR, interval=METRICS_FLUSH_INTERVAL)
+metrics.histogram('weather_http_request_duration_seconds', 'Time spent answering a request, by route.')
+metrics.histogram('weather_upstream_request_duration_seconds', 'Time spent on one upstream HTTP request.')
+metrics.counter('weather_upstream_errors_total', 'Failed upstream requests, by HTTP status, timeout or network.')
+metrics.counter('weather_upstream_hedges_total', 'Duplicate upstream requests sent for slow ones, and how many answered first.')
+metrics.histogram('weather_json_decode_duration_seconds', 'Time spent decoding an upstream response.')
+metrics.histogram('weather_json_encode_duration_seconds', 'Time spent serializing a response body, by format.')
+metrics.counter('weather_cache_requests_total', 'Cache lookups by result.')
+metrics.counter('weather_stale_served_total', 'Cached forecasts served past their expiry because DarkSky failed.')
+metrics.histogram('weather_fanout_width', 'Number of upstream lookups one map or batch request fans out to.',
+                  buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+
+upstream_guards = dict((name, UpstreamGuard(name, budget, burst,
+                                              reserve=UPSTREAM_BACKGROUND_RESERVE,
+                                              failures=UPSTREAM_BREAKER_FAILURES,
+                                              reset=UPSTREAM_BREAKER_RESET))
+                       for name, budget, burst in (('darksky', DARK_SKY_BUDGET, DARK_SKY_BURST),
+                                                   ('geonames', GEONAMES_BUDGET, GEONAMES_BURST),
+                                                   ('nominatim', NOMINATIM_BUDGET, NOMINATIM_BURST)))
+
+upstream_client = UpstreamClient(connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+                                 read_timeout=UPSTREAM_READ_TIMEOUT,
+                                 pool_size=UPSTREAM_POOL_SIZE)
+
+# Latency of the successful calls to each upstream, a call slower than the quantile is hedged
+upstream_latency = dict((name, LatencyWindow(quantile=UPSTREAM_HEDGE_QUANTILE)) for name in upstream_guards)
+
+# Hedged calls wait here for the first answer, so they never take a thread of the fan-out pool
+hedge_pool = ThreadPoolExecutor(max_workers=2 * UPSTREAM_POOL_SIZE, thread_name_prefix='hedge')
+
+# Built by getGeolocator() when the first address is needed
+geolocator = None
+geolocator_lock = threading.Lock()
+
+reverse_geocoder = ReverseGeocoder(REVERSE_GEOCODER_DATA)
+
+gazetteer = Gazetteer(GAZETTEER_DATA, alternateNames=GAZETTEER_ALTERNATE_NAMES)
+
+# Points of the forecasts fetched for the coordinates routes, by language
+spatial_index = SpatialIndex(SPATIAL_PRECISION, maxsize=FORECAST_CACHE_SIZE)
+
+
+# Forecasts are stored as the DarkSky document and the version it was fetched as
+def dumpForecast(darkSky):
+    return json.dumps({'version': darkSky.version, 'data': darkSky.data}, ensure_ascii=False).encode('utf-8')
 
-geolocator = Nominatim()
+
+def loadForecast(data):
+    stored = json.loads(data.decode('utf-8'))
+    darkSky = DarkSky(stored['data'])
+    darkSky.version = stored['version']
+    return darkSky
+
+
+# Stands in the reverse cache for coordinates Nominatim has no address for
+NO_ADDRESS = Place('', None, None, None, None)
+
+
+# Nominatim results are stored as the address, the only part that is used
+def dumpAddress(location):
+    return dumpValue(None if location is None else location.address)
+
+
+def loadAddress(data):
+    address = loadValue(data)
+    if address == '':
+        return NO_ADDRESS
+    return None if address is None else Place(address, None, None, None, None)
+
+
+# Builds the store of one cache as CACHE_BACKEND says: 'memory' for each worker its own,
+# 'sqlite' or 'shared' (memory-mapped) for one per host in CACHE_DIR. Size is in MB.
+def cacheBackend(name, maxsize, size, dumps=dumpValue, loads=loadValue):
+    if CACHE_BACKEND == 'memory':
+        return MemoryBackend(maxsize)
+    path = os.path.join(CACHE_DIR, 'pm-weather-' + name)
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteBackend(path + '.sqlite', maxsize, dumps=dumps, loads=loads)
+    if CACHE_BACKEND == 'shared':
+        return SharedMemoryBackend(path + '.cache', buckets=max((maxsize or 16384) // 2, 1),
+                                   size=size * 1024 * 1024, dumps=dumps, loads=loads)
+    raise ValueError('Unknown CACHE_BACKEND %r, use memory, sqlite or shared' % CACHE_BACKEND)
+
+
+# Nominatim results by coordinates rounded to 3 decimals (about 100 m)
+reverse_cache = ForecastCache(ttl=REVERSE_CACHE_TTL, maxsize=4096, stale_ttl=0,
+                              backend=cacheBackend('reverse', 4096, 8, dumpAddress, loadAddress))
+
+forecast_cache = ForecastCache(ttl=FORECAST_CACHE_TTL,
+                               maxsize=FORECAST_CACHE_SIZE,
+                               stale_ttl=FORECAST_CACHE_STALE_TTL,
+                               backend=cacheBackend('forecast', FORECAST_CACHE_SIZE, CACHE_SHARED_SIZE,
+                                                    dumpForecast, loadForecast))
+
+upstream_flight = SingleFlight()
+
+upstream_pool = FanOutPool(workers=UPSTREAM_WORKERS, per_request=MAP_FANOUT_LIMIT)
+
+geocoding_cache = GeocodingCache(GEOCODING_CACHE_PATH,
+                                 negative_ttl=GEOCODING_CACHE_NEGATIVE_TTL,
+                                 backend=cacheBackend('geocoding', None, 8))
+
+
+def cacheCounters():
+    for name, cache in (('forecast', forecast_cache), ('geocoding', geocoding_cache), ('reverse', reverse_cache)):
+        for result, count in cache.stats().items():
+            yield 'weather_cache_requests_total', {'cache': name, 'result': result}, count
+
+
+metrics.collector(cacheCounters)
 
 
 def getDarkSkySUFFIX(lang):
@@ -76,14 +419,27 @@ def getDarkSkySUFFIX(lang):
 
 
 def checkLang(lang):
-    if lang == 'et' or lang == 'ru' or lang == 'en' or lang == 'lv':
+    if lang in LANGUAGES:
         return make_response(jsonify({'error': 'Specify a location'}))
     else:
         return abort(400)
 
 
 def dumpjson(dict):
-    return json.dumps(dict, ensure_ascii=False).encode('utf-8')
+    with metrics.timer('weather_json_encode_duration_seconds', format='json'):
+        return json.dumps(dict, ensure_ascii=False).encode('utf-8')
+
+
+def dumppack(dict):
+    with metrics.timer('weather_json_encode_duration_seconds', format='msgpack'):
+        return msgpack.packb(dict, use_bin_type=True)
+
+
+# Serializes the body in the format picked by payloadVariant
+def dumpPayload(dict, format):
+    if format == 'msgpack':
+        return dumppack(dict)
+    return dumpjson(dict)
 
 
 def encoding(slug):
@@ -106,19 +462,458 @@ def getURL(location, lang):
     return DARK_SKY_URL + API_KEY + '/' + location + getDarkSkySUFFIX(lang)
 
 
-def parseJson(url, Class):
-    try:
-        parsingJson = urllib.request.urlopen(url).read()
+# Decodes an upstream response body into an instance of Class
+def decodeJson(parsingJson, Class):
+    with metrics.timer('weather_json_decode_duration_seconds', upstream=UPSTREAMS[Class]):
         html = str(parsingJson, 'utf-8')
         jsonReady = json.loads(html)
         result = Class(jsonReady)
-        return result
+    # Identifies the upstream data, ETags are derived from it
+    result.version = hashlib.sha1(parsingJson).hexdigest()[:16]
+    return result
+
+
+# Fetches url from the named upstream through the shared client, recording the time it
+# took and the error if it failed. Raises UpstreamUnavailable without calling the
+# upstream when its budget is spent or its circuit is open, and DeadlineExceeded when
+# the request has no time left. The socket timeout is cut to what is left of it.
+def upstreamOpen(upstream, url, *args, **kwargs):
+    kwargs['timeout'] = upstreamTimeout(upstream, kwargs.get('timeout'))
+    acquireUpstream(upstream)
+    call = partial(upstreamCall, upstream, url, *args, **kwargs)
+    if upstream not in UPSTREAM_HEDGE or inBackground():
+        return call()
+    response, hedged = hedge(hedge_pool, call, upstream_latency[upstream].threshold(),
+                             backup=partial(hedgeCall, upstream, call))
+    if hedged:
+        metrics.inc('weather_upstream_hedges_total', upstream=upstream, result='won')
+    return response
+
+
+def upstreamTimeout(upstream, timeout):
+    try:
+        return deadline.timeout(timeout or UPSTREAM_READ_TIMEOUT)
+    except deadline.DeadlineExceeded:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status='deadline')
+        raise
+
+
+def acquireUpstream(upstream):
+    try:
+        upstream_guards[upstream].acquire()
+    except UpstreamUnavailable as e:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status=e.reason)
+        raise
+
+
+# The duplicate of a slow call. It is background work, so it is only sent while the
+# budget has more than the reserve left.
+def hedgeCall(upstream, call):
+    with background():
+        acquireUpstream(upstream)
+    metrics.inc('weather_upstream_hedges_total', upstream=upstream, result='sent')
+    return call()
+
+
+def upstreamCall(upstream, url, *args, **kwargs):
+    guard = upstream_guards[upstream]
+    start = time.perf_counter()
+    try:
+        response = upstream_client.urlopen(url, *args, **kwargs)
+    except error.HTTPError as e:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status=e.code)
+        guard.record(e.code)
+        raise
+    except deadline.DeadlineExceeded:
+        # Out of time waiting for a pooled connection, nothing was asked of the upstream
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status='deadline')
+        raise
+    except OSError as e:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream,
+                    status='timeout' if isinstance(e, socket.timeout) else 'network')
+        guard.failure()
+        raise
+    finally:
+        metrics.observe('weather_upstream_request_duration_seconds', time.perf_counter() - start, upstream=upstream)
+    guard.record(response.status)
+    upstream_latency[upstream].observe(time.perf_counter() - start)
+    return response
+
+
+# Returns the Nominatim client, importing geopy and building it on first use so that a
+# new instance does not pay for it before it serves anything
+def getGeolocator():
+    global geolocator
+    if geolocator is None:
+        with geolocator_lock:
+            if geolocator is None:
+                from geopy.geocoders import Nominatim
+                locator = Nominatim(domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+                locator.urlopen = partial(upstreamOpen, 'nominatim')
+                geolocator = locator
+    return geolocator
+
+
+def parseJson(url, Class):
+    try:
+        parsingJson = upstreamOpen(UPSTREAMS[Class], url).read()
+        return decodeJson(parsingJson, Class)
+    except UpstreamUnavailable:
+        abort(503)
     except error.HTTPError as e:
         abort(e.code)
+    except OSError:
+        abort(504)
     except ImportError:
         abort(500)
 
 
+# Same as parseJson, but concurrent requests for the same url share one upstream call.
+# A request waiting for another one's call gives up at its own deadline.
+def fetchJson(url, Class):
+    try:
+        return upstream_flight.do(url, partial(parseJson, url, Class), timeout=deadline.remaining())
+    except TimeoutError:
+        abort(504)
+
+
+# Looks the location up from Geonames. Returns None if Geonames has no results for it.
+def resolveGeoNames(location):
+    geoName = fetchJson(getGeoNames(encoding(location)), Geonames)
+    try:
+        return geoName.getCoordinates(0)
+    except IndexError:
+        return None
+
+
+# Looks the location up from the offline gazetteer, and from Geonames if the gazetteer
+# does not know it
+def resolveLocation(location):
+    coordinates = gazetteer.resolve(location)
+    if coordinates is None:
+        coordinates = resolveGeoNames(location)
+    return coordinates
+
+
+# Returns the coordinates for the location, served from the persistent geocoding cache.
+# Raises IndexError if the location does not exist.
+def getCoordinates(location):
+    coordinates = geocoding_cache.get(location, partial(resolveLocation, location))
+    if coordinates is None:
+        raise IndexError(location)
+    return coordinates
+
+
+# Returns the DarkSky forecast for the coordinates, served from the forecast cache.
+# Cached objects are shared between requests, so callers must copy before modifying.
+def getForecast(coordinates, lang):
+    url = getURL(coordinates, lang)
+    key = (coordinates.lower(), lang)
+    try:
+        return forecast_cache.get(key, partial(fetchJson, url, DarkSky))
+    except HTTPException as e:
+        darkSky = staleForecast(key, e.code)
+        if darkSky is None:
+            raise
+        return darkSky
+
+
+# Returns the last forecast cached for the key however old, marked stale, when DarkSky
+# failed with the status code. None if there is none or the error was not DarkSky's.
+def staleForecast(key, code):
+    if code < 500 and code != 429:
+        return None
+    darkSky = forecast_cache.last(key)
+    if darkSky is None:
+        return None
+    metrics.inc('weather_stale_served_total')
+    darkSky = copy.copy(darkSky)
+    darkSky.stale = True
+    return darkSky
+
+
+# Fetches the forecast of a map city straight from DarkSky and stores it in the forecast cache
+def prewarmForecast(key):
+    location, lang = key
+    with background():
+        coordinates = getCoordinates(location)
+        # With a shared cache backend another worker may just have refreshed it
+        age = forecast_cache.age((coordinates.lower(), lang))
+        if age is not None and age < (FORECAST_CACHE_TTL - PREWARM_LEAD) / 2:
+            return
+        url = getURL(coordinates, lang)
+        forecast_cache.set((coordinates.lower(), lang), fetchJson(url, DarkSky))
+
+
+def parseCoordinates(coordinates):
+    lat, lng = coordinates.split(',')
+    return float(lat), float(lng)
+
+
+# Returns the coordinates validated and rounded to 4 decimals (about 11 m), 400 Bad
+# Request if they are not coordinates
+def normalizeCoordinates(coordinates):
+    try:
+        return formatCoordinates(*checkCoordinates(coordinates))
+    except ValueError:
+        abort(400)
+
+
+# Returns (darkSky, coordinates, distance) of a cached forecast within SPATIAL_RADIUS km
+# of the point, the nearest one, or None if there is none
+def nearbyForecast(lat, lng, lang):
+    if not SPATIAL_RADIUS:
+        return None
+    for distance, point, pointLat, pointLng in spatial_index.nearby(lang, lat, lng, SPATIAL_RADIUS):
+        darkSky = forecast_cache.peek((point, lang), partial(fetchJson, getURL(point, lang), DarkSky))
+        if darkSky is not None:
+            return darkSky, point, distance
+        # Evicted from the forecast cache
+        spatial_index.discard(lang, point)
+    return None
+
+
+# Returns (darkSky, coordinates, distance) for normalized coordinates: a forecast already
+# fetched nearby if there is one, otherwise the forecast of the coordinates themselves
+def getNearbyForecast(coordinates, lang):
+    lat, lng = parseCoordinates(coordinates)
+    found = nearbyForecast(lat, lng, lang)
+    if found is not None:
+        return found
+    darkSky = getForecast(coordinates, lang)
+    spatial_index.add(lang, coordinates, lat, lng)
+    return darkSky, coordinates, 0.0
+
+
+# Tells which coordinates the forecast of a coordinates request is for, and how many km
+# away from the requested ones they are
+def markDistance(output, point, distance):
+    response = make_response(output)
+    response.headers['X-Forecast-Coordinates'] = point
+    response.headers['X-Forecast-Distance'] = '%.3f' % distance
+    return response
+
+
+# Returns the nearest place from the offline reverse geocoder, or None if it has no
+# place close enough to the coordinates
+def localReverse(coordinates):
+    try:
+        lat, lng = parseCoordinates(coordinates)
+    except ValueError:
+        return None
+    place = reverse_geocoder.nearest(lat, lng)
+    if place is None or place.distance > REVERSE_GEOCODER_MAX_DISTANCE:
+        return None
+    return place
+
+
+# Starts the reverse geocode of the coordinates, to be done while their forecast is
+# fetched. Returns an object whose result() is the address.
+def startReverse(coordinates):
+    place = localReverse(coordinates)
+    if place is not None:
+        future = Future()
+        future.set_result(place)
+        return future
+    return upstream_pool.submit(reverseGeocode, coordinates)
+
+
+# Returns the address for the coordinates. The offline reverse geocoder answers if it
+# can, otherwise Nominatim is asked, cached on the rounded coordinates.
+def reverseGeocode(coordinates):
+    place = localReverse(coordinates)
+    if place is not None:
+        return place
+    if not REVERSE_GEOCODER_FALLBACK:
+        abort(404)
+    lat, lng = parseCoordinates(coordinates)
+    key = '%.3f,%.3f' % (lat, lng)
+    try:
+        # Coordinates without an address are asked again after REVERSE_CACHE_NEGATIVE_TTL
+        place = reverse_cache.peek(key)
+        if place is None or place is NO_ADDRESS and (reverse_cache.age(key) or 0) >= REVERSE_CACHE_NEGATIVE_TTL:
+            # Concurrent misses for the same key share one Nominatim call
+            place = upstream_flight.do(('reverse', key), lambda: getGeolocator().reverse(key),
+                                       timeout=deadline.remaining())
+            if place is None:
+                place = NO_ADDRESS
+            reverse_cache.set(key, place)
+        return None if place is NO_ADDRESS else place
+    except TimeoutError:
+        abort(504)
+    except Exception as e:
+        geocoderError(e)
+        raise
+
+
+# Answers a failed Nominatim call like the other upstreams: 503 if the call was refused
+# by the budget or circuit breaker (or Nominatim is down), 504 if it timed out or the
+# request ran out of time. geopy wraps what upstreamOpen raised, so its cause is looked at.
+# Returns for any other error.
+def geocoderError(e):
+    from geopy.exc import GeopyError, GeocoderTimedOut, GeocoderUnavailable
+    if not isinstance(e, GeopyError):
+        return
+    cause = e.__cause__ or e.__context__
+    if isinstance(e, GeocoderTimedOut) or isinstance(cause, TimeoutError):
+        abort(504)
+    if isinstance(e, GeocoderUnavailable) or isinstance(cause, UpstreamUnavailable):
+        abort(503)
+
+
+# Builds one view of a forecast document. The label is the location 'name' for
+# searched locations and the 'address' for coordinates.
+def buildView(darkSky, view, field, label, fields=None):
+    fulldict = {}
+    fulldict['location'] = darkSky.view(view)
+    if fields is not None:
+        fulldict['location'] = project(fulldict['location'], fieldTree(fields))
+    fulldict['location'][field] = label
+    if view == 'current' and field == 'name':
+        fulldict['location']['latitude'] = darkSky.data['latitude']
+        fulldict['location']['longitude'] = darkSky.data['longitude']
+    return fulldict
+
+
+# Key of the body variant in ETags, empty for the whole document as JSON
+def variantKey(fields, format):
+    if fields is None and format == 'json':
+        return ''
+    return '\n' + (fields or '') + '\n' + format
+
+
+def viewEtag(darkSky, view, field, label, fields=None, format='json'):
+    key = ('\n'.join((view, field, label)) + variantKey(fields, format)).encode('utf-8')
+    return darkSky.version + '-' + hashlib.sha1(key).hexdigest()[:12]
+
+
+rendered_lock = threading.Lock()
+
+
+# Returns the body memoized under the key in `bodies` (an OrderedDict), marking it recently used
+def recallBody(bodies, key):
+    with rendered_lock:
+        rendered = bodies.get(key)
+        if rendered is not None:
+            bodies.move_to_end(key)
+        return rendered
+
+
+# Memoizes a body in `bodies`, evicting the least recently used past RENDERED_VIEWS_LIMIT
+def keepBody(bodies, key, rendered):
+    with rendered_lock:
+        bodies[key] = rendered
+        bodies.move_to_end(key)
+        while len(bodies) > RENDERED_VIEWS_LIMIT:
+            bodies.popitem(last=False)
+
+
+# Returns the serialized view. The body is memoized on the cached document, so
+# it is dropped together with it when the forecast is refreshed.
+def renderView(darkSky, view, field, label, fields=None, format='json'):
+    key = (view, field, label, fields, format)
+    rendered = recallBody(darkSky.rendered, key)
+    if rendered is None:
+        rendered = RenderedBody(dumpPayload(buildView(darkSky, view, field, label, fields), format),
+                                viewEtag(darkSky, view, field, label, fields, format))
+        keepBody(darkSky.rendered, key, rendered)
+    return rendered
+
+
+# Parses the ?from=, ?days=, ?stats= and ?fields= parameters of the summary views
+# through get(name, default). Aborts with 400 if they are not valid.
+def summaryQuery(get):
+    try:
+        start = int(get('from', 0))
+        days = int(get('days', 3))
+    except ValueError:
+        abort(400)
+    stats = tuple(get('stats', 'min,max,mean,median').split(','))
+    fields = tuple(get('fields', ','.join(SUMMARY_FIELDS)).split(','))
+    if start < 0 or days < 1 or start + days > 8 or not all(stat in STATS for stat in stats):
+        abort(400)
+    return {'start': start, 'days': days, 'stats': stats, 'fields': fields}
+
+
+# Min/max/mean/median of the daily values over a window of days, and the precipitation total
+def buildSummary(darkSky, field, label, query):
+    fulldict = {}
+    fulldict['location'] = summarize([darkSky.columns()], **query)[0]
+    fulldict['location'][field] = label
+    return fulldict
+
+
+# Returns the ETag from If-None-Match that matches any encoding of the etag, or None
+def notModified(etag):
+    tags = request.if_none_match
+    if tags.star_tag:
+        return etag
+    for tag in tags.as_set(include_weak=True):
+        if tag == etag or tag.startswith(etag + '-'):
+            return tag
+    return None
+
+
+def notModifiedResponse(etag):
+    response = make_response(b'', 304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.vary.add('Accept')
+    return response
+
+
+# Sends the rendered body in the best encoding the client accepts
+def sendRendered(rendered, format='json'):
+    body, encoding, etag = rendered.encoded(negotiate(request.headers.get('Accept-Encoding')))
+    response = make_response(body)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    response.vary.add('Accept')
+    if encoding is not None:
+        response.content_encoding = encoding
+    if format != 'json':
+        response.content_type = FORMATS[format]
+    return response
+
+
+# Parses ?fields=, see field_projection. Aborts with 400 if it is not valid.
+def fieldsQuery(fields):
+    try:
+        return parseFields(fields)
+    except ValueError:
+        abort(400)
+
+
+# Returns (fields, format) of the body asked for: the ?fields= projection, None for the
+# whole document, and 'msgpack' or 'json' from ?format= or else the Accept header.
+# MessagePack is only sent if the msgpack package is installed, JSON otherwise.
+def payloadVariant(fields, format, accept):
+    fields = fieldsQuery(fields)
+    if format is None:
+        return fields, negotiateFormat(accept)
+    if format not in FORMATS:
+        abort(400)
+    return fields, format if msgpack is not None else 'json'
+
+
+# Answers a view request, with 304 Not Modified if the client already has it
+def viewResponse(darkSky, view, field, label):
+    fields, format = payloadVariant(request.args.get('fields'), request.args.get('format'),
+                                    request.headers.get('Accept'))
+    matched = notModified(viewEtag(darkSky, view, field, label, fields, format))
+    if matched is not None:
+        return markStale(notModifiedResponse(matched), [darkSky])
+    return markStale(sendRendered(renderView(darkSky, view, field, label, fields, format), format), [darkSky])
+
+
+# Adds a Warning header to the response if any of the forecasts is a stale fallback
+def markStale(output, forecasts):
+    response = make_response(output)
+    if any(getattr(darkSky, 'stale', False) for darkSky in forecasts):
+        response.headers['Warning'] = STALE_WARNING
+    return response
+
+
 # def graylogger(e):
 #    graylog.error(e, extra={
 #        'extra': 'metadata',
@@ -136,54 +931,47 @@ def nothing(lang):
 @bp.route('/<lang>/<location>')
 def search_location(location, lang):
     try:
-        url = getGeoNames(encoding(location))
-    except NameError:
-        abort(404)
-    try:
-        geoName = parseJson(url, Geonames)
-        coordinates = geoName.getCoordinates(0)
-        forDarkSky = getURL(coordinates, lang)
-        darkSky = parseJson(forDarkSky, DarkSky)
-        fulldict = {}
-        fulldict['location'] = darkSky.data
-        fulldict['location']['name'] = location.title()
-        output = dumpjson(fulldict)
+        darkSky = getForecast(getCoordinates(location), lang)
+        output = viewResponse(darkSky, 'full', 'name', location.title())
     except IndexError:
         output = abort(404)
     return output
 
 
+# Autocomplete for location names from the offline gazetteer, most populous places first.
+# ?limit= sets the number of suggestions (at most 10).
+@bp.route('/<lang>/suggest/<prefix>')
+def suggest(lang, prefix):
+    return suggestions(lang, prefix, request.args.get('limit', SUGGEST_LIMIT))
+
+
+def suggestions(lang, prefix, limit):
+    if lang not in LANGUAGES:
+        abort(400)
+    if not gazetteer.ready:
+        abort(503)
+    try:
+        limit = min(int(limit), SUGGEST_LIMIT)
+    except ValueError:
+        abort(400)
+    return dumpjson({'suggestions': [place.dict() for place in gazetteer.suggest(prefix, limit)]})
+
+
 # Returns the current (or forecast) dataset for the searched location. Used to
 # fill the current (or future) weather information box
 @bp.route('/<lang>/<location>/<endpoint>')
 def search_location_endpoints(location, lang, endpoint):
     try:
-        url = getGeoNames(encoding(location))
-    except NameError:
-        abort(404)
-    try:
-        geoName = parseJson(url, Geonames)
-        coordinates = geoName.getCoordinates(0)
-        forDarkSky = getURL(coordinates, lang)
-        darkSky = parseJson(forDarkSky, DarkSky)
+        coordinates = getCoordinates(location)
+        darkSky = getForecast(coordinates, lang)
         fulldict = {}
-        if endpoint == 'current':
-            darkSky.data['currently']['name'] = location.title()
-            fulldict['location'] = darkSky.data['currently']
-            fulldict['location']['latitude'] = darkSky.data['latitude']
-            fulldict['location']['longitude'] = darkSky.data['longitude']
-            output = dumpjson(fulldict)
-        elif endpoint == 'forecast':
-            darkSky.data['daily']['name'] = location.title()
-            fulldict['location'] = darkSky.data['daily']
-            output = dumpjson(fulldict)
-        elif endpoint == 'basic':
-            fulldict['location'] = darkSky.basicforecast()
-            fulldict['location']['name'] = location.title()
-            output = dumpjson(fulldict)
+        if endpoint in ('current', 'forecast', 'basic'):
+            output = viewResponse(darkSky, endpoint, 'name', location.title())
+        elif endpoint == 'summary':
+            output = markStale(dumpjson(buildSummary(darkSky, 'name', location.title(),
+                                                     summaryQuery(request.args.get))), [darkSky])
         else:
-            url = getURL(coordinates, endpoint)
-            locationUNIX = parseJson(url, DarkSky)
+            locationUNIX = getForecast(coordinates, endpoint)
             fulldict[location.getName(0)] = locationUNIX.data
             output = dumpjson(fulldict)
     except IndexError:
@@ -194,17 +982,12 @@ def search_location_endpoints(location, lang, endpoint):
 # Returns the full dataset for the specified coordinates (address based on the location is included)
 @bp.route('/<lang>/coordinates/<coordinates>')
 def coordinates(coordinates, lang):
+    coordinates = normalizeCoordinates(coordinates)
+    reverse = startReverse(coordinates)
     try:
-        url = getURL(coordinates, lang)
-    except NameError:
-        abort(404)
-    try:
-        fulldict = {}
-        location = parseJson(url, DarkSky)
-        name = geolocator.reverse(coordinates)
-        fulldict['location'] = location.data
-        fulldict['location']['address'] = name.address
-        output = dumpjson(fulldict)
+        location, point, distance = getNearbyForecast(coordinates, lang)
+        name = reverse.result()
+        output = markDistance(viewResponse(location, 'full', 'address', name.address), point, distance)
     except NameError:
         output = abort(404)
     return output
@@ -213,31 +996,22 @@ def coordinates(coordinates, lang):
 # Detailed response with coordinates
 @bp.route('/<lang>/coordinates/<coordinates>/<endpoint>')
 def coordinates_endpoints(lang, coordinates, endpoint):
-    try:
-        url = getURL(coordinates, lang)
-    except NameError:
-        abort(404)
+    coordinates = normalizeCoordinates(coordinates)
+    reverse = startReverse(coordinates)
     try:
         fulldict = {}
-        darkSky = parseJson(url, DarkSky)
-        name = geolocator.reverse(coordinates)
-        if endpoint == 'current':
-            darkSky.data['currently']['address'] = name.address
-            fulldict['location'] = darkSky.data['currently']
-            output = dumpjson(fulldict)
-        elif endpoint == 'forecast':
-            darkSky.data['daily']['address'] = name.address
-            fulldict['location'] = darkSky.data['daily']
-            output = dumpjson(fulldict)
-        elif endpoint == 'basic':
-            fulldict['location'] = darkSky.basicforecast()
-            fulldict['location']['address'] = name.address
-            output = dumpjson(fulldict)
+        darkSky, point, distance = getNearbyForecast(coordinates, lang)
+        name = reverse.result()
+        if endpoint in ('current', 'forecast', 'basic'):
+            output = viewResponse(darkSky, endpoint, 'address', name.address)
+        elif endpoint == 'summary':
+            output = markStale(dumpjson(buildSummary(darkSky, 'address', name.address,
+                                                     summaryQuery(request.args.get))), [darkSky])
         else:
-            url = getURL(coordinates, endpoint)
-            locationUNIX = parseJson(url, DarkSky)
+            locationUNIX, point, distance = getNearbyForecast(coordinates, endpoint)
             fulldict[name.address] = locationUNIX.data
             output = dumpjson(fulldict)
+        output = markDistance(output, point, distance)
     except NameError:
         output = abort(404)
     return output
@@ -339,48 +1113,164 @@ european_map = {
 }
 
 
+map_areas = {
+    'europe': european_map,
+    'estonia': estonian_map}
+
+# Serialized maps by (area, lang), replaced whenever one of the cities changes
+rendered_maps = OrderedDict()
+
+# Snapshots of the maps by (area, lang), see map_snapshot
+map_snapshots = {}
+map_snapshots_lock = threading.Lock()
+
+# (area, location) of the map cities by the forecast cache key of their coordinates
+map_cities = {}
+
+
+# Returns the cached forecast document for a map location
 def create_map(location, lang):
     try:
-        url = getGeoNames(encoding(location))
-    except NameError:
-        abort(404)
-    try:
-        geoName = parseJson(url, Geonames)
-        coordinates = geoName.getCoordinates(0)
-        forDarkSky = getURL(coordinates, lang)
-        darkSky = parseJson(forDarkSky, DarkSky)
-        fulldict = {}
-        fulldict['location'] = darkSky.data
-        fulldict['location']['name'] = location.title()
-        output = dumpjson(fulldict)
+        darkSky = getForecast(getCoordinates(location), lang)
     except IndexError:
-        output = abort(404)
-    return output
+        darkSky = abort(404)
+    return darkSky
 
 
-@bp.route('/<lang>/map/<area>')
-def map(lang, area):
+def mapVersion(forecasts, fields=None, format='json'):
+    key = ' '.join(darkSky.version for darkSky in forecasts) + variantKey(fields, format)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
 
-    start = time.time()
+
+# Returns the serialized map. It is only rebuilt when one of the cities has changed.
+# Every projection and format is kept as its own body.
+def renderMap(area, lang, locations, forecasts, fields=None, format='json'):
+    version = mapVersion(forecasts, fields, format)
+    key = (area, lang, fields, format)
+    rendered = recallBody(rendered_maps, key)
+    if rendered is None or rendered.etag != version:
+        json_array = {}
+        for location, darkSky in zip(locations, forecasts):
+            item = buildView(darkSky, 'full', 'name', location.title(), fields)
+            json_array[item['location']['name']] = item
+        rendered = RenderedBody(dumpPayload(json_array, format), version)
+        keepBody(rendered_maps, key, rendered)
+    return rendered
+
+
+# Returns the snapshot of a map, 400 Bad Request for an unknown language and KeyError
+# for an unknown area. The cities are sorted, so every worker and every restart comes
+# to the same version for the same forecasts.
+def mapSnapshot(area, lang):
+    locations = map_areas[area]
+    getDarkSkySUFFIX(lang)
+    snapshot = map_snapshots.get((area, lang))
+    if snapshot is None:
+        with map_snapshots_lock:
+            snapshot = map_snapshots.get((area, lang))
+            if snapshot is None:
+                snapshot = MapSnapshot(sorted(locations), mapVersion,
+                                       history=MAP_SNAPSHOT_HISTORY, recheck=MAP_SNAPSHOT_RECHECK)
+                map_snapshots[(area, lang)] = snapshot
+    return snapshot
+
+
+# Returns the forecast cache key and the forecast of a map city
+def mapCity(location, lang):
     try:
-        if area == 'europe':
-           map = european_map
-        elif area == 'estonia':
-           map = estonian_map
+        coordinates = getCoordinates(location)
+    except IndexError:
+        abort(404)
+    return (coordinates.lower(), lang), getForecast(coordinates, lang)
+
+
+# Takes a looked up city into its map's snapshot. Later forecasts stored for the same
+# key are taken in as they are stored, see mapForecastStored.
+def takeMapCity(area, lang, location, key, darkSky):
+    map_cities.setdefault(key, set()).add((area, location))
+    map_snapshots[(area, lang)].update(location, darkSky)
+
+
+def mapForecastStored(key, darkSky):
+    for area, location in tuple(map_cities.get(key, ())):
+        map_snapshots[(area, key[1])].update(location, darkSky)
+
+
+forecast_cache.listen(mapForecastStored)
 
-        pool = ThreadPool(len(map))
+
+# Brings the snapshot of a map up to date and returns it. Only the cities that are due
+# are looked up, the rest were taken in when their forecasts were refreshed.
+def updateMap(area, lang):
+    snapshot = mapSnapshot(area, lang)
+    due = snapshot.due()
+    if due:
+        metrics.observe('weather_fanout_width', len(due), route='map')
+        for location, (key, darkSky) in zip(due, upstream_pool.map(partial(mapCity, lang=lang), due)):
+            takeMapCity(area, lang, location, key, darkSky)
+    return snapshot
+
+
+# ETag of the changes of a map since the version `since`, of the whole map as changes
+# if that version is not remembered
+def deltaVersion(state, since, fields=None, format='json'):
+    known = since if state.changed is not None else ''
+    key = state.version + '\n' + known + variantKey(fields, format)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+# Returns the serialized changes of a map since the version `since`: the new version and
+# the cities that changed, keyed like the map. If `since` is not remembered every city is
+# in it and 'full' is true. Kept with the snapshot until the map changes.
+def renderDelta(locations, state, since, fields=None, format='json'):
+    known = since if state.changed is not None else None
+    key = (known, fields, format)
+    rendered = recallBody(state.bodies, key)
+    if rendered is None:
+        changed = set(locations if known is None else state.changed)
         json_array = {}
-        pooled_list = pool.map(partial(search_location, lang=lang), map)
+        for location, darkSky in zip(locations, state.forecasts):
+            if location in changed:
+                item = buildView(darkSky, 'full', 'name', location.title(), fields)
+                json_array[item['location']['name']] = item
+        payload = {'version': state.version, 'full': known is None, 'changed': json_array}
+        rendered = RenderedBody(dumpPayload(payload, format), deltaVersion(state, since, fields, format))
+        keepBody(state.bodies, key, rendered)
+    return rendered
+
+
+# Adds the map version, the `since` of the next poll, and the stale warning to a map response
+def markMap(output, state):
+    response = markStale(output, state.forecasts)
+    response.headers['X-Map-Version'] = state.version
+    return response
 
-        for item in pooled_list:
-            item = json.loads(str(item, 'utf-8'))
-            json_array[item['location']['name']] = item
-        output = dumpjson(json_array)
 
-        pool.close()
-        pool.join()
+# Returns the full map, or with ?since=<version> only the cities that changed since
+@bp.route('/<lang>/map/<area>')
+def map(lang, area):
 
-    except NameError:
+    start = time.time()
+    try:
+        fields, format = payloadVariant(request.args.get('fields'), request.args.get('format'),
+                                        request.headers.get('Accept'))
+        since = request.args.get('since')
+        snapshot = updateMap(area, lang)
+        state = snapshot.read(since)
+
+        if since is None:
+            matched = notModified(mapVersion(state.forecasts, fields, format))
+        else:
+            matched = notModified(deltaVersion(state, since, fields, format))
+        if matched is not None:
+            return markMap(notModifiedResponse(matched), state)
+        if since is None:
+            rendered = renderMap(area, lang, snapshot.locations, state.forecasts, fields, format)
+        else:
+            rendered = renderDelta(snapshot.locations, state, since, fields, format)
+        output = markMap(sendRendered(rendered, format), state)
+
+    except KeyError:
         output = abort(404)
 
     end = time.time()
@@ -388,6 +1278,239 @@ def map(lang, area):
     return output
 
 
+# Summaries of every city on the map, keyed like the map. They are computed in one
+# vectorized pass over all the cities.
+def mapSummary(locations, forecasts, query):
+    summaries = summarize([darkSky.columns() for darkSky in forecasts], **query)
+    json_array = {}
+    for location, summary in zip(locations, summaries):
+        summary['name'] = location.title()
+        json_array[location.title()] = {'location': summary}
+    return json_array
+
+
+@bp.route('/<lang>/map/<area>/summary')
+def map_summary(lang, area):
+    query = summaryQuery(request.args.get)
+    try:
+        locations = sorted(map_areas[area])
+    except KeyError:
+        abort(404)
+    metrics.observe('weather_fanout_width', len(locations), route='map')
+    forecasts = upstream_pool.map(partial(create_map, lang=lang), locations)
+    return markStale(dumpjson(mapSummary(locations, forecasts, query)), forecasts)
+
+
+def streamLine(location, darkSky, fields=None):
+    return dumpjson(buildView(darkSky, 'full', 'name', location.title(), fields)) + b'\n'
+
+
+# The last line of a streamed map, listing the cities that could not be fetched
+def streamTrailer(failed):
+    return dumpjson({'failed': [dict(batchError(e), name=location.title()) for location, e in failed]}) + b'\n'
+
+
+# Streams the map as NDJSON: one line per city in the order they arrive, the same
+# object the full map has under the city's name, then a trailer with the failures.
+@bp.route('/<lang>/map/<area>/stream')
+def map_stream(lang, area):
+    if area not in map_areas:
+        abort(404)
+    getDarkSkySUFFIX(lang)
+    fields = fieldsQuery(request.args.get('fields'))
+    metrics.observe('weather_fanout_width', len(map_areas[area]), route='map')
+
+    def generate():
+        failed = []
+        for location, future in upstream_pool.as_completed(partial(create_map, lang=lang), map_areas[area]):
+            e = future.exception()
+            if e is not None:
+                failed.append((location, e))
+                continue
+            yield streamLine(location, future.result(), fields)
+        yield streamTrailer(failed)
+
+    # The upstream calls are made while the body streams, after the request's teardown
+    return Response(deadline.carry(generate()), mimetype='application/x-ndjson')
+
+
+# Checks a batch query and aborts with 400 if it is not valid
+def checkBatch(lang, locations, coordinates, view):
+    getDarkSkySUFFIX(lang)
+    if view not in DarkSky.views:
+        abort(400)
+    if not isinstance(locations, list) or not isinstance(coordinates, list):
+        abort(400)
+    if not all(isinstance(item, str) for item in locations + coordinates):
+        abort(400)
+    if len(locations) + len(coordinates) > BATCH_LIMIT:
+        abort(400)
+
+
+# The per-item error of a batch response, worded like the error handlers. Flask
+# aborts carry the status in 'code', Tornado errors in 'status_code'.
+def batchError(e):
+    if isinstance(e, IndexError):
+        code = 404
+    else:
+        code = getattr(e, 'code', None) or getattr(e, 'status_code', None) or 500
+    return {'error': 'Error %d %s' % (code, responses.get(code, 'Unknown'))}
+
+
+# Validates and rounds the coordinates of a batch like normalizeCoordinates. Returns
+# {item: coordinates}, with a 400 Bad Request error for the items that are not coordinates.
+def batchCoordinates(coordinates):
+    checked = {}
+    for item in coordinates:
+        try:
+            checked[item] = formatCoordinates(*checkCoordinates(item))
+        except ValueError:
+            checked[item] = BadRequest()
+    return checked
+
+
+def batchResults(view, locations, coordinates, resolved, forecasts, checked):
+    """
+    Builds the batch response. `resolved` maps location names and `checked` the
+    coordinates items (see batchCoordinates) to coordinates, and `forecasts` maps
+    coordinates to documents, any of them may hold exceptions instead. Location names
+    are looked up in lowercase.
+    """
+    output = {'locations': [], 'coordinates': []}
+    for location in locations:
+        darkSky = forecasts.get(resolved[location.lower()], resolved[location.lower()])
+        if isinstance(darkSky, Exception):
+            output['locations'].append(batchError(darkSky))
+        else:
+            output['locations'].append(buildView(darkSky, view, 'name', location.title()))
+    for item in coordinates:
+        darkSky = forecasts.get(checked[item], checked[item])
+        if isinstance(darkSky, Exception):
+            output['coordinates'].append(batchError(darkSky))
+        else:
+            output['coordinates'].append(buildView(darkSky, view, 'coordinates', item))
+    return output
+
+
+# Returns the value of every future, or the exception it raised
+def settle(futures):
+    results = []
+    for future in futures:
+        e = future.exception()
+        results.append(e if e is not None else future.result())
+    return results
+
+
+# Weather for many locations and coordinates in one request. POST a JSON object
+# {"locations": [...], "coordinates": [...], "view": "basic"} or GET with repeated
+# ?location= and ?coordinates= parameters. Entries that resolve to the same coordinates
+# are fetched once, and an entry that fails gets an 'error' instead of failing the batch.
+@bp.route('/<lang>/batch', methods=['GET', 'POST'])
+def batch(lang):
+    if request.method == 'POST':
+        query = request.get_json(force=True, silent=True)
+        if not isinstance(query, dict):
+            abort(400)
+        locations = query.get('locations', [])
+        coordinates = query.get('coordinates', [])
+        view = query.get('view', 'full')
+    else:
+        locations = request.args.getlist('location')
+        coordinates = request.args.getlist('coordinates')
+        view = request.args.get('view', 'full')
+    checkBatch(lang, locations, coordinates, view)
+
+    names = list(dict.fromkeys(location.lower() for location in locations))
+    checked = batchCoordinates(coordinates)
+    metrics.observe('weather_fanout_width', len(names) + len(checked), route='batch')
+    resolved = dict(zip(names, settle(upstream_pool.submit_all(getCoordinates, names))))
+
+    points = list(dict.fromkeys(value for value in list(resolved.values()) + list(checked.values())
+                                if isinstance(value, str)))
+    forecasts = dict(zip(points, settle(upstream_pool.submit_all(partial(getForecast, lang=lang), points))))
+
+    return markStale(dumpjson(batchResults(view, locations, coordinates, resolved, forecasts, checked)), forecasts.values())
+
+
+# Parses a grid request into the grid and the fields to sample. 400 Bad Request for a box
+# or resolution that is not one, or more than GRID_LIMIT points.
+def gridQuery(lang, bbox, resolution, fields):
+    getDarkSkySUFFIX(lang)
+    try:
+        grid = Grid(bbox, float(resolution))
+    except ValueError:
+        abort(400)
+    if len(grid) > GRID_LIMIT:
+        abort(400)
+    fields = tuple(dict.fromkeys(field for field in fields.split(',') if field)) if fields else GRID_FIELDS
+    if not fields:
+        abort(400)
+    return grid, fields
+
+
+# 'binary' if ?format=binary or the client accepts application/octet-stream, else 'json'
+def gridFormat(format, accept):
+    if format is None:
+        return 'binary' if 'application/octet-stream' in accept else 'json'
+    if format not in ('binary', 'json'):
+        abort(400)
+    return format
+
+
+# The forecasts of the grid points, None for the ones that failed. Fails like the first
+# point did if none could be fetched.
+def gridForecasts(results):
+    if results and all(isinstance(result, Exception) for result in results):
+        raise results[0]
+    return [None if isinstance(result, Exception) else result[0] for result in results]
+
+
+def gridVersion(fields, format, forecasts):
+    versions = ' '.join('-' if darkSky is None else darkSky.version for darkSky in forecasts)
+    return hashlib.sha1((format + ' ' + ','.join(fields) + ' ' + versions).encode('utf-8')).hexdigest()[:16]
+
+
+def renderGrid(grid, fields, format, forecasts):
+    header = grid.header(fields, sum(1 for darkSky in forecasts if darkSky is None))
+    arrays = grid.sample(forecasts, fields)
+    if format == 'binary':
+        body = packBinary(header, arrays)
+    else:
+        body = dumpjson(packJson(header, arrays))
+    return RenderedBody(body, gridVersion(fields, format, forecasts))
+
+
+# Current values (?fields=temperature,precipIntensity,windSpeed by default) over a grid of
+# points every <resolution> degrees in the box <south,west,north,east>, for map layers.
+# Each field is a float32 array, as base64 in JSON or, with ?format=binary or
+# Accept: application/octet-stream, packed after a small header (see forecast_grid).
+# Points near an already fetched forecast reuse it, ones that fail are NaN.
+@bp.route('/<lang>/grid/<bbox>/<resolution>')
+def grid(lang, bbox, resolution):
+    area, fields = gridQuery(lang, bbox, resolution, request.args.get('fields'))
+    format = gridFormat(request.args.get('format'), request.headers.get('Accept', ''))
+    points = [formatCoordinates(lat, lng) for lat, lng in area.points()]
+    metrics.observe('weather_fanout_width', len(points), route='grid')
+    forecasts = gridForecasts(settle(upstream_pool.submit_all(partial(getNearbyForecast, lang=lang), points)))
+    present = [darkSky for darkSky in forecasts if darkSky is not None]
+
+    matched = notModified(gridVersion(fields, format, forecasts))
+    if matched is not None:
+        response = notModifiedResponse(matched)
+    else:
+        response = sendRendered(renderGrid(area, fields, format, forecasts))
+        if format == 'binary':
+            response.mimetype = 'application/octet-stream'
+    return markStale(response, present)
+
+
+# Counters and latency histograms in the Prometheus text format. With METRICS_DIR set
+# they cover every gunicorn worker, whichever one answers.
+@bp.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @bp.route('/error/<slug>')
 def error_slug(slug):
     if slug == '400':
@@ -430,10 +1553,31 @@ def fiveofour(e):
     return make_response(jsonify({'error': 'Error 504 Gateway Timeout'}), 503)
 
 
+@bp.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    deadline.start(REQUEST_DEADLINE)
+
+
+@bp.teardown_request
+def clear_deadline(exception):
+    deadline.clear()
+
+
 @bp.after_request
 def add_header(response):
     response.cache_control.max_age = 900
-    response.content_type = 'application/json; charset=utf-8'
+    if response.mimetype not in ('application/x-ndjson', 'text/plain', 'application/octet-stream', 'application/msgpack'):
+        response.content_type = 'application/json; charset=utf-8'
+    return response
+
+
+# Streamed bodies are timed to the first byte
+@bp.after_request
+def record_request(response):
+    if 'request_start' in g:
+        metrics.observe('weather_http_request_duration_seconds', time.perf_counter() - g.request_start,
+                        route=request.url_rule.rule, method=request.method, status=response.status_code)
     return response
 
 
@@ -441,7 +1585,53 @@ app = Flask(__name__)
 app.register_blueprint(bp, url_prefix=APP_URL_PREFIX)
 CORS(app, resources=r'/*')
 
+# The caches are restored from the last snapshot before anything is fetched, and written
+# back periodically and at exit
+cache_snapshot = CacheSnapshot(CACHE_SNAPSHOT_PATH, interval=CACHE_SNAPSHOT_INTERVAL)
+cache_snapshot.add('forecast', forecast_cache, dumpForecast, loadForecast)
+cache_snapshot.add('geocoding', geocoding_cache, dumpValue, loadValue)
+cache_snapshot.add('reverse', reverse_cache, dumpAddress, loadAddress)
+if CACHE_SNAPSHOT_PATH:
+    cache_snapshot.load()
+    cache_snapshot.start()
+
+# Fills the geocoding cache with the map cities, within what is left of the Geonames budget
+def seedGeocoding():
+    with background():
+        geocoding_cache.seed(sorted(estonian_map | european_map), resolveLocation)
+    geocoding_seeded.set()
+
+
+def startSeeding():
+    if not geocoding_seeded.is_set():
+        threading.Thread(target=seedGeocoding, name='geocoding-seed', daemon=True).start()
+
+
+def startPrewarm():
+    global prewarm
+    prewarm = PrewarmScheduler([(location, lang) for lang in LANGUAGES
+                                for location in sorted(estonian_map | european_map)],
+                               prewarmForecast,
+                               ttl=FORECAST_CACHE_TTL,
+                               lead=PREWARM_LEAD,
+                               budget=PREWARM_BUDGET)
+    prewarm.start()
+
+
+geocoding_seeded = threading.Event()
+startSeeding()
+# Threads do not survive a fork: every worker forked by gunicorn --preload seeds (what is
+# still missing) and prewarms its own caches
+os.register_at_fork(after_in_child=startSeeding)
+
+prewarm = None
+if PREWARM_ENABLED:
+    startPrewarm()
+    os.register_at_fork(after_in_child=startPrewarm)
+
 if __name__ == '__main__':
+    # Exit normally on SIGTERM, so the cache snapshot is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     #app.run(host='0.0.0.0', port=int(APP_PORT))
     app.run()
     # app.run(host='127.0.0.1', port=8080, debug=True)
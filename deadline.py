@@ -0,0 +1,61 @@
+import contextvars
+import time
+
+# time.monotonic() by which the current request has to be answered, None for no limit.
+# A context variable, so it follows the request into the fan-out pool (see
+# upstream_pool.FanOutPool) and into Tornado's tasks.
+current = contextvars.ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request has no time left for an upstream call"""
+
+
+def start(seconds):
+    """Give the current request `seconds` to answer, `0` for no limit"""
+    current.set(time.monotonic() + seconds if seconds else None)
+
+
+def clear():
+    current.set(None)
+
+
+def remaining():
+    """Seconds the current request has left, `None` without a deadline"""
+    at = current.get()
+    return None if at is None else at - time.monotonic()
+
+
+def timeout(default):
+    """`default` seconds, or what is left of the deadline if that is less. Raises DeadlineExceeded if nothing is."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(default, left) if default else left
+
+
+def carry(iterable):
+    """
+    Iterate `iterable` under the current deadline. A streamed body is generated
+    after the request is torn down and its deadline cleared.
+    """
+    at = current.get()
+
+    def generate():
+        iterator = iter(iterable)
+        try:
+            while True:
+                token = current.set(at)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    current.reset(token)
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+    return generate()
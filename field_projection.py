@@ -0,0 +1,51 @@
+# Most paths one ?fields= may list
+FIELDS_LIMIT = 64
+
+
+def parseFields(text):
+    """
+    Parse a `fields=` parameter: comma separated paths of keys joined with
+    dots, e.g. `currently.temperature,currently.icon,daily.data.icon`.
+    Returns the paths sorted and without duplicates as one string, usable as
+    a cache key, or `None` when no projection is asked for. Raises ValueError
+    for an empty path or key.
+    """
+    if text is None:
+        return None
+    paths = sorted(set(path.strip() for path in text.split(',')))
+    if not paths or len(paths) > FIELDS_LIMIT or not all(paths) or \
+            any(not key for path in paths for key in path.split('.')):
+        raise ValueError(text)
+    return ','.join(paths)
+
+
+def fieldTree(fields):
+    """Nested `{key: subtree}` of parsed `fields`, `None` marks a key that is kept whole"""
+    tree = {}
+    for path in fields.split(','):
+        node = tree
+        keys = path.split('.')
+        for key in keys[:-1]:
+            child = node.get(key, {})
+            if child is None:
+                # An ancestor is already kept whole
+                break
+            node = node.setdefault(key, child)
+        else:
+            node[keys[-1]] = None
+    return tree
+
+
+def project(value, tree):
+    """
+    The part of `value` selected by `tree`. A path runs through lists, so
+    `daily.data.icon` keeps the icon of every day. Keys that are not there
+    are left out.
+    """
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return dict((key, project(value[key], subtree)) for key, subtree in tree.items() if key in value)
+    return value
@@ -0,0 +1,62 @@
+import unittest
+
+from field_projection import FIELDS_LIMIT, fieldTree, parseFields, project
+
+FORECAST = {
+    'latitude': 59.4372,
+    'longitude': 24.7454,
+    'currently': {'temperature': 3.4, 'icon': 'cloudy', 'summary': 'Cloudy'},
+    'daily': {'summary': 'Rain on Sunday.',
+              'data': [{'icon': 'rain', 'temperatureMax': 5.1},
+                       {'icon': 'snow', 'temperatureMax': -1.0},
+                       {'temperatureMax': 0.2}]},
+}
+
+
+class ParseFieldsTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertIsNone(parseFields(None))
+        self.assertEqual(parseFields('currently.icon, currently.temperature,currently.icon'),
+                         'currently.icon,currently.temperature')
+        # The same projection asked in another order is the same cache key
+        self.assertEqual(parseFields('daily.data.icon,currently'), parseFields('currently,daily.data.icon'))
+
+    def test_invalid(self):
+        for text in ('', ',', 'currently,', 'currently..icon', '.icon', 'currently.'):
+            self.assertRaises(ValueError, parseFields, text)
+        self.assertRaises(ValueError, parseFields, ','.join('f%d' % i for i in range(FIELDS_LIMIT + 1)))
+        self.assertEqual(len(parseFields(','.join('f%d' % i for i in range(FIELDS_LIMIT))).split(',')), FIELDS_LIMIT)
+
+
+class ProjectTest(unittest.TestCase):
+    def fields(self, text):
+        return project(FORECAST, fieldTree(parseFields(text)))
+
+    def test_tree(self):
+        self.assertEqual(fieldTree('currently.icon,currently.temperature,daily.data.icon'),
+                         {'currently': {'icon': None, 'temperature': None}, 'daily': {'data': {'icon': None}}})
+        # A key kept whole swallows its descendants, whichever comes first
+        self.assertEqual(fieldTree(parseFields('currently.icon,currently')), {'currently': None})
+        self.assertEqual(fieldTree('currently,currently.icon'), {'currently': None})
+
+    def test_nested(self):
+        self.assertEqual(self.fields('currently.temperature,latitude'),
+                         {'currently': {'temperature': 3.4}, 'latitude': 59.4372})
+        self.assertEqual(self.fields('currently'), {'currently': FORECAST['currently']})
+
+    def test_through_lists(self):
+        self.assertEqual(self.fields('daily.data.icon'),
+                         {'daily': {'data': [{'icon': 'rain'}, {'icon': 'snow'}, {}]}})
+
+    def test_missing(self):
+        self.assertEqual(self.fields('hourly.data.icon,currently.ozone,flags'), {'currently': {}})
+        # A path past a plain value keeps the value
+        self.assertEqual(self.fields('latitude.degrees'), {'latitude': 59.4372})
+
+    def test_not_changed(self):
+        self.fields('currently.icon')
+        self.assertEqual(FORECAST['currently'], {'temperature': 3.4, 'icon': 'cloudy', 'summary': 'Cloudy'})
+
+
+if __name__ == '__main__':
+    unittest.main()
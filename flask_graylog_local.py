@@ -1,12 +1,79 @@
 import logging
+import queue
+import random
+import threading
 import time
 
 from flask import g, request
 import graypy
 
 
+class BackgroundHandler(logging.Handler):
+    """
+    Logging handler that hands records to `target` on a background thread.
+
+    `emit` only puts the record on a bounded queue. When the queue is full the
+    record is dropped (and counted in `dropped`) instead of blocking the
+    caller. The sender thread takes up to `batch_size` queued items per
+    wakeup. An item may also be a function returning the record, so building
+    it is left to the sender thread as well.
+
+    :param target: The handler that actually sends the records
+    :type target: `logging.Handler`
+    :param queue_size: Maximum number of records waiting to be sent
+    :type queue_size: `int`
+    :param batch_size: Maximum number of records sent per wakeup
+    :type batch_size: `int`
+    """
+
+    def __init__(self, target, queue_size=10000, batch_size=100):
+        super(BackgroundHandler, self).__init__()
+        self.target = target
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='graylog', daemon=True)
+        self.thread.start()
+
+    def emit(self, record):
+        self.enqueue(record)
+
+    def enqueue(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is None:
+                    return
+                try:
+                    self.target.handle(item() if callable(item) else item)
+                except Exception:
+                    self.handleError(item if isinstance(item, logging.LogRecord) else None)
+
+    def close(self):
+        """Send what is still queued, waiting at most a few seconds, then stop"""
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+            self.thread.join(timeout=5)
+        self.target.close()
+        super(BackgroundHandler, self).close()
+
+
 class Graylog(logging.Logger):
-    __slots__ = ['app', 'config', 'handler']
+    __slots__ = ['app', 'config', 'handler', 'background']
 
     def __init__(self, app=None, config=None, level=logging.WARNING):
         """
@@ -40,6 +107,10 @@ class Graylog(logging.Logger):
           GRAYLOG_EXTRA_FIELDS - whether or not to include `extra` fields from the message [default: True]
           GRAYLOG_ADD_DEBUG_FIELDS - whether extra python debug fields should be added to each message [default: True]
           GRAYLOG_CONFIGURE_MIDDLEWARE - whether to setup middleware to log each response [default: True]
+          GRAYLOG_QUEUE_SIZE - maximum number of messages waiting to be sent, more are dropped [default: 10000]
+          GRAYLOG_BATCH_SIZE - maximum number of messages sent per wakeup of the sender thread [default: 100]
+          GRAYLOG_SAMPLE_RATE - fraction of the successful (below 400) responses that are logged [default: 1.0]
+          GRAYLOG_SLOW_REQUEST - responses slower than this many milliseconds are always logged [default: 1000]
 
         :param app: Flask application to configure this logger for
         :type app: flask.Flask
@@ -61,8 +132,13 @@ class Graylog(logging.Logger):
         self.config.setdefault('GRAYLOG_EXTRA_FIELDS', True)
         self.config.setdefault('GRAYLOG_ADD_DEBUG_FIELDS', True)
         self.config.setdefault('GRAYLOG_CONFIGURE_MIDDLEWARE', True)
+        self.config.setdefault('GRAYLOG_QUEUE_SIZE', 10000)
+        self.config.setdefault('GRAYLOG_BATCH_SIZE', 100)
+        self.config.setdefault('GRAYLOG_SAMPLE_RATE', 1.0)
+        self.config.setdefault('GRAYLOG_SLOW_REQUEST', 1000)
 
-        # Configure the logging handler and attach to this logger
+        # Configure the logging handler and attach to this logger. Messages are sent
+        # from a background thread, never from the request thread.
         self.handler = graypy.GELFHandler(
             host=self.config['GRAYLOG_HOST'],
             port=self.config['GRAYLOG_PORT'],
@@ -70,7 +146,12 @@ class Graylog(logging.Logger):
             extra_fields=self.config['GRAYLOG_EXTRA_FIELDS'],
             debugging_fields=self.config['GRAYLOG_ADD_DEBUG_FIELDS'],
         )
-        self.addHandler(self.handler)
+        self.background = BackgroundHandler(
+            self.handler,
+            queue_size=int(self.config['GRAYLOG_QUEUE_SIZE']),
+            batch_size=int(self.config['GRAYLOG_BATCH_SIZE']),
+        )
+        self.addHandler(self.background)
 
         # Setup middleware if they asked for it
         if self.config['GRAYLOG_CONFIGURE_MIDDLEWARE']:
@@ -88,43 +169,62 @@ class Graylog(logging.Logger):
 
     def after_request(self, response):
         """Middleware helper to report each flask response to graylog"""
+        if not self.isEnabledFor(logging.INFO):
+            return response
+
         # Calculate the elapsed time for this request
         elapsed = 0
         if hasattr(g, 'graylog_start_time'):
             elapsed = time.time() - g.graylog_start_time
             elapsed = int(round(1000 * elapsed))
 
+        # Errors and slow requests are always logged, the rest is sampled
+        if response.status_code < 400 and elapsed < self.config['GRAYLOG_SLOW_REQUEST']:
+            if random.random() >= self.config['GRAYLOG_SAMPLE_RATE']:
+                return response
+
+        # Only copy what the message needs here, it is built on the sender thread
+        snapshot = (str(request.endpoint), request.view_args, list(response.headers),
+                    dict(request.environ), response.status_code, elapsed, time.time())
+        self.background.enqueue(lambda: self.response_record(*snapshot))
+
+        return response
+
+    def response_record(self, endpoint, view_args, response_headers, environ, status_code, elapsed, finished):
+        """Build the log record of a finished request"""
         # Extra metadata to include with the message
         extra = {
             'flask': {
-                'endpoint': str(request.endpoint).lower(),
-                'view_args': request.view_args,
+                'endpoint': endpoint.lower(),
+                'view_args': view_args,
             },
             'response': {
                 'headers': dict(
                     (key.replace('-', '_').lower(), value)
-                    for key, value in response.headers
+                    for key, value in response_headers
                     if key.lower() not in ('cookie', )
                 ),
             },
-            'request_url': request.environ.get('PATH_INFO'),
+            'request_url': environ.get('PATH_INFO'),
             'response_time': elapsed,
-            'response_code': response.status_code,
+            'response_code': status_code,
             'headers': dict(
                 (key[5:].replace('-', '_').lower(), value)
-                for key, value in request.environ.items()
+                for key, value in environ.items()
                 if key.startswith('HTTP_') and key.lower() not in ('http_cookie',)),
             'request': {
-                'content_length': request.environ.get('CONTENT_LENGTH'),
-                'content_type': request.environ.get('CONTENT_TYPE'),
-                'method': request.environ.get('REQUEST_METHOD'),
-                'query_string': request.environ.get('QUERY_STRING'),
-                'remote_addr': request.environ.get('REMOTE_ADDR')
+                'content_length': environ.get('CONTENT_LENGTH'),
+                'content_type': environ.get('CONTENT_TYPE'),
+                'method': environ.get('REQUEST_METHOD'),
+                'query_string': environ.get('QUERY_STRING'),
+                'remote_addr': environ.get('REMOTE_ADDR')
             },
         }
 
         #message = 'Finishing request for "%s %s" from %s' % (request.method, request.url, extra.get('remote_addr', '-'))
         message = 'oskar-api'
-        self.info(message, extra=extra)
-
-        return response
+        record = self.makeRecord(self.name, logging.INFO, __file__, 0, message, (), None, extra=extra)
+        # Timestamped when the request finished, not when it was sent
+        record.created = finished
+        record.msecs = (finished - int(finished)) * 1000
+        return record
@@ -0,0 +1,140 @@
+import threading
+import time
+
+from cache_backends import MemoryBackend
+
+
+class ForecastCache:
+    """
+    TTL cache with stale-while-revalidate.
+
+    Entries younger than `ttl` are served as they are. Entries older than `ttl`
+    but younger than `ttl + stale_ttl` are served stale while a background
+    thread reloads them. Anything older is treated as a miss.
+
+    The entries live in `backend` (see cache_backends), an in-process LRU of
+    `maxsize` entries unless another one is given.
+
+    :param ttl: Seconds an entry is considered fresh
+    :type ttl: `int`
+    :param maxsize: Maximum number of entries kept before evicting the least recently used
+    :type maxsize: `int`
+    :param stale_ttl: Seconds an expired entry may still be served while it is refreshed
+    :type stale_ttl: `int`
+    :param backend: Where the entries are stored
+    :type backend: `cache_backends.MemoryBackend`, `cache_backends.SQLiteBackend`,
+        `cache_backends.SharedMemoryBackend` or `None`
+    """
+
+    def __init__(self, ttl=900, maxsize=1024, stale_ttl=3600, backend=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.stale_ttl = stale_ttl
+        self.backend = backend if backend is not None else MemoryBackend(maxsize)
+        # Keys this process is reloading in the background
+        self.refreshing = set()
+        # Called with (key, value) whenever a value is stored
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+
+    def peek(self, key, loader=None):
+        """
+        Return the cached value for `key`, or `None` on a miss. A stale value is
+        returned as well, and refreshed in the background with `loader()`.
+        """
+        now = time.time()
+        entry = self.backend.get(key)
+        if entry is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        value, stored = entry
+        age = now - stored
+        if age < self.ttl:
+            with self.lock:
+                self.hits += 1
+            return value
+        if age < self.ttl + self.stale_ttl:
+            with self.lock:
+                self.stale += 1
+                if loader is None or key in self.refreshing:
+                    return value
+                self.refreshing.add(key)
+            threading.Thread(target=self.refresh, args=(key, loader), daemon=True).start()
+            return value
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def get(self, key, loader):
+        """Return the value for `key`, calling `loader()` on a miss"""
+        value = self.peek(key, loader)
+        if value is None:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, time.time())
+        for listener in self.listeners:
+            listener(key, value)
+
+    def listen(self, listener):
+        """Call `listener(key, value)` whenever this process stores a value, also a background refresh"""
+        self.listeners.append(listener)
+
+    def age(self, key):
+        """Seconds since `key` was stored, or `None` if it is not cached"""
+        entry = self.backend.get(key)
+        return None if entry is None else time.time() - entry[1]
+
+    def last(self, key):
+        """Return the value stored for `key` however old it is, or `None`"""
+        entry = self.backend.get(key)
+        return None if entry is None else entry[0]
+
+    def refresh(self, key, loader):
+        """Reload `key` in the background, keeping the stale value if the reload fails"""
+        try:
+            self.set(key, loader())
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def entries(self):
+        """Every cached `(key, value, stored)`, for a snapshot"""
+        return self.backend.items()
+
+    def restore(self, entries):
+        """
+        Store `(key, value, stored)` entries from a snapshot, keeping their
+        original times. Entries too old to be served, even stale, and entries
+        the cache already has a newer value for are skipped. Returns how many
+        were stored.
+        """
+        now = time.time()
+        restored = 0
+        for key, value, stored in entries:
+            if now - stored >= self.ttl + self.stale_ttl:
+                continue
+            current = self.backend.get(key)
+            if current is not None and current[1] >= stored:
+                continue
+            self.backend.set(key, value, stored)
+            restored += 1
+        return restored
+
+    def stats(self):
+        """Number of lookups so far by result"""
+        return {'hit': self.hits, 'stale': self.stale, 'miss': self.misses}
+
+    def clear(self):
+        self.backend.clear()
+
+    def __len__(self):
+        return len(self.backend)
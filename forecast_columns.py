@@ -0,0 +1,75 @@
+import warnings
+
+import numpy as np
+
+# Daily fields summarized when no fields are asked for
+SUMMARY_FIELDS = ('temperatureMax', 'temperatureMin', 'apparentTemperatureMax', 'apparentTemperatureMin',
+                  'precipProbability', 'windSpeed', 'humidity', 'cloudCover')
+
+STATS = {'min': np.nanmin,
+         'max': np.nanmax,
+         'mean': np.nanmean,
+         'median': np.nanmedian}
+
+
+def block(data, name):
+    """Turn `data[name]['data']` into `{field: float array}`, skipping text fields. Missing values are NaN."""
+    rows = data.get(name, {}).get('data', [])
+    fields = set()
+    for row in rows:
+        fields.update(row)
+    columns = {}
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        if all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in values):
+            columns[field] = np.array([np.nan if value is None else value for value in values], dtype=float)
+    return columns
+
+
+class Columns:
+    """
+    Columnar form of a DarkSky document: the daily block as one NumPy array
+    per field, built once per document.
+    """
+
+    def __init__(self, data):
+        self.daily = block(data, 'daily')
+
+
+def window(columnsList, field, start, days):
+    """Stack `field` over the day window into a (documents x days) matrix, padded with NaN"""
+    matrix = np.full((len(columnsList), days), np.nan)
+    for i, columns in enumerate(columnsList):
+        values = columns.daily.get(field)
+        if values is not None:
+            part = values[start:start + days]
+            matrix[i, :len(part)] = part
+    return matrix
+
+
+def number(value):
+    return None if np.isnan(value) else round(float(value), 2)
+
+
+def summarize(columnsList, start=0, days=3, stats=('min', 'max', 'mean', 'median'), fields=SUMMARY_FIELDS):
+    """
+    Aggregate a window of days for many documents at once. Every statistic is
+    one NumPy call over a (documents x days) matrix, so a whole map costs about
+    as much as a single city. Returns one summary dict per document.
+    """
+    summaries = [{'from': start, 'days': days} for _ in columnsList]
+    with warnings.catch_warnings():
+        # All-NaN windows (fields DarkSky left out) just summarize to None
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for field in fields:
+            matrix = window(columnsList, field, start, days)
+            for stat in stats:
+                values = STATS[stat](matrix, axis=1)
+                for summary, value in zip(summaries, values):
+                    summary.setdefault(field, {})[stat] = number(value)
+
+        # Daily precipIntensity is the average in mm/h over the day
+        totals = np.nansum(window(columnsList, 'precipIntensity', start, days) * 24, axis=1)
+        for summary, value in zip(summaries, totals):
+            summary['precipTotal'] = number(value)
+    return summaries
@@ -0,0 +1,110 @@
+import base64
+import json
+import math
+import struct
+
+import numpy as np
+
+# First bytes of a binary grid, then the header length
+GRID_MAGIC = b'PMG1'
+GRID_PREFIX = struct.Struct('<4sI')
+
+# Fields of the 'currently' block sampled when no fields are asked for
+GRID_FIELDS = ('temperature', 'precipIntensity', 'windSpeed')
+
+# Grid coordinates are rounded to this many decimals, like the coordinates routes
+GRID_DECIMALS = 4
+
+
+def parseBox(bbox):
+    """Parse `south,west,north,east`, raising ValueError unless it is a box on the globe"""
+    south, west, north, east = (float(value) for value in bbox.split(','))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError(bbox)
+    return south, west, north, east
+
+
+def axis(start, stop, step):
+    # The box edges are included when they fall on the grid, small float error is forgiven
+    count = int(math.floor((stop - start) / step + 1e-9)) + 1
+    return [round(start + i * step, GRID_DECIMALS) + 0.0 for i in range(count)]
+
+
+class Grid:
+    """
+    Points every `resolution` degrees over a bounding box, from the south-west
+    corner north- and eastwards.
+
+    Values are sampled into one float32 array per field, row by row from the
+    south, each row from the west. Cells without a forecast or without the
+    field are NaN.
+
+    :param bbox: `south,west,north,east` in degrees
+    :type bbox: `str`
+    :param resolution: Degrees between the points
+    :type resolution: `float`
+    """
+
+    def __init__(self, bbox, resolution):
+        if not resolution > 0:
+            raise ValueError(resolution)
+        self.south, self.west, self.north, self.east = parseBox(bbox)
+        self.resolution = resolution
+        # A resolution far below the box would need an absurd number of cells before it is refused
+        if (self.north - self.south) / resolution > 1e6 or (self.east - self.west) / resolution > 1e6:
+            raise ValueError(resolution)
+        self.lats = axis(self.south, self.north, resolution)
+        self.lngs = axis(self.west, self.east, resolution)
+
+    def __len__(self):
+        return len(self.lats) * len(self.lngs)
+
+    def points(self):
+        """`(lat, lng)` of every cell in array order"""
+        return [(lat, lng) for lat in self.lats for lng in self.lngs]
+
+    def sample(self, forecasts, fields):
+        """`{field: float32 array}` of the current values, `forecasts` in array order with `None` for missing"""
+        arrays = dict((field, np.full(len(self), np.nan, dtype='<f4')) for field in fields)
+        for i, darkSky in enumerate(forecasts):
+            if darkSky is None:
+                continue
+            currently = darkSky.data.get('currently', {})
+            for field in fields:
+                value = currently.get(field)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    arrays[field][i] = value
+        return arrays
+
+    def header(self, fields, missing):
+        return {'rows': len(self.lats),
+                'cols': len(self.lngs),
+                'south': self.lats[0],
+                'west': self.lngs[0],
+                'north': self.lats[-1],
+                'east': self.lngs[-1],
+                'resolution': self.resolution,
+                'fields': list(fields),
+                'dtype': 'float32',
+                'missing': missing}
+
+
+def packBinary(header, arrays):
+    """
+    `PMG1`, the header length as a little-endian uint32, the JSON header
+    padded with spaces to a multiple of 4 bytes, then the arrays one after
+    the other as little-endian float32, in the order of `header['fields']`.
+    Every array starts 4-byte aligned, so it can be viewed without a copy.
+    """
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    encoded += b' ' * (-(GRID_PREFIX.size + len(encoded)) % 4)
+    return b''.join([GRID_PREFIX.pack(GRID_MAGIC, len(encoded)), encoded] +
+                    [arrays[field].tobytes() for field in header['fields']])
+
+
+def packJson(header, arrays):
+    """The header with a 'data' object of the arrays as base64 little-endian float32"""
+    packed = dict(header)
+    packed['data'] = dict((field, base64.b64encode(arrays[field].tobytes()).decode('ascii'))
+                          for field in header['fields'])
+    return packed
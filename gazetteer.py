@@ -0,0 +1,361 @@
+import heapq
+import io
+import mmap
+import os
+import struct
+import threading
+import unicodedata
+
+MAGIC = b'GAZ2'
+HEADER = struct.Struct('<4sIIIII')
+# latitude, longitude, population, name offset, name length, country code, feature class, admin1 code
+PLACE = struct.Struct('<ddqIH2sc8s')
+# key offset, key length, place
+KEY = struct.Struct('<IHI')
+# prefix offset, prefix length, first posting, posting count
+PREFIX = struct.Struct('<IHII')
+POSTING = struct.Struct('<I')
+# name offset, name length, country code, admin1 code (blank for a country)
+QUALIFIER = struct.Struct('<IH2s8s')
+
+# GeoNames files read from next to the dump, if they are there, for country and
+# first-level administrative division names
+COUNTRY_INFO = 'countryInfo.txt'
+ADMIN1_CODES = 'admin1CodesASCII.txt'
+
+# Prefixes up to this length get a precomputed list of their most populous places
+PREFIX_DEPTH = 3
+# Length of each precomputed postings list, and the most suggestions a query returns
+SUGGEST_LIMIT = 10
+# Longer prefixes are answered by scanning the sorted keys, at most this many of them
+SCAN_LIMIT = 20000
+
+SPECIAL = str.maketrans({'ø': 'o', 'ł': 'l', 'đ': 'd', 'æ': 'ae', 'œ': 'oe', 'ı': 'i', 'þ': 'th', 'ð': 'd'})
+
+
+def normalize(text):
+    """Case and diacritic insensitive form of a place name, 'Pärnu' -> 'parnu'"""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.translate(SPECIAL).split())
+
+
+class Suggestion:
+    __slots__ = ['name', 'country', 'latitude', 'longitude', 'population']
+
+    def __init__(self, name, country, latitude, longitude, population):
+        self.name = name
+        self.country = country
+        self.latitude = latitude
+        self.longitude = longitude
+        self.population = population
+
+    def coordinates(self):
+        return repr(self.latitude) + ',' + repr(self.longitude)
+
+    def dict(self):
+        return {'name': self.name,
+                'country': self.country,
+                'latitude': self.latitude,
+                'longitude': self.longitude,
+                'population': self.population}
+
+
+def rank(population, featureClass):
+    # Populated places come before administrative areas of the same name
+    return (featureClass == b'P', population)
+
+
+def code(text, size):
+    return text.encode('ascii', 'replace')[:size].ljust(size)
+
+
+def readQualifiers(source):
+    """
+    `(name, country code, admin1 code)` of the countries and first-level
+    divisions in GeoNames' countryInfo.txt and admin1CodesASCII.txt next to
+    `source`, where they exist.
+    """
+    directory = os.path.dirname(source)
+    path = os.path.join(directory, COUNTRY_INFO)
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if not line.startswith('#') and len(fields) > 4:
+                    yield fields[4], fields[0], ''
+    path = os.path.join(directory, ADMIN1_CODES)
+    if os.path.exists(path):
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > 2 and '.' in fields[0]:
+                    country, admin1 = fields[0].split('.', 1)
+                    yield fields[1], country, admin1
+                    yield fields[2], country, admin1
+
+
+def build(source, target, alternateNames=False):
+    """
+    Build the index file `target` from a GeoNames dump. Only populated places
+    and administrative areas (feature classes P and A) are indexed.
+
+    The names of countries and first-level divisions, from the dump itself
+    and from the files of COUNTRY_INFO and ADMIN1_CODES, are kept as the
+    qualifiers of `Gazetteer.resolve`.
+    """
+    places = []
+    keys = []
+    qualifiers = set((normalize(name), code(country, 2), code(admin1, 8))
+                     for name, country, admin1 in readQualifiers(source))
+    blob = io.BytesIO()
+
+    def store(text):
+        data = text.encode('utf-8')
+        offset = blob.tell()
+        blob.write(data)
+        return offset, len(data)
+
+    with io.open(source, encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 15 or fields[6] not in ('P', 'A'):
+                continue
+            try:
+                lat = float(fields[4])
+                lng = float(fields[5])
+                population = int(fields[14] or 0)
+            except ValueError:
+                continue
+            place = len(places)
+            offset, length = store(fields[1])
+            places.append((lat, lng, population, offset, length,
+                           code(fields[8], 2), fields[6].encode('ascii'), code(fields[10], 8)))
+            names = {normalize(fields[1]), normalize(fields[2])}
+            if alternateNames and fields[3]:
+                names.update(normalize(name) for name in fields[3].split(','))
+            for name in names:
+                if name:
+                    keys.append((name, place))
+            # allCountries.txt has the countries and divisions as places of their own
+            if fields[7].startswith('PCL'):
+                qualifiers.update((name, code(fields[8], 2), code('', 8)) for name in names if name)
+            elif fields[7] == 'ADM1':
+                qualifiers.update((name, code(fields[8], 2), code(fields[10], 8)) for name in names if name)
+
+    def order(item):
+        place = places[item[1]]
+        return item[0], not rank(place[2], place[6])[0], -place[2], item[1]
+
+    keys.sort(key=order)
+
+    # Flattened trie of the short prefixes, each with its most populous places
+    postings = []
+    prefixes = []
+    tops = {}
+    for name, place in keys:
+        for length in range(1, min(len(name), PREFIX_DEPTH) + 1):
+            tops.setdefault(name[:length], set()).add(place)
+    for prefix in sorted(tops):
+        top = heapq.nlargest(SUGGEST_LIMIT, tops[prefix], key=lambda p: rank(places[p][2], places[p][6]))
+        offset, length = store(prefix)
+        prefixes.append((offset, length, len(postings), len(top)))
+        postings.extend(top)
+
+    key_records = []
+    for name, place in keys:
+        offset, length = store(name)
+        key_records.append((offset, length, place))
+
+    qualifier_records = []
+    for name, country, admin1 in sorted(qualifiers):
+        offset, length = store(name)
+        qualifier_records.append((offset, length, country, admin1))
+
+    # Every worker may build it at once, each writes its own file and the last replace wins
+    temporary = '%s.%d.tmp' % (target, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(places), len(key_records), len(prefixes), len(postings),
+                            len(qualifier_records)))
+        for record in places:
+            f.write(PLACE.pack(*record))
+        for record in key_records:
+            f.write(KEY.pack(*record))
+        for record in prefixes:
+            f.write(PREFIX.pack(*record))
+        for posting in postings:
+            f.write(POSTING.pack(posting))
+        for record in qualifier_records:
+            f.write(QUALIFIER.pack(*record))
+        f.write(blob.getvalue())
+    os.replace(temporary, target)
+
+
+class Gazetteer:
+    """
+    Offline place name index built from a GeoNames dump, read through mmap.
+
+    The index file holds a place table, the normalized names sorted
+    alphabetically (and by rank within a name), a flattened prefix trie for
+    short prefixes with population-ranked postings, and a string blob. It is
+    built next to the dump on first use and rebuilt when the dump changes.
+
+    :param path: GeoNames dump file, `None` disables the gazetteer
+    :type path: `str` or `None`
+    :param alternateNames: Index the alternate names (other languages) too
+    :type alternateNames: `bool`
+    """
+
+    def __init__(self, path=None, alternateNames=False):
+        self.path = path
+        self.alternateNames = alternateNames
+        self.ready = False
+        if path is not None:
+            self.start()
+            # A worker forked by gunicorn --preload has no loading thread, it loads
+            # (or builds) again unless loading was done before the fork
+            os.register_at_fork(after_in_child=self.forked)
+
+    def start(self):
+        threading.Thread(target=self.load, name='gazetteer', daemon=True).start()
+
+    def forked(self):
+        if not self.ready:
+            self.start()
+
+    def load(self):
+        index = self.path + '.idx'
+        if not os.path.exists(index) or os.path.getmtime(index) < os.path.getmtime(self.path) or \
+                not self.current(index):
+            build(self.path, index, self.alternateNames)
+        with open(index, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.places, self.keys, self.prefixes, self.postings, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a gazetteer index' % index)
+        self.placeStart = HEADER.size
+        self.keyStart = self.placeStart + self.places * PLACE.size
+        self.prefixStart = self.keyStart + self.keys * KEY.size
+        self.postingStart = self.prefixStart + self.prefixes * PREFIX.size
+        qualifierStart = self.postingStart + self.postings * POSTING.size
+        self.blobStart = qualifierStart + count * QUALIFIER.size
+        # Normalized country or division name -> [(country code, admin1 code)], a few thousand at most
+        self.qualifiers = {}
+        for i in range(count):
+            offset, length, country, admin1 = QUALIFIER.unpack_from(self.mm, qualifierStart + i * QUALIFIER.size)
+            self.qualifiers.setdefault(self.text(offset, length), []).append((country, admin1))
+        self.ready = True
+
+    def current(self, index):
+        # An index written by an older version of this module is rebuilt
+        with open(index, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    def text(self, offset, length):
+        start = self.blobStart + offset
+        return self.mm[start:start + length].decode('utf-8')
+
+    def place(self, i):
+        lat, lng, population, offset, length, country, featureClass, admin1 = \
+            PLACE.unpack_from(self.mm, self.placeStart + i * PLACE.size)
+        return Suggestion(self.text(offset, length), country.decode('ascii').strip(), lat, lng, population)
+
+    def placeCodes(self, i):
+        record = PLACE.unpack_from(self.mm, self.placeStart + i * PLACE.size)
+        return record[5], record[7]
+
+    def placeRank(self, i):
+        record = PLACE.unpack_from(self.mm, self.placeStart + i * PLACE.size)
+        return rank(record[2], record[6])
+
+    def key(self, i):
+        offset, length, place = KEY.unpack_from(self.mm, self.keyStart + i * KEY.size)
+        return self.text(offset, length), place
+
+    def lowerBound(self, name):
+        lo, hi = 0, self.keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid)[0] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def prefixPostings(self, prefix):
+        lo, hi = 0, self.prefixes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, first, count = PREFIX.unpack_from(self.mm, self.prefixStart + mid * PREFIX.size)
+            text = self.text(offset, length)
+            if text == prefix:
+                return [POSTING.unpack_from(self.mm, self.postingStart + (first + i) * POSTING.size)[0]
+                        for i in range(count)]
+            if text < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return []
+
+    def qualifies(self, place, qualifier):
+        """
+        Whether the place is in the country or first-level division named by
+        `qualifier`: a name from the index, or an ISO country or admin1 code.
+        """
+        country, admin1 = self.placeCodes(place)
+        upper = qualifier.upper().encode('ascii', 'replace')
+        if upper == country.rstrip() or upper == admin1.rstrip():
+            return True
+        return any(country == qualifiedCountry and (not qualifiedAdmin1.strip() or admin1 == qualifiedAdmin1)
+                   for qualifiedCountry, qualifiedAdmin1 in self.qualifiers.get(qualifier, ()))
+
+    def resolve(self, location):
+        """
+        Return the coordinates of the best place named by `location`, or `None`.
+        In 'Paris,Texas' or 'Tartu,EE' style queries the first part is the
+        place name and every following part a country or first-level division
+        the place has to be in. The highest ranked place that is wins; if
+        none is, `None` leaves the query to Geonames.
+        """
+        if not self.ready:
+            return None
+        parts = [normalize(part) for part in location.split(',')]
+        name = parts[0]
+        qualifiers = [part for part in parts[1:] if part]
+        if not name:
+            return None
+        best = None
+        i = self.lowerBound(name)
+        while i < self.keys:
+            key, place = self.key(i)
+            if key != name:
+                break
+            if all(self.qualifies(place, qualifier) for qualifier in qualifiers) and \
+                    (best is None or self.placeRank(place) > self.placeRank(best)):
+                best = place
+            i += 1
+        if best is None:
+            return None
+        return self.place(best).coordinates()
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """Return up to `limit` places whose name starts with `prefix`, most populous first"""
+        if not self.ready:
+            return []
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        if len(prefix) <= PREFIX_DEPTH:
+            places = self.prefixPostings(prefix)
+        else:
+            seen = set()
+            i = self.lowerBound(prefix)
+            end = min(i + SCAN_LIMIT, self.keys)
+            while i < end:
+                key, place = self.key(i)
+                if not key.startswith(prefix):
+                    break
+                seen.add(place)
+                i += 1
+            places = heapq.nlargest(SUGGEST_LIMIT, seen, key=self.placeRank)
+        return [self.place(i) for i in places[:limit]]
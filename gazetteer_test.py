@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from gazetteer import HEADER, MAGIC, Gazetteer, build, normalize
+
+# GeoNames rows (geonameid, name, asciiname, alternatenames, latitude, longitude, feature class,
+# feature code, country code, cc2, admin1 code, admin2, admin3, admin4, population)
+DUMP = '''\
+588409\tTallinn\tTallinn\tReval,Таллин\t59.43696\t24.75353\tP\tPPLC\tEE\t\t01\t\t\t\t394024
+589580\tPärnu\tParnu\tPernau,Пярну\t58.38588\t24.49711\tP\tPPLA\tEE\t\t11\t\t\t\t52337
+588335\tTartu\tTartu\tDorpat,Тарту\t58.38062\t26.72509\tP\tPPLA\tEE\t\t18\t\t\t\t97005
+2988507\tParis\tParis\tLutetia,Париж\t48.85341\t2.3488\tP\tPPLC\tFR\t\t11\t\t\t\t2138551
+4717560\tParis\tParis\t\t33.66094\t-95.55551\tP\tPPLA2\tUS\t\tTX\t277\t\t\t24171
+2643743\tLondon\tLondon\tLondres,Лондон\t51.50853\t-0.12574\tP\tPPLC\tGB\t\tENG\tGLA\t\t\t8961989
+6058560\tLondon\tLondon\t\t42.98339\t-81.23304\tP\tPPL\tCA\t\t08\t\t\t\t346765
+6251999\tCanada\tCanada\t\t60.10867\t-113.64258\tA\tPCLI\tCA\t\t00\t\t\t\t37058856
+2960313\tLake Ülemiste\tLake Ulemiste\t\t59.40000\t24.80000\tH\tLK\tEE\t\t01\t\t\t\t0
+'''
+
+COUNTRY_INFO = '''\
+#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital
+EE\tEST\t233\tEN\tEstonia\tTallinn
+FR\tFRA\t250\tFR\tFrance\tParis
+GB\tGBR\t826\tUK\tUnited Kingdom\tLondon
+US\tUSA\t840\tUS\tUnited States\tWashington
+'''
+
+ADMIN1_CODES = '''\
+US.TX\tTexas\tTexas\t4736286
+CA.08\tOntario\tOntario\t6093943
+EE.11\tPärnumaa\tParnumaa\t589576
+'''
+
+
+class GazetteerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dump = os.path.join(self.directory, 'cities.txt')
+        for name, text in (('cities.txt', DUMP), ('countryInfo.txt', COUNTRY_INFO),
+                           ('admin1CodesASCII.txt', ADMIN1_CODES)):
+            with open(os.path.join(self.directory, name), 'w', encoding='utf-8') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        gazetteer = Gazetteer()
+        gazetteer.path = self.dump
+        gazetteer.load()
+        return gazetteer
+
+    def test_normalize(self):
+        self.assertEqual(normalize('Pärnu'), 'parnu')
+        self.assertEqual(normalize('  Łódź '), 'lodz')
+        self.assertEqual(normalize('Sankt  Peterburg'), 'sankt peterburg')
+
+    def test_index_format(self):
+        build(self.dump, self.dump + '.idx')
+        with open(self.dump + '.idx', 'rb') as f:
+            magic, places, keys, prefixes, postings, qualifiers = HEADER.unpack(f.read(HEADER.size))
+        self.assertEqual(magic, MAGIC)
+        # The lake is neither a populated place nor an administrative area
+        self.assertEqual(places, 8)
+        # The name and the ASCII name normalize to the same key ('Pärnu', 'Parnu')
+        self.assertEqual(keys, 8)
+        self.assertGreater(prefixes, 0)
+        self.assertGreater(postings, 0)
+        self.assertGreater(qualifiers, 0)
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith('.tmp')])
+
+    def test_old_index_rebuilt(self):
+        with open(self.dump + '.idx', 'wb') as f:
+            f.write(b'GAZ1' + bytes(HEADER.size))
+        os.utime(self.dump, (0, 0))
+        gazetteer = self.load()
+        self.assertTrue(gazetteer.ready)
+        self.assertEqual(gazetteer.resolve('Tallinn'), '59.43696,24.75353')
+
+    def test_resolve(self):
+        gazetteer = self.load()
+        self.assertEqual(gazetteer.resolve('parnu'), '58.38588,24.49711')
+        self.assertEqual(gazetteer.resolve('PÄRNU'), '58.38588,24.49711')
+        # The most populous of the same name
+        self.assertEqual(gazetteer.resolve('Paris'), '48.85341,2.3488')
+        self.assertEqual(gazetteer.resolve('London'), '51.50853,-0.12574')
+        self.assertIsNone(gazetteer.resolve('Reval'))
+        self.assertIsNone(gazetteer.resolve('Nowhere'))
+        self.assertIsNone(gazetteer.resolve(''))
+
+    def test_resolve_qualified(self):
+        gazetteer = self.load()
+        self.assertEqual(gazetteer.resolve('Paris,TX,US'), '33.66094,-95.55551')
+        self.assertEqual(gazetteer.resolve('Paris, Texas'), '33.66094,-95.55551')
+        self.assertEqual(gazetteer.resolve('Paris,United States'), '33.66094,-95.55551')
+        self.assertEqual(gazetteer.resolve('Paris,France'), '48.85341,2.3488')
+        # Canada is a qualifier because the dump has it as a country (PCLI)
+        self.assertEqual(gazetteer.resolve('London,Canada'), '42.98339,-81.23304')
+        self.assertEqual(gazetteer.resolve('London,Ontario'), '42.98339,-81.23304')
+        self.assertEqual(gazetteer.resolve('Parnu,Parnumaa'), '58.38588,24.49711')
+        self.assertIsNone(gazetteer.resolve('Paris,Texas,France'))
+        self.assertIsNone(gazetteer.resolve('Paris,Germany'))
+        self.assertIsNone(gazetteer.resolve('Tallinn,Ontario'))
+
+    def test_alternate_names(self):
+        build(self.dump, self.dump + '.idx', alternateNames=True)
+        gazetteer = self.load()
+        self.assertEqual(gazetteer.resolve('Dorpat'), '58.38062,26.72509')
+        self.assertEqual(gazetteer.resolve('Пярну'), '58.38588,24.49711')
+
+    def test_suggest(self):
+        gazetteer = self.load()
+        # Short prefixes come from the precomputed postings, most populous first
+        self.assertEqual([(place.name, place.country) for place in gazetteer.suggest('pa')],
+                         [('Paris', 'FR'), ('Pärnu', 'EE'), ('Paris', 'US')])
+        self.assertEqual([place.name for place in gazetteer.suggest('pa', 1)], ['Paris'])
+        # Longer ones by scanning the sorted names
+        self.assertEqual([place.country for place in gazetteer.suggest('pari')], ['FR', 'US'])
+        self.assertEqual(gazetteer.suggest('tal')[0].dict(),
+                         {'name': 'Tallinn', 'country': 'EE', 'latitude': 59.43696, 'longitude': 24.75353,
+                          'population': 394024})
+        self.assertEqual(gazetteer.suggest('xyz'), [])
+        self.assertEqual(gazetteer.suggest(''), [])
+
+    def test_not_ready(self):
+        gazetteer = Gazetteer()
+        self.assertFalse(gazetteer.ready)
+        self.assertIsNone(gazetteer.resolve('Tallinn'))
+        self.assertEqual(gazetteer.suggest('ta'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+import time
+
+from cache_backends import MemoryBackend
+
+
+class GeocodingCache:
+    """
+    Persistent location -> coordinates cache backed by SQLite.
+
+    Every row is also kept in `backend` (see cache_backends), in memory unless
+    another one is given, so lookups never query the database. A row with no
+    coordinates records a location the geocoder could not find; those negative
+    results expire after `negative_ttl` seconds so a typo does not stay
+    unresolvable forever.
+
+    :param path: SQLite database file, created if missing
+    :type path: `str`
+    :param ttl: Seconds a found location is kept, `None` to keep it forever
+    :type ttl: `int` or `None`
+    :param negative_ttl: Seconds a not-found location is kept
+    :type negative_ttl: `int`
+    :param backend: Where the rows are looked up from
+    :type backend: `cache_backends.MemoryBackend`, `cache_backends.SQLiteBackend`,
+        `cache_backends.SharedMemoryBackend` or `None`
+    """
+
+    def __init__(self, path, ttl=None, negative_ttl=86400, backend=None):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.open()
+        # Like cache_backends.SQLiteBackend, every worker forked by gunicorn --preload
+        # opens its own connection
+        os.register_at_fork(after_in_child=self.open)
+        self.hits = 0
+        self.misses = 0
+        # A shared backend may already have them from another worker
+        for location, coordinates, stored in self.db.execute('SELECT location, coordinates, stored FROM geocodes'):
+            if self.backend.get(location) is None:
+                self.backend.set(location, coordinates, stored)
+
+    def open(self):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS geocodes '
+                        '(location TEXT PRIMARY KEY, coordinates TEXT, stored REAL)')
+        self.db.commit()
+
+    def expired(self, coordinates, stored, now):
+        if coordinates is None:
+            return now - stored > self.negative_ttl
+        return self.ttl is not None and now - stored > self.ttl
+
+    def get(self, location, resolver):
+        """
+        Return the coordinates for `location`, calling `resolver()` on a miss.
+        `None` means the location is known not to exist.
+        """
+        found, coordinates = self.lookup(location)
+        if found:
+            return coordinates
+
+        coordinates = resolver()
+        self.set(location, coordinates)
+        return coordinates
+
+    def lookup(self, location):
+        """Return `(found, coordinates)` without resolving anything"""
+        found, coordinates = self.find(location)
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, coordinates
+
+    def find(self, location):
+        # Same as lookup, but not counted in the stats
+        row = self.backend.get(location.lower())
+        if row is None or self.expired(row[0], row[1], time.time()):
+            return False, None
+        return True, row[0]
+
+    def contains(self, location):
+        return self.find(location)[0]
+
+    def stats(self):
+        """Number of lookups so far by result"""
+        return {'hit': self.hits, 'miss': self.misses}
+
+    def set(self, location, coordinates):
+        key = location.lower()
+        stored = time.time()
+        with self.lock:
+            self.backend.set(key, coordinates, stored)
+            self.db.execute('INSERT OR REPLACE INTO geocodes (location, coordinates, stored) VALUES (?, ?, ?)',
+                            (key, coordinates, stored))
+            self.db.commit()
+
+    def entries(self):
+        """Every cached `(location, coordinates, stored)`, for a snapshot"""
+        with self.lock:
+            return self.db.execute('SELECT location, coordinates, stored FROM geocodes').fetchall()
+
+    def restore(self, entries):
+        """
+        Store `(location, coordinates, stored)` rows from a snapshot, keeping
+        their original times. Expired rows and rows the cache already has a
+        newer result for are skipped. Returns how many were stored.
+        """
+        now = time.time()
+        rows = [(location, coordinates, stored) for location, coordinates, stored in entries
+                if not self.expired(coordinates, stored, now)]
+        restored = 0
+        with self.lock:
+            for location, coordinates, stored in rows:
+                current = self.backend.get(location)
+                if current is not None and current[1] >= stored:
+                    continue
+                self.backend.set(location, coordinates, stored)
+                self.db.execute('INSERT OR REPLACE INTO geocodes (location, coordinates, stored) VALUES (?, ?, ?)',
+                                (location, coordinates, stored))
+                restored += 1
+            self.db.commit()
+        return restored
+
+    def seed(self, locations, resolve):
+        """Resolve and store every location in `locations` that is not cached yet"""
+        for location in locations:
+            if self.contains(location):
+                continue
+            try:
+                self.set(location, resolve(location))
+            except Exception:
+                continue
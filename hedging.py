@@ -0,0 +1,97 @@
+import asyncio
+import contextvars
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+
+class LatencyWindow:
+    """
+    Latency of the last `size` successful calls to one upstream, and the
+    `quantile` of them after which a call is hedged.
+
+    :param size: Number of latencies kept
+    :type size: `int`
+    :param quantile: Fraction of calls expected to be done by the threshold
+    :type quantile: `float`
+    :param min_samples: Calls needed before there is a threshold
+    :type min_samples: `int`
+    :param floor: Least seconds the threshold is
+    :type floor: `float`
+    """
+
+    # The quantile is recomputed after this many new latencies
+    refresh_every = 16
+
+    def __init__(self, size=256, quantile=0.95, min_samples=20, floor=0.02):
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.floor = floor
+        self.samples = deque(maxlen=size)
+        self.added = 0
+        self.cached = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.added += 1
+            if self.added % self.refresh_every == 0:
+                self.cached = None
+
+    def threshold(self):
+        """Seconds after which a call is slower than `quantile` of the recent ones, `None` until there are enough"""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            if self.cached is None:
+                ordered = sorted(self.samples)
+                self.cached = max(ordered[min(int(self.quantile * len(ordered)), len(ordered) - 1)], self.floor)
+            return self.cached
+
+
+def hedge(executor, function, delay, backup=None):
+    """
+    Run `function()` on `executor`. If it has not returned after `delay`
+    seconds, run `backup()` (by default `function()` again) too and use
+    whichever succeeds first; the other is left to finish on its own. Without
+    a `delay` `function()` just runs on this thread.
+
+    Returns `(result, hedged)`, `hedged` telling if the backup's result was
+    used. If both fail, the first call's exception is raised.
+    """
+    if delay is None:
+        return function(), False
+    first = executor.submit(contextvars.copy_context().run, function)
+    if wait([first], timeout=delay).done:
+        return first.result(), False
+    second = executor.submit(contextvars.copy_context().run, backup or function)
+    pending = {first, second}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result(), future is second
+    # Both failed, the first call's error is the one reported
+    raise first.exception()
+
+
+async def hedgeAsync(function, delay, backup=None):
+    """`hedge` for coroutine functions, on the running event loop"""
+    if delay is None:
+        return await function(), False
+    first = asyncio.ensure_future(function())
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if done:
+        return await first, False
+    second = asyncio.ensure_future((backup or function)())
+    pending = {first, second}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                # The loser's error, if it fails, is of no interest
+                for other in pending:
+                    other.add_done_callback(lambda task: task.cancelled() or task.exception())
+                return task.result(), task is second
+    raise first.exception()
@@ -0,0 +1,127 @@
+import asyncio
+import gc
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from hedging import LatencyWindow, hedge, hedgeAsync
+
+
+class LatencyWindowTest(unittest.TestCase):
+    def test_threshold(self):
+        window = LatencyWindow(size=100, quantile=0.9, min_samples=10, floor=0.02)
+        for i in range(9):
+            window.observe(0.1)
+        self.assertIsNone(window.threshold())
+        for i in range(91):
+            window.observe(0.1 if i < 80 else 1.0)
+        # 90 of the 100 latencies are 0.1, the 91st is where the slow ones start
+        self.assertEqual(window.threshold(), 1.0)
+
+    def test_floor(self):
+        window = LatencyWindow(min_samples=1, floor=0.05)
+        window.observe(0.001)
+        self.assertEqual(window.threshold(), 0.05)
+
+    def test_only_the_last(self):
+        window = LatencyWindow(size=16, quantile=0.5, min_samples=1, floor=0)
+        for i in range(16):
+            window.observe(5.0)
+        for i in range(16):
+            window.observe(0.5)
+        self.assertEqual(window.threshold(), 0.5)
+
+
+class HedgeTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.executor.shutdown)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def call(self, *durations):
+        """Function whose n-th call sleeps durations[n] seconds, then returns n (or raises it, if negative)"""
+        def function():
+            with self.lock:
+                n = self.calls
+                self.calls += 1
+            time.sleep(abs(durations[n]))
+            if durations[n] < 0:
+                raise ValueError(n)
+            return n
+        return function
+
+    def test_no_delay(self):
+        self.assertEqual(hedge(self.executor, self.call(0), None), (0, False))
+
+    def test_fast_enough(self):
+        self.assertEqual(hedge(self.executor, self.call(0.01), 0.5), (0, False))
+        self.assertEqual(self.calls, 1)
+
+    def test_backup_wins(self):
+        start = time.monotonic()
+        self.assertEqual(hedge(self.executor, self.call(0.3, 0.01), 0.05), (1, True))
+        self.assertLess(time.monotonic() - start, 0.2)
+
+    def test_first_still_wins(self):
+        self.assertEqual(hedge(self.executor, self.call(0.1, 0.3), 0.05), (0, False))
+
+    def test_failed_backup_ignored(self):
+        self.assertEqual(hedge(self.executor, self.call(0.2, -0.01), 0.05), (0, False))
+
+    def test_both_fail(self):
+        with self.assertRaises(ValueError) as raised:
+            hedge(self.executor, self.call(-0.2, -0.1), 0.05)
+        self.assertEqual(raised.exception.args, (0,))
+
+    def test_backup_function(self):
+        self.assertEqual(hedge(self.executor, self.call(0.3), 0.05, backup=lambda: 'backup'), ('backup', True))
+
+
+class HedgeAsyncTest(unittest.TestCase):
+    def run_hedge(self, delays, delay, errors=()):
+        """Run hedgeAsync over calls that sleep `delays[n]`; the n in `errors` raise ValueError(n)"""
+        calls = []
+
+        async def function():
+            n = len(calls)
+            calls.append(n)
+            await asyncio.sleep(delays[n])
+            if n in errors:
+                raise ValueError(n)
+            return n
+
+        unhandled = []
+
+        async def main():
+            asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+            result = await hedgeAsync(function, delay)
+            # Let the loser finish
+            await asyncio.sleep(max(delays) + 0.05)
+            return result
+
+        result = asyncio.run(main())
+        gc.collect()
+        return result, calls, unhandled
+
+    def test_no_delay(self):
+        self.assertEqual(self.run_hedge([0], None)[:2], ((0, False), [0]))
+
+    def test_backup_wins(self):
+        self.assertEqual(self.run_hedge([0.3, 0.01], 0.05)[:2], ((1, True), [0, 1]))
+
+    def test_loser_error_retrieved(self):
+        # The first call fails after the backup won; its error is not reported as never retrieved
+        result, calls, unhandled = self.run_hedge([0.2, 0.01], 0.05, errors=(0,))
+        self.assertEqual(result, (1, True))
+        self.assertEqual(unhandled, [])
+
+    def test_both_fail(self):
+        with self.assertRaises(ValueError) as raised:
+            self.run_hedge([0.1, 0.2], 0.05, errors=(0, 1))
+        self.assertEqual(raised.exception.args, (0,))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+import gzip
+import http.client
+import io
+import queue
+import threading
+import zlib
+from urllib import error
+from urllib.parse import urljoin, urlsplit
+
+import deadline
+
+
+class Response:
+    """Fully read upstream response, compatible with what `urllib.request.urlopen` returns"""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.code = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class HostPool:
+    """Idle keep-alive connections to one host, and a limit on how many may be open at once"""
+
+    def __init__(self, scheme, host, port, size, connect_timeout):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.connect_timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+
+    def get(self):
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self.connect(), False
+
+    def put(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+
+class UpstreamClient:
+    """
+    Shared HTTP client for the upstream APIs.
+
+    Connections are kept alive and reused per host, responses are requested
+    gzip/deflate compressed and decoded transparently. `urlopen` behaves like
+    `urllib.request.urlopen`: it follows redirects and raises
+    `urllib.error.HTTPError` for error statuses.
+
+    :param connect_timeout: Seconds to wait for a connection to be established
+    :type connect_timeout: `float`
+    :param read_timeout: Seconds to wait for response data
+    :type read_timeout: `float`
+    :param pool_size: Maximum number of open connections per host
+    :type pool_size: `int`
+    """
+
+    user_agent = 'pm-weather-api'
+    max_redirects = 5
+
+    def __init__(self, connect_timeout=3, read_timeout=10, pool_size=16):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = HostPool(scheme, host, port, self.pool_size, self.connect_timeout)
+                self.pools[key] = pool
+        return pool
+
+    def urlopen(self, url, timeout=None, headers=None):
+        """
+        Fetch `url` and return a `Response`. `url` may also be a `urllib.request.Request`,
+        which is how geopy calls it.
+        """
+        if hasattr(url, 'full_url'):
+            request_headers = dict(url.header_items())
+            url = url.full_url
+        else:
+            request_headers = {}
+        if headers:
+            request_headers.update(headers)
+
+        for redirect in range(self.max_redirects + 1):
+            response = self.request(url, request_headers, timeout)
+            location = response.headers.get('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin(url, location)
+                continue
+            break
+
+        if response.status >= 400:
+            raise error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(response.body))
+        return response
+
+    def request(self, url, headers, timeout=None):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        pool = self.pool(parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        request_headers = {'Accept-Encoding': 'gzip, deflate',
+                           'User-Agent': self.user_agent,
+                           'Connection': 'keep-alive'}
+        request_headers.update(headers)
+
+        # Waiting for a free connection counts against the request deadline too
+        if not pool.slots.acquire(timeout=deadline.remaining()):
+            raise deadline.DeadlineExceeded()
+        try:
+            connection, reused = pool.get()
+            try:
+                response = self.send(connection, path, request_headers, timeout)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection, retry once on a fresh one
+                connection = pool.connect()
+                response = self.send(connection, path, request_headers, timeout)
+            except Exception:
+                connection.close()
+                raise
+
+            try:
+                body = self.decode(response.read(), response.headers.get('Content-Encoding'))
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                pool.put(connection)
+        finally:
+            pool.slots.release()
+
+        return Response(url, response.status, response.reason, response.msg, body)
+
+    def send(self, connection, path, headers, timeout):
+        if connection.sock is None:
+            # A timeout shorter than the connect timeout (a request deadline) bounds the connect too
+            if timeout:
+                connection.timeout = min(self.connect_timeout, timeout)
+            connection.connect()
+        connection.sock.settimeout(timeout or self.read_timeout)
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+    def decode(self, body, encoding):
+        if encoding == 'gzip':
+            return gzip.decompress(body)
+        if encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)
+        return body
+
+    def close(self):
+        with self.lock:
+            pools = list(self.pools.values())
+            self.pools = {}
+        for pool in pools:
+            while True:
+                try:
+                    pool.idle.get_nowait().close()
+                except queue.Empty:
+                    break
+
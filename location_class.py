@@ -1,75 +1,28 @@
+from collections import OrderedDict
+from forecast_columns import Columns
+
+
 def iround(x):
     y = round(x) - .5
     return int(y) + (y > 0)
 
 
 class DarkSky:
+    views = ('full', 'current', 'forecast', 'basic')
+    currently_fields = ('apparentTemperature', 'cloudCover', 'dewPoint', 'humidity', 'icon', 'ozone',
+                        'precipIntensity', 'precipProbability', 'precipType', 'pressure', 'summary',
+                        'temperature', 'time', 'visibility', 'windBearing', 'windSpeed')
+
     def __init__(self, location):
         self.data = location
-        try:
-            self.apparentTemperature = self.data['currently']['apparentTemperature']
-        except KeyError:
-            self.apparentTemperature = None
-        try:
-            self.cloudCover = self.data['currently']['cloudCover']
-        except KeyError:
-            self.cloudCover = None
-        try:
-            self.dewPoint = self.data['currently']['dewPoint']
-        except KeyError:
-            self.dewPoint = None
-        try:
-            self.humidity = self.data['currently']['humidity']
-        except KeyError:
-            self.humidity = None
-        try:
-            self.icon = self.data['currently']['icon']
-        except KeyError:
-            self.icon = None
-        try:
-            self.ozone = self.data['currently']['ozone']
-        except KeyError:
-            self.ozone = None
-        try:
-            self.precipIntensity = self.data['currently']['precipIntensity']
-        except KeyError:
-            self.precipIntensity = None
-        try:
-            self.precipProbability = self.data['currently']['precipProbability']
-        except KeyError:
-            self.precipProbability = None
-        try:
-            self.precipType = self.data['currently']['precipType']
-        except KeyError:
-            self.precipType = None
-        try:
-            self.pressure = self.data['currently']['pressure']
-        except KeyError:
-            self.pressure = None
-        try:
-            self.summary = self.data['currently']['summary']
-        except KeyError:
-            self.summary = None
-        try:
-            self.temperature = self.data['currently']['temperature']
-        except KeyError:
-            self.temperature = None
-        try:
-            self.time = self.data['currently']['time']
-        except KeyError:
-            self.time = None
-        try:
-            self.visibility = self.data['currently']['visibility']
-        except KeyError:
-            self.visibility = None
-        try:
-            self.windBearing = self.data['currently']['windBearing']
-        except KeyError:
-            self.windBearing = None
-        try:
-            self.windSpeed = self.data['currently']['windSpeed']
-        except KeyError:
-            self.windSpeed = None
+        self.version = ''
+        self.rendered = OrderedDict()
+        self.columnar = None
+        # Set on a copy served from the cache because DarkSky could not be reached
+        self.stale = False
+        currently = self.data.get('currently', {})
+        for field in self.currently_fields:
+            setattr(self, field, currently.get(field))
 
     def basicforecast(self):
         forecast = {}
@@ -97,3 +50,21 @@ class DarkSky:
                                         'summary': self.data['daily']['data'][2]['summary']}
 
         return forecast
+
+    # Returns the daily arrays as NumPy columns, built on first use
+    def columns(self):
+        if self.columnar is None:
+            self.columnar = Columns(self.data)
+        return self.columnar
+
+    # Returns a new dict with the part of the document served by the view
+    def view(self, view):
+        if view == 'full':
+            return dict(self.data)
+        elif view == 'current':
+            return dict(self.data['currently'])
+        elif view == 'forecast':
+            return dict(self.data['daily'])
+        elif view == 'basic':
+            return self.basicforecast()
+        raise KeyError(view)
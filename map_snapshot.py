@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class MapState:
+    """What a map snapshot held at one moment, see `MapSnapshot.read`"""
+
+    __slots__ = ['version', 'forecasts', 'changed', 'bodies']
+
+    def __init__(self, version, forecasts, changed, bodies):
+        self.version = version
+        self.forecasts = forecasts
+        self.changed = changed
+        self.bodies = bodies
+
+
+class MapSnapshot:
+    """
+    The forecasts of the cities of one map (an area in one language), and a
+    version that changes whenever one of them does.
+
+    Cities are taken in one at a time, as their forecasts are refreshed, so a
+    poll only has to look up the cities that are due (see `due`). The city
+    versions of the last `history` map versions are remembered, to tell which
+    cities changed since any of them.
+
+    Serialized bodies of the current version can be kept in `bodies` of what
+    `read` returns; a new version starts with none.
+
+    :param locations: The cities of the map, in map order
+    :type locations: `list`
+    :param versionOf: Returns the map version of the forecasts in map order
+    :type versionOf: `callable`
+    :param history: Number of past versions remembered
+    :type history: `int`
+    :param recheck: Seconds after which a city is looked up again, even if no refresh was seen
+    :type recheck: `float`
+    """
+
+    def __init__(self, locations, versionOf, history=64, recheck=60):
+        self.locations = list(locations)
+        self.versionOf = versionOf
+        self.history = history
+        self.recheck = recheck
+        self.forecasts = {}
+        self.checked = {}
+        self.version = None
+        # Map version -> {location: city version}, oldest first
+        self.past = OrderedDict()
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def update(self, location, darkSky):
+        """Take in the current forecast of a city. Returns whether the map version changed."""
+        with self.lock:
+            previous = self.forecasts.get(location)
+            self.forecasts[location] = darkSky
+            self.checked[location] = time.monotonic()
+            if previous is not None and previous.version == darkSky.version:
+                return False
+            if len(self.forecasts) < len(self.locations):
+                return False
+            self.version = self.versionOf([self.forecasts[location] for location in self.locations])
+            self.past[self.version] = dict((location, forecast.version)
+                                           for location, forecast in self.forecasts.items())
+            self.past.move_to_end(self.version)
+            while len(self.past) > self.history:
+                self.past.popitem(last=False)
+            self.bodies = OrderedDict()
+            return True
+
+    def due(self):
+        """The cities to look up: not taken in yet, stale fallbacks, or not checked for `recheck` seconds"""
+        now = time.monotonic()
+        with self.lock:
+            return [location for location in self.locations
+                    if location not in self.forecasts or
+                    getattr(self.forecasts[location], 'stale', False) or
+                    now - self.checked[location] >= self.recheck]
+
+    def read(self, since=None):
+        """
+        The current `MapState`: the version, the forecasts in map order, and
+        the cities that changed since the version `since`. `changed` is
+        `None` if `since` is not given or not remembered, so only the full
+        map will do.
+        """
+        with self.lock:
+            forecasts = [self.forecasts.get(location) for location in self.locations]
+            changed = None
+            old = self.past.get(since) if since is not None and self.version is not None else None
+            if old is not None:
+                changed = [location for location in self.locations
+                           if self.forecasts[location].version != old.get(location)]
+            return MapState(self.version, forecasts, changed, self.bodies)
@@ -0,0 +1,178 @@
+import atexit
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def labelKey(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def formatNumber(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """
+    In-process counters and histograms, rendered in the Prometheus text format.
+
+    Without `path` a scrape only sees the process that answers it. With `path`
+    every process writes its values to `<path>/<pid>.json` every `interval`
+    seconds and `render()` adds up the files of all of them, so any gunicorn
+    worker answers for the whole server. Files of exited workers are kept so
+    counters never go backwards; empty the directory before the server starts.
+
+    :param path: Directory shared by the worker processes, or `None`
+    :type path: `str` or `None`
+    :param interval: Seconds between writes of this process' values
+    :type interval: `float`
+    """
+
+    def __init__(self, path=None, interval=5):
+        self.path = path
+        self.interval = interval
+        self.kinds = {}
+        self.values = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            atexit.register(self.flush)
+            # With gunicorn --preload the workers are forked after import, each needs its own writer
+            os.register_at_fork(after_in_child=self.forked)
+            self.start()
+
+    def counter(self, name, help):
+        self.kinds[name] = ('counter', help, ())
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        self.kinds[name] = ('histogram', help, tuple(buckets))
+
+    def collector(self, function):
+        """Add `function()`, which returns `(name, labels, value)` counters read at collection time"""
+        self.collectors.append(function)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, labelKey(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record `value` in histogram `name`. The counts are kept per bucket, then the sum."""
+        buckets = self.kinds[name][2]
+        key = (name, labelKey(labels))
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(buckets) + 2)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """This process' values, the collectors included"""
+        with self.lock:
+            values = dict((key, list(value) if isinstance(value, list) else value)
+                          for key, value in self.values.items())
+        for function in self.collectors:
+            for name, labels, value in function():
+                key = (name, labelKey(labels))
+                values[key] = values.get(key, 0) + value
+        return values
+
+    def flush(self):
+        target = os.path.join(self.path, '%d.json' % os.getpid())
+        temporary = target + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump([[name, labels, value] for (name, labels), value in self.snapshot().items()], f)
+        os.replace(temporary, target)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                continue
+
+    def start(self):
+        threading.Thread(target=self.run, name='metrics', daemon=True).start()
+
+    def forked(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.start()
+
+    def collect(self):
+        """The values of every process added up"""
+        if self.path is None:
+            return self.snapshot()
+        self.flush()
+        total = {}
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                current = total.get(key)
+                if current is None:
+                    total[key] = value
+                elif isinstance(value, list):
+                    total[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    total[key] = current + value
+        return total
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        values = self.collect()
+        lines = []
+        for name in sorted(self.kinds):
+            kind, help, buckets = self.kinds[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for (metric, labels), value in sorted(values.items(), key=lambda item: item[0]):
+                if metric != name:
+                    continue
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (name, formatLabels(labels), formatNumber(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (math.inf,), value):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, formatLabels(labels + (('le', formatNumber(bound)),)),
+                                                     cumulative))
+                lines.append('%s_sum%s %s' % (name, formatLabels(labels), formatNumber(value[-1])))
+                lines.append('%s_count%s %d' % (name, formatLabels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,76 @@
+import heapq
+import random
+import threading
+import time
+from collections import deque
+
+
+class PrewarmScheduler(threading.Thread):
+    """
+    Background thread that keeps a fixed set of cache keys warm.
+
+    Every key is refreshed `lead` seconds before its cache entry would expire.
+    The first round is spread evenly over `spread` seconds and every following
+    refresh gets a little random jitter, so the keys do not all come due at the
+    same moment. No more than `budget` refreshes are started per minute; when
+    the budget runs out the remaining keys simply wait their turn.
+
+    :param keys: Keys to keep warm, passed to `refresh` one at a time
+    :type keys: `list`
+    :param refresh: Function that fetches and caches a single key
+    :type refresh: `callable`
+    :param ttl: Cache TTL of the refreshed entries in seconds
+    :type ttl: `int`
+    :param lead: Seconds before expiry a key is refreshed
+    :type lead: `int`
+    :param budget: Maximum number of refreshes per minute
+    :type budget: `int`
+    :param spread: Seconds the first round of refreshes is spread over
+    :type spread: `int` or `None`
+    """
+
+    def __init__(self, keys, refresh, ttl=900, lead=60, budget=60, spread=None):
+        super(PrewarmScheduler, self).__init__(name='prewarm', daemon=True)
+        self.refresh = refresh
+        self.interval = max(ttl - lead, 1)
+        self.budget = budget
+        self.started = deque()
+        self.stopping = threading.Event()
+
+        if spread is None:
+            spread = min(self.interval, len(keys) * 60.0 / max(budget, 1))
+        now = time.time()
+        step = spread / max(len(keys), 1)
+        self.queue = [(now + i * step, i, key) for i, key in enumerate(keys)]
+        heapq.heapify(self.queue)
+
+    def run(self):
+        if not self.queue:
+            return
+        while not self.stopping.is_set():
+            due, i, key = self.queue[0]
+            wait = max(due - time.time(), self.throttle())
+            if wait > 0:
+                self.stopping.wait(wait)
+                continue
+
+            heapq.heappop(self.queue)
+            self.started.append(time.time())
+            try:
+                self.refresh(key)
+            except Exception:
+                pass
+            jitter = random.uniform(0, self.interval * 0.05)
+            heapq.heappush(self.queue, (time.time() + self.interval - jitter, i, key))
+
+    def throttle(self):
+        """Seconds to wait before the budget allows another refresh"""
+        now = time.time()
+        while self.started and now - self.started[0] >= 60:
+            self.started.popleft()
+        if len(self.started) < self.budget:
+            return 0
+        return 60 - (now - self.started[0])
+
+    def stop(self):
+        self.stopping.set()
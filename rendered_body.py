@@ -0,0 +1,96 @@
+import gzip
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Bodies smaller than this are always sent uncompressed
+MIN_COMPRESS_SIZE = 512
+
+# Body formats by name, with their content type. MessagePack only if the package is installed.
+FORMATS = {'json': 'application/json; charset=utf-8',
+           'msgpack': 'application/msgpack'}
+
+
+def qualities(header):
+    """`{value: quality}` of an `Accept` or `Accept-Encoding` style header, values lowercased"""
+    accepted = {}
+    for part in header.split(','):
+        params = part.strip().split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[params[0].strip().lower()] = quality
+    return accepted
+
+
+def negotiate(accept_encoding):
+    """Pick the content encoding to send for an `Accept-Encoding` header, `None` for identity"""
+    if not accept_encoding:
+        return None
+    accepted = qualities(accept_encoding)
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def negotiateFormat(accept):
+    """Pick the body format for an `Accept` header: 'msgpack' if the client prefers it and it is available"""
+    if msgpack is None or not accept:
+        return 'json'
+    accepted = qualities(accept)
+    packed = max(accepted.get('application/msgpack', 0), accepted.get('application/x-msgpack', 0))
+    if packed > 0 and packed >= accepted.get('application/json', 0):
+        return 'msgpack'
+    return 'json'
+
+
+class RenderedBody:
+    """
+    Serialized response body with its ETag and lazily computed compressed variants.
+
+    Every variant is compressed at most once, so a cached body can be served to
+    any number of clients without touching the CPU again.
+
+    :param body: The uncompressed body
+    :type body: `bytes`
+    :param etag: Strong ETag of the uncompressed body, without quotes
+    :type etag: `str`
+    """
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+        self.variants = {}
+        self.lock = threading.Lock()
+
+    def encoded(self, encoding):
+        """Return `(body, encoding, etag)` for the requested encoding"""
+        if encoding is None or len(self.body) < MIN_COMPRESS_SIZE:
+            return self.body, None, self.etag
+        variant = self.variants.get(encoding)
+        if variant is None:
+            with self.lock:
+                variant = self.variants.get(encoding)
+                if variant is None:
+                    if encoding == 'br':
+                        variant = brotli.compress(self.body)
+                    else:
+                        variant = gzip.compress(self.body, compresslevel=6)
+                    self.variants[encoding] = variant
+        return variant, encoding, self.etag + '-' + encoding
@@ -0,0 +1,142 @@
+import io
+import math
+import os
+import threading
+from array import array
+
+EARTH_RADIUS = 6371.0
+
+
+def toVector(lat, lng):
+    lat = math.radians(lat)
+    lng = math.radians(lng)
+    return math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)
+
+
+class Place:
+    """Result of a reverse lookup, with the same `address` attribute geopy locations have"""
+    __slots__ = ['address', 'name', 'country', 'latitude', 'longitude', 'distance']
+
+    def __init__(self, name, country, latitude, longitude, distance):
+        self.name = name
+        self.country = country
+        self.address = name + ', ' + country if country else name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.distance = distance
+
+
+class ReverseGeocoder:
+    """
+    Offline nearest-place lookup over a GeoNames dump (e.g. cities1000.txt).
+
+    Places are stored as unit vectors in flat arrays and indexed with an
+    implicit KD-tree: `order` is sorted so that every range has its median as
+    the splitting node, which needs no per-node objects at all. Loading runs
+    on a background thread, `ready` tells whether lookups can be answered yet.
+
+    :param path: GeoNames dump file, tab separated in the geoname table layout
+    :type path: `str` or `None`
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.names = []
+        self.countries = []
+        self.latlng = array('d')
+        self.vectors = array('d')
+        self.order = array('i')
+        self.ready = False
+        if path is not None:
+            self.start()
+            # A worker forked by gunicorn --preload has no loading thread, it loads
+            # again unless loading was done before the fork
+            os.register_at_fork(after_in_child=self.forked)
+
+    def start(self):
+        threading.Thread(target=self.load, args=(self.path,), name='reverse-geocoder', daemon=True).start()
+
+    def forked(self):
+        if not self.ready:
+            self.start()
+
+    def load(self, path):
+        names = []
+        countries = []
+        latlng = array('d')
+        vectors = array('d')
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 9:
+                    continue
+                try:
+                    lat = float(fields[4])
+                    lng = float(fields[5])
+                except ValueError:
+                    continue
+                names.append(fields[1])
+                countries.append(fields[8])
+                latlng.extend((lat, lng))
+                vectors.extend(toVector(lat, lng))
+
+        self.names = names
+        self.countries = countries
+        self.latlng = latlng
+        self.vectors = vectors
+        order = list(range(len(names)))
+        self.build(order, 0, len(order), 0)
+        self.order = array('i', order)
+        self.ready = True
+
+    def build(self, order, lo, hi, depth):
+        if hi - lo <= 1:
+            return
+        vectors = self.vectors
+        axis = depth % 3
+        part = order[lo:hi]
+        part.sort(key=lambda i: vectors[3 * i + axis])
+        order[lo:hi] = part
+        mid = (lo + hi) // 2
+        self.build(order, lo, mid, depth + 1)
+        self.build(order, mid + 1, hi, depth + 1)
+
+    def nearest(self, lat, lng):
+        """Return the `Place` closest to the coordinates, or `None` if nothing is loaded"""
+        if not self.ready or not self.names:
+            return None
+        point = toVector(lat, lng)
+        best = [float('inf'), -1]
+        self.search(point, 0, len(self.order), 0, best)
+        i = best[1]
+        chord = math.sqrt(best[0])
+        distance = 2 * EARTH_RADIUS * math.asin(min(chord / 2, 1.0))
+        return Place(self.names[i], self.countries[i], self.latlng[2 * i], self.latlng[2 * i + 1], distance)
+
+    def search(self, point, lo, hi, depth, best):
+        if lo >= hi:
+            return
+        mid = (lo + hi) // 2
+        i = self.order[mid]
+        vectors = self.vectors
+        dx = point[0] - vectors[3 * i]
+        dy = point[1] - vectors[3 * i + 1]
+        dz = point[2] - vectors[3 * i + 2]
+        d2 = dx * dx + dy * dy + dz * dz
+        if d2 < best[0]:
+            best[0] = d2
+            best[1] = i
+
+        axis = depth % 3
+        diff = point[axis] - vectors[3 * i + axis]
+        if diff < 0:
+            self.search(point, lo, mid, depth + 1, best)
+            if diff * diff < best[0]:
+                self.search(point, mid + 1, hi, depth + 1, best)
+        else:
+            self.search(point, mid + 1, hi, depth + 1, best)
+            if diff * diff < best[0]:
+                self.search(point, lo, mid, depth + 1, best)
+
+    def __len__(self):
+        return len(self.names)
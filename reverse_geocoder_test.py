@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from reverse_geocoder import ReverseGeocoder
+from spatial_index import distance
+
+# cities1000.txt rows, only the columns the reverse geocoder reads filled in
+CITIES = [
+    ('Tallinn', 59.43696, 24.75353, 'EE'),
+    ('Tartu', 58.38062, 26.72509, 'EE'),
+    ('Pärnu', 58.38588, 24.49711, 'EE'),
+    ('Narva', 59.37722, 28.19028, 'EE'),
+    ('Helsinki', 60.16952, 24.93545, 'FI'),
+    ('Riga', 56.946, 24.10589, 'LV'),
+    ('Stockholm', 59.32938, 18.06871, 'SE'),
+    ('Saint Petersburg', 59.93863, 30.31413, 'RU'),
+    ('Reykjavik', 64.13548, -21.89541, 'IS'),
+    ('Longyearbyen', 78.22334, 15.64689, 'SJ'),
+    ('Suva', -18.14161, 178.44149, 'FJ'),
+    ('Apia', -13.83333, -171.76666, 'WS'),
+    ('Quito', -0.22985, -78.52495, 'EC'),
+    ('Singapore', 1.28967, 103.85007, 'SG'),
+    ('Ushuaia', -54.8, -68.3, 'AR'),
+    ('McMurdo Station', -77.846, 166.676, 'AQ'),
+]
+
+
+class ReverseGeocoderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cities1000.txt')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            for i, (name, lat, lng, country) in enumerate(CITIES):
+                f.write('\t'.join([str(i), name, name, '', repr(lat), repr(lng), 'P', 'PPL', country] +
+                                  [''] * 10) + '\n')
+            # Rows that cannot be read are skipped
+            f.write('broken\trow\n')
+            f.write('99\tNowhere\tNowhere\t\tnorth\teast\tP\tPPL\tXX\n')
+        self.geocoder = ReverseGeocoder()
+        self.geocoder.load(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_loaded(self):
+        self.assertTrue(self.geocoder.ready)
+        self.assertEqual(len(self.geocoder), len(CITIES))
+
+    def test_nearest(self):
+        place = self.geocoder.nearest(59.437, 24.7454)
+        self.assertEqual((place.name, place.country, place.address), ('Tallinn', 'EE', 'Tallinn, EE'))
+        self.assertLess(place.distance, 1)
+        place = self.geocoder.nearest(58.37, 26.70)
+        self.assertEqual(place.name, 'Tartu')
+        self.assertAlmostEqual(place.distance, distance(58.37, 26.70, 58.38062, 26.72509), places=3)
+
+    def test_across_the_antimeridian(self):
+        # 1.6 degrees east of Suva by way of 180, Apia is 8 degrees away
+        self.assertEqual(self.geocoder.nearest(-18.0, -179.9).name, 'Suva')
+
+    def test_near_the_poles(self):
+        self.assertEqual(self.geocoder.nearest(89.9, -120.0).name, 'Longyearbyen')
+        self.assertEqual(self.geocoder.nearest(-90.0, 0.0).name, 'McMurdo Station')
+
+    def test_same_as_every_distance(self):
+        for lat in range(-80, 90, 10):
+            for lng in range(-180, 180, 15):
+                expected = min(CITIES, key=lambda city: distance(lat, lng, city[1], city[2]))
+                place = self.geocoder.nearest(lat, lng)
+                self.assertEqual(place.name, expected[0], (lat, lng))
+                self.assertAlmostEqual(place.distance, distance(lat, lng, expected[1], expected[2]), places=3)
+
+    def test_not_loaded(self):
+        self.assertIsNone(ReverseGeocoder().nearest(59.437, 24.7454))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import threading
+
+
+class Call:
+    __slots__ = ['done', 'result', 'error']
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single call.
+
+    The first caller for a key runs the function, every caller arriving while it
+    is in flight waits for it and gets the same result (or the same exception).
+    Nothing is remembered once the call finishes, caching is left to the caller.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, timeout=None):
+        """
+        Run `function()` for `key` unless a call for `key` is already in flight.
+        A caller waiting for another one's call raises TimeoutError after
+        `timeout` seconds, the call itself goes on.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(key)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def inflight(self):
+        return len(self.calls)
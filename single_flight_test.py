@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+
+from single_flight import Call, SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow(self, value):
+        def function():
+            self.calls.append(value)
+            self.release.wait(5)
+            if isinstance(value, Exception):
+                raise value
+            return value
+        return function
+
+    def together(self, count, key, function, timeout=None):
+        """Call `function` for `key` from `count` threads at once. Returns their results or exceptions."""
+        results = [None] * count
+
+        def call(i):
+            try:
+                results[i] = self.flight.do(key, function, timeout)
+            except Exception as e:
+                results[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+        threads[0].start()
+        # The others arrive while the first call is in flight
+        while not self.calls:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_one_call(self):
+        self.assertEqual(self.together(8, 'tallinn', self.slow('59.437,24.745')), ['59.437,24.745'] * 8)
+        self.assertEqual(self.calls, ['59.437,24.745'])
+        self.assertEqual(self.flight.inflight(), 0)
+
+    def test_same_error_for_everyone(self):
+        error = ValueError('not found')
+        results = self.together(4, 'nowhere', self.slow(error))
+        self.assertEqual(results, [error] * 4)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_nothing_remembered(self):
+        self.release.set()
+        self.assertRaises(ValueError, self.flight.do, 'key', self.slow(ValueError('first')))
+        self.assertEqual(self.flight.do('key', self.slow('second')), 'second')
+        self.assertEqual(self.calls[1:], ['second'])
+
+    def test_keys_apart(self):
+        self.release.set()
+        self.assertEqual([self.flight.do(key, self.slow(key)) for key in ('a', 'b')], ['a', 'b'])
+        self.assertEqual(self.calls, ['a', 'b'])
+
+    def test_waiter_timeout(self):
+        # A call already in flight that never finishes
+        self.flight.calls['tallinn'] = leader = Call()
+        self.assertRaises(TimeoutError, self.flight.do, 'tallinn', self.slow('never'), 0.05)
+        # The waiter gave up, the call in flight was not touched
+        self.assertIs(self.flight.calls['tallinn'], leader)
+        self.assertEqual(self.calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import math
+import threading
+from collections import OrderedDict
+
+from reverse_geocoder import EARTH_RADIUS
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Decimals kept of user supplied coordinates, 4 is about 11 m
+COORDINATE_DECIMALS = 4
+
+
+def geohash(lat, lng, precision):
+    """Geohash of `precision` characters of the cell holding the point"""
+    latRange = [-90.0, 90.0]
+    lngRange = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        # Bits alternate between longitude and latitude, longitude first
+        target, span = (lng, lngRange) if even else (lat, latRange)
+        middle = (span[0] + span[1]) / 2
+        value <<= 1
+        if target >= middle:
+            value |= 1
+            span[0] = middle
+        else:
+            span[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def cellSize(precision):
+    """Height and width in degrees of a geohash cell of `precision` characters"""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """Great-circle distance in km"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def checkCoordinates(coordinates):
+    """
+    Parse `lat,lng`, raising ValueError unless both are numbers on the globe.
+    The point is rounded to COORDINATE_DECIMALS.
+    """
+    lat, lng = coordinates.split(',')
+    lat = float(lat)
+    lng = float(lng)
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(coordinates)
+    # + 0.0 turns -0.0 into 0.0
+    return round(lat, COORDINATE_DECIMALS) + 0.0, round(lng, COORDINATE_DECIMALS) + 0.0
+
+
+def formatCoordinates(lat, lng):
+    return '%r,%r' % (lat, lng)
+
+
+class SpatialIndex:
+    """
+    Points bucketed by geohash cell, for finding the nearest one within a
+    radius. A search looks at every cell the square around the radius
+    touches, so any `radius` works, but it is cheapest when the cells are
+    about as large as the radius.
+
+    Points are kept per `group` (e.g. the forecast language) under a `key`;
+    past `maxsize` points the oldest added is dropped.
+
+    :param precision: Geohash length of the cells, 6 is about 1.2 x 0.6 km
+    :type precision: `int`
+    :param maxsize: Maximum number of points, `None` for no limit
+    :type maxsize: `int` or `None`
+    """
+
+    def __init__(self, precision=6, maxsize=None):
+        self.precision = precision
+        self.maxsize = maxsize
+        self.height, self.width = cellSize(precision)
+        # (group, geohash) -> {key: (lat, lng)}
+        self.cells = {}
+        # (group, key) -> geohash, oldest first
+        self.points = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, group, key, lat, lng):
+        cell = geohash(lat, lng, self.precision)
+        with self.lock:
+            self.remove(group, key)
+            self.cells.setdefault((group, cell), {})[key] = (lat, lng)
+            self.points[(group, key)] = cell
+            while self.maxsize is not None and len(self.points) > self.maxsize:
+                (oldGroup, oldKey), _ = next(iter(self.points.items()))
+                self.remove(oldGroup, oldKey)
+
+    def discard(self, group, key):
+        with self.lock:
+            self.remove(group, key)
+
+    def remove(self, group, key):
+        cell = self.points.pop((group, key), None)
+        if cell is None:
+            return
+        points = self.cells[(group, cell)]
+        del points[key]
+        if not points:
+            del self.cells[(group, cell)]
+
+    def span(self, lat, radius):
+        """Half the height and width in degrees of the square around `radius` km"""
+        # Degrees of latitude are always 111 km, of longitude less the further from the equator
+        dlat = radius / 111.2
+        dlng = min(radius / max(111.2 * math.cos(math.radians(lat)), 1e-6), 180.0)
+        return dlat, dlng
+
+    def cellCount(self, lat, dlat, dlng):
+        """Most cells `cellsAround` can visit for the square"""
+        rows = math.ceil((min(lat + dlat, 90.0) - max(lat - dlat, -90.0)) / self.height) + 1
+        return rows * (math.ceil(2 * dlng / self.width) + 1)
+
+    def cellsAround(self, lat, lng, radius):
+        dlat, dlng = self.span(lat, radius)
+        cells = set()
+        y = max(lat - dlat, -90.0)
+        while True:
+            x = lng - dlng
+            while True:
+                cells.add(geohash(min(y, 90.0), (x + 180.0) % 360.0 - 180.0, self.precision))
+                if x >= lng + dlng:
+                    break
+                x = min(x + self.width, lng + dlng)
+            if y >= min(lat + dlat, 90.0):
+                break
+            y = min(y + self.height, lat + dlat, 90.0)
+        return cells
+
+    def nearby(self, group, lat, lng, radius):
+        """`(distance, key, lat, lng)` of the points of `group` within `radius` km, nearest first"""
+        dlat, dlng = self.span(lat, radius)
+        if self.cellCount(lat, dlat, dlng) > len(self.points):
+            # Near the poles the square spans a whole band of cells, fewer than
+            # there are points to look at one by one
+            with self.lock:
+                points = [(key, self.cells[(pointGroup, cell)][key])
+                          for (pointGroup, key), cell in self.points.items() if pointGroup == group]
+        else:
+            cells = self.cellsAround(lat, lng, radius)
+            with self.lock:
+                points = [point for cell in cells for point in self.cells.get((group, cell), {}).items()]
+        found = [(distance(lat, lng, pointLat, pointLng), key, pointLat, pointLng)
+                 for key, (pointLat, pointLng) in points]
+        return sorted(point for point in found if point[0] <= radius)
+
+    def __len__(self):
+        return len(self.points)
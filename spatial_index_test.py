@@ -0,0 +1,93 @@
+import time
+import unittest
+
+from spatial_index import SpatialIndex, cellSize, checkCoordinates, distance, formatCoordinates, geohash
+
+
+class GeohashTest(unittest.TestCase):
+    def test_geohash(self):
+        self.assertEqual(geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(geohash(59.4372, 24.7454, 6), 'ud9d5h')
+        self.assertEqual(geohash(-90.0, -180.0, 4), '0000')
+        self.assertEqual(geohash(90.0, 180.0, 4), 'zzzz')
+
+    def test_cell_size(self):
+        self.assertEqual(cellSize(1), (45.0, 45.0))
+        self.assertEqual(cellSize(6), (180.0 / 2 ** 15, 360.0 / 2 ** 15))
+
+    def test_distance(self):
+        self.assertAlmostEqual(distance(59.43696, 24.75353, 58.38062, 26.72509), 163.1, places=1)
+        self.assertEqual(distance(59.4372, 24.7454, 59.4372, 24.7454), 0.0)
+
+    def test_check_coordinates(self):
+        self.assertEqual(checkCoordinates('59.43720,24.74540'), (59.4372, 24.7454))
+        self.assertEqual(checkCoordinates('59.437249,24.74536'), (59.4372, 24.7454))
+        self.assertEqual(formatCoordinates(*checkCoordinates('-0.00001,-0.00001')), '0.0,0.0')
+        for coordinates in ('91,0', '0,180.5', 'nan,0', '59.4', 'a,b', '1,2,3'):
+            self.assertRaises(ValueError, checkCoordinates, coordinates)
+
+
+class SpatialIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SpatialIndex(precision=6)
+
+    def keys(self, group, lat, lng, radius):
+        return [key for distance, key, pointLat, pointLng in self.index.nearby(group, lat, lng, radius)]
+
+    def test_nearest_first(self):
+        self.index.add('et', '59.4372,24.7454', 59.4372, 24.7454)
+        self.index.add('et', '59.4400,24.7500', 59.44, 24.75)
+        self.index.add('et', '59.4500,24.7600', 59.45, 24.76)
+        self.assertEqual(self.keys('et', 59.4373, 24.7455, 1.0), ['59.4372,24.7454', '59.4400,24.7500'])
+        self.assertEqual(self.keys('et', 59.4373, 24.7455, 2.0),
+                         ['59.4372,24.7454', '59.4400,24.7500', '59.4500,24.7600'])
+
+    def test_neighbouring_cells(self):
+        # Just either side of a cell border, 2 m apart
+        height, width = cellSize(6)
+        lng = -180 + round(204.75 / width) * width
+        self.index.add('et', 'west', 59.4372, lng - 0.00002)
+        self.assertNotEqual(geohash(59.4372, lng - 0.00002, 6), geohash(59.4372, lng + 0.00002, 6))
+        self.assertEqual(self.keys('et', 59.4372, lng + 0.00002, 0.1), ['west'])
+
+    def test_across_the_antimeridian(self):
+        self.index.add('en', 'east', -16.5, 179.9999)
+        self.assertEqual(self.keys('en', -16.5, -179.9999, 1.0), ['east'])
+
+    def test_groups(self):
+        self.index.add('et', 'tallinn', 59.4372, 24.7454)
+        self.index.add('ru', 'tallinn', 59.4372, 24.7454)
+        self.index.discard('ru', 'tallinn')
+        self.assertEqual(self.keys('et', 59.4372, 24.7454, 1.0), ['tallinn'])
+        self.assertEqual(self.keys('ru', 59.4372, 24.7454, 1.0), [])
+        self.assertEqual(self.keys('en', 59.4372, 24.7454, 1.0), [])
+
+    def test_moved(self):
+        self.index.add('et', 'point', 59.4372, 24.7454)
+        self.index.add('et', 'point', 58.3806, 26.7251)
+        self.assertEqual(self.keys('et', 59.4372, 24.7454, 1.0), [])
+        self.assertEqual(self.keys('et', 58.3806, 26.7251, 1.0), ['point'])
+        self.assertEqual(len(self.index), 1)
+
+    def test_maxsize(self):
+        index = SpatialIndex(precision=6, maxsize=2)
+        index.add('et', 'a', 59.0, 24.0)
+        index.add('et', 'b', 59.0, 24.001)
+        index.add('et', 'c', 59.0, 24.002)
+        self.assertEqual(len(index), 2)
+        self.assertEqual([point[1] for point in index.nearby('et', 59.0, 24.0, 1.0)], ['b', 'c'])
+        self.assertEqual(index.cells, dict((key, value) for key, value in index.cells.items() if value))
+
+    def test_near_the_pole(self):
+        self.index.add('et', 'alert', 89.995, 10.0)
+        self.index.add('en', 'alert', 89.995, 10.0)
+        self.index.add('et', 'tallinn', 59.4372, 24.7454)
+        for lat in (89.99, 90.0):
+            start = time.perf_counter()
+            self.assertEqual(self.keys('et', lat, 24.75, 1.0), ['alert'])
+            # Not one lookup per cell of the whole band around the pole
+            self.assertLess(time.perf_counter() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
 import os
+import signal
+import sys
 from tornado.web import Application, FallbackHandler, RequestHandler
 from tornado.wsgi import WSGIContainer
 from tornado.ioloop import IOLoop
 from tornado.log import enable_pretty_logging
-from darksky_api import app
+from darksky_api import app, APP_URL_PREFIX
+from tornado_handlers import routes
 
 
 APP_PORT = 80
@@ -19,12 +22,16 @@ class MainHandler(RequestHandler):
 
 tr = WSGIContainer(app)
 
+# The weather routes are served natively, everything else still goes through Flask
 application = Application([
     (r"/tornado", MainHandler),
+] + routes(APP_URL_PREFIX) + [
     (r".*", FallbackHandler, dict(fallback=tr)),
 ])
 
 if __name__ == "__main__":
+    # Exit normally on SIGTERM, so the cache snapshot is written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     #application.listen(5000, address='127.0.0.1')
     application.listen(int(APP_PORT), address='0.0.0.0')
     IOLoop.instance().start()
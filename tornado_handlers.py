@@ -0,0 +1,487 @@
+import asyncio
+import json
+import time
+from functools import partial
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httputil import responses
+from tornado.web import HTTPError, RequestHandler
+from werkzeug.exceptions import HTTPException
+
+import deadline
+from darksky_api import (app, DarkSky, Geonames, MAP_FANOUT_LIMIT, UPSTREAM_CONNECT_TIMEOUT,
+                         UPSTREAM_POOL_SIZE, UPSTREAM_READ_TIMEOUT, decodeJson, encoding, fetchJson,
+                         forecast_cache, fouroo, fourofour, fiveoo, fiveothree, fiveofour, geocoding_cache,
+                         getDarkSkySUFFIX, getGeoNames, getURL, map_areas, mapVersion, negotiate,
+                         renderMap, renderView, upstream_pool, viewEtag, dumpjson, localReverse,
+                         reverseGeocode, gazetteer, suggestions, SUGGEST_LIMIT, batchResults, batchCoordinates, checkBatch,
+                         streamLine, streamTrailer, buildSummary, summaryQuery, mapSummary, metrics, UPSTREAMS,
+                         upstream_guards, staleForecast, STALE_WARNING, normalizeCoordinates, parseCoordinates,
+                         nearbyForecast, spatial_index, formatCoordinates, gridQuery, gridFormat, gridForecasts,
+                         gridVersion, renderGrid, payloadVariant, fieldsQuery, FORMATS, REQUEST_DEADLINE,
+                         UPSTREAM_HEDGE, upstream_latency, mapSnapshot, takeMapCity, deltaVersion, renderDelta)
+from hedging import hedgeAsync
+from upstream_guard import UpstreamUnavailable, background
+
+#
+# Tornado-native versions of the weather routes. Upstream calls use the non-blocking
+# AsyncHTTPClient, so a slow DarkSky or Geonames response only holds up its own request.
+# The caches and the serialized views are shared with the Flask app, responses are
+# byte-for-byte the same.
+#
+
+try:
+    import pycurl
+    # curl keeps upstream connections alive, simple_httpclient opens a new one per request
+    AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=UPSTREAM_POOL_SIZE)
+except ImportError:
+    AsyncHTTPClient.configure(None, max_clients=UPSTREAM_POOL_SIZE)
+
+
+# Upstream fetches in flight by url, so concurrent requests for the same url share one
+inflight = {}
+
+
+async def fetchUpstream(url, Class):
+    upstream = UPSTREAMS[Class]
+    try:
+        timeout = deadline.timeout(UPSTREAM_CONNECT_TIMEOUT + UPSTREAM_READ_TIMEOUT)
+    except deadline.DeadlineExceeded:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status='deadline')
+        raise HTTPError(504)
+    acquireAsync(upstream)
+    call = partial(fetchOnce, url, upstream, timeout)
+    if upstream not in UPSTREAM_HEDGE:
+        response = await call()
+    else:
+        response, hedged = await hedgeAsync(call, upstream_latency[upstream].threshold(),
+                                            backup=partial(hedgeAsyncCall, upstream, call))
+        if hedged:
+            metrics.inc('weather_upstream_hedges_total', upstream=upstream, result='won')
+    return decodeJson(response.body, Class)
+
+
+def acquireAsync(upstream):
+    try:
+        upstream_guards[upstream].acquire()
+    except UpstreamUnavailable as e:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status=e.reason)
+        raise HTTPError(503)
+
+
+async def hedgeAsyncCall(upstream, call):
+    with background():
+        acquireAsync(upstream)
+    metrics.inc('weather_upstream_hedges_total', upstream=upstream, result='sent')
+    return await call()
+
+
+async def fetchOnce(url, upstream, timeout):
+    guard = upstream_guards[upstream]
+    start = time.perf_counter()
+    try:
+        response = await AsyncHTTPClient().fetch(url,
+                                                 connect_timeout=min(UPSTREAM_CONNECT_TIMEOUT, timeout),
+                                                 request_timeout=timeout,
+                                                 decompress_response=True)
+    except HTTPClientError as e:
+        if e.code == 599:
+            metrics.inc('weather_upstream_errors_total', upstream=upstream, status='timeout')
+            guard.failure()
+            raise HTTPError(504)
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status=e.code)
+        guard.record(e.code)
+        raise HTTPError(e.code)
+    except OSError:
+        metrics.inc('weather_upstream_errors_total', upstream=upstream, status='network')
+        guard.failure()
+        raise HTTPError(504)
+    finally:
+        metrics.observe('weather_upstream_request_duration_seconds', time.perf_counter() - start, upstream=upstream)
+    guard.record(response.code)
+    upstream_latency[upstream].observe(time.perf_counter() - start)
+    return response
+
+
+async def fetchJsonAsync(url, Class):
+    future = inflight.get(url)
+    if future is None:
+        future = asyncio.ensure_future(fetchUpstream(url, Class))
+        inflight[url] = future
+        future.add_done_callback(lambda f: inflight.pop(url, None))
+    # A request waiting for another one's fetch gives up at its own deadline
+    try:
+        return await asyncio.wait_for(asyncio.shield(future), deadline.remaining())
+    except asyncio.TimeoutError:
+        raise HTTPError(504)
+
+
+async def getCoordinatesAsync(location):
+    found, coordinates = geocoding_cache.lookup(location)
+    if not found:
+        coordinates = gazetteer.resolve(location)
+    if not found and coordinates is None:
+        geoName = await fetchJsonAsync(getGeoNames(encoding(location)), Geonames)
+        try:
+            coordinates = geoName.getCoordinates(0)
+        except IndexError:
+            coordinates = None
+        geocoding_cache.set(location, coordinates)
+    if coordinates is None:
+        raise IndexError(location)
+    return coordinates
+
+
+async def getForecastAsync(coordinates, lang):
+    url = getURL(coordinates, lang)
+    key = (coordinates.lower(), lang)
+    # Stale entries are refreshed with the blocking fetch on a background thread
+    darkSky = forecast_cache.peek(key, partial(fetchJson, url, DarkSky))
+    if darkSky is None:
+        try:
+            darkSky = await fetchJsonAsync(url, DarkSky)
+        except HTTPError as e:
+            darkSky = staleForecast(key, e.status_code)
+            if darkSky is None:
+                raise
+            return darkSky
+        forecast_cache.set(key, darkSky)
+    return darkSky
+
+
+async def getNearbyForecastAsync(coordinates, lang):
+    lat, lng = parseCoordinates(coordinates)
+    found = nearbyForecast(lat, lng, lang)
+    if found is not None:
+        return found
+    darkSky = await getForecastAsync(coordinates, lang)
+    spatial_index.add(lang, coordinates, lat, lng)
+    return darkSky, coordinates, 0.0
+
+
+async def reverseAsync(coordinates):
+    place = localReverse(coordinates)
+    if place is not None:
+        return place
+    # geopy has no async API, run it on the shared upstream pool instead of the IOLoop
+    return await asyncio.wrap_future(upstream_pool.submit(reverseGeocode, coordinates))
+
+
+flask_error_handlers = {400: fouroo, 404: fourofour, 500: fiveoo, 503: fiveothree, 504: fiveofour}
+flask_errors = {}
+
+
+# Returns the status and body the Flask app answers an error with
+def flaskError(code):
+    if code not in flask_errors:
+        handler = flask_error_handlers.get(code)
+        if handler is None:
+            body = dumpjson({'error': 'Error %d %s' % (code, responses.get(code, 'Unknown'))})
+            flask_errors[code] = (code, body)
+        else:
+            with app.test_request_context():
+                response = handler(None)
+            flask_errors[code] = (response.status_code, response.get_data())
+    return flask_errors[code]
+
+
+class WeatherHandler(RequestHandler):
+    def initialize(self, route):
+        # The Flask rule of the route, the label of its metrics
+        self.route = route
+
+    def prepare(self):
+        deadline.start(REQUEST_DEADLINE)
+
+    def on_finish(self):
+        deadline.clear()
+        metrics.observe('weather_http_request_duration_seconds', self.request.request_time(),
+                        route=self.route, method=self.request.method, status=self.get_status())
+
+    def set_default_headers(self):
+        self.set_header('Content-Type', 'application/json; charset=utf-8')
+        self.set_header('Cache-Control', 'max-age=900')
+        self.set_header('Access-Control-Allow-Origin', '*')
+
+    def compute_etag(self):
+        # ETags are set from the upstream data version, not from the body
+        return None
+
+    def write_error(self, status_code, **kwargs):
+        status, body = flaskError(status_code)
+        self.set_status(status)
+        self.finish(body)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, (HTTPError, HTTPException, IndexError)):
+            super(WeatherHandler, self).log_exception(typ, value, tb)
+
+    def _handle_request_exception(self, e):
+        # Errors raised by the shared Flask helpers (abort) and by a missing location
+        if isinstance(e, HTTPException):
+            e = HTTPError(e.code)
+        elif isinstance(e, IndexError):
+            e = HTTPError(404)
+        super(WeatherHandler, self)._handle_request_exception(e)
+
+    def notModified(self, etag):
+        header = self.request.headers.get('If-None-Match', '')
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag == '*':
+                return etag
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            tag = tag.strip('"')
+            if tag == etag or tag.startswith(etag + '-'):
+                return tag
+        return None
+
+    def sendNotModified(self, etag):
+        self.set_status(304)
+        self.set_header('ETag', '"%s"' % etag)
+        self.set_header('Vary', 'Accept-Encoding, Accept')
+        self.finish()
+
+    def sendRendered(self, rendered, format='json'):
+        body, encoding, etag = rendered.encoded(negotiate(self.request.headers.get('Accept-Encoding')))
+        self.set_header('ETag', '"%s"' % etag)
+        self.set_header('Vary', 'Accept-Encoding, Accept')
+        if encoding is not None:
+            self.set_header('Content-Encoding', encoding)
+        if format != 'json':
+            self.set_header('Content-Type', FORMATS[format])
+        self.finish(body)
+
+    def variant(self):
+        return payloadVariant(self.get_argument('fields', None), self.get_argument('format', None),
+                              self.request.headers.get('Accept'))
+
+    def markStale(self, forecasts):
+        if any(getattr(darkSky, 'stale', False) for darkSky in forecasts):
+            self.set_header('Warning', STALE_WARNING)
+
+    def markDistance(self, point, distance):
+        self.set_header('X-Forecast-Coordinates', point)
+        self.set_header('X-Forecast-Distance', '%.3f' % distance)
+
+    def sendView(self, darkSky, view, field, label):
+        fields, format = self.variant()
+        self.markStale([darkSky])
+        matched = self.notModified(viewEtag(darkSky, view, field, label, fields, format))
+        if matched is not None:
+            return self.sendNotModified(matched)
+        self.sendRendered(renderView(darkSky, view, field, label, fields, format), format)
+
+
+# /<lang>/<location> and /<lang>/<location>/<endpoint>
+class LocationHandler(WeatherHandler):
+    async def get(self, lang, location, endpoint=None):
+        coordinates = await getCoordinatesAsync(location)
+        darkSky = await getForecastAsync(coordinates, lang)
+        if endpoint is None:
+            self.sendView(darkSky, 'full', 'name', location.title())
+        elif endpoint in ('current', 'forecast', 'basic'):
+            self.sendView(darkSky, endpoint, 'name', location.title())
+        elif endpoint == 'summary':
+            self.markStale([darkSky])
+            self.finish(dumpjson(buildSummary(darkSky, 'name', location.title(), summaryQuery(self.get_argument))))
+        else:
+            # Flask answers 400 for an unknown endpoint and fails with 500 for a language
+            getDarkSkySUFFIX(endpoint)
+            raise HTTPError(500)
+
+
+# /<lang>/coordinates/<coordinates> and /<lang>/coordinates/<coordinates>/<endpoint>
+class CoordinatesHandler(WeatherHandler):
+    async def get(self, lang, coordinates, endpoint=None):
+        coordinates = normalizeCoordinates(coordinates)
+        (darkSky, point, distance), name = await asyncio.gather(getNearbyForecastAsync(coordinates, lang),
+                                                                reverseAsync(coordinates))
+        self.markDistance(point, distance)
+        if endpoint is None:
+            self.sendView(darkSky, 'full', 'address', name.address)
+        elif endpoint in ('current', 'forecast', 'basic'):
+            self.sendView(darkSky, endpoint, 'address', name.address)
+        elif endpoint == 'summary':
+            self.markStale([darkSky])
+            self.finish(dumpjson(buildSummary(darkSky, 'address', name.address, summaryQuery(self.get_argument))))
+        else:
+            locationUNIX, point, distance = await getNearbyForecastAsync(coordinates, endpoint)
+            self.markDistance(point, distance)
+            self.finish(dumpjson({name.address: locationUNIX.data}))
+
+
+# /<lang>/suggest/<prefix>, answered locally so there is nothing to wait for
+class SuggestHandler(WeatherHandler):
+    def get(self, lang, prefix):
+        self.finish(suggestions(lang, prefix, self.get_argument('limit', SUGGEST_LIMIT)))
+
+
+# /<lang>/map/<area>
+class MapHandler(WeatherHandler):
+    async def get(self, lang, area):
+        if area not in map_areas:
+            raise HTTPError(404)
+        fields, format = self.variant()
+        since = self.get_argument('since', None)
+        snapshot = mapSnapshot(area, lang)
+        due = snapshot.due()
+        if due:
+            metrics.observe('weather_fanout_width', len(due), route='map')
+            slots = asyncio.Semaphore(MAP_FANOUT_LIMIT)
+
+            async def fetch(location):
+                async with slots:
+                    coordinates = await getCoordinatesAsync(location)
+                    return (coordinates.lower(), lang), await getForecastAsync(coordinates, lang)
+
+            cities = await asyncio.gather(*[fetch(location) for location in due])
+            for location, (key, darkSky) in zip(due, cities):
+                takeMapCity(area, lang, location, key, darkSky)
+
+        state = snapshot.read(since)
+        self.markStale(state.forecasts)
+        self.set_header('X-Map-Version', state.version)
+        if since is None:
+            matched = self.notModified(mapVersion(state.forecasts, fields, format))
+        else:
+            matched = self.notModified(deltaVersion(state, since, fields, format))
+        if matched is not None:
+            return self.sendNotModified(matched)
+        if since is None:
+            self.sendRendered(renderMap(area, lang, snapshot.locations, state.forecasts, fields, format), format)
+        else:
+            self.sendRendered(renderDelta(snapshot.locations, state, since, fields, format), format)
+
+
+# /<lang>/map/<area>/summary, see darksky_api.map_summary
+class MapSummaryHandler(WeatherHandler):
+    async def get(self, lang, area):
+        query = summaryQuery(self.get_argument)
+        if area not in map_areas:
+            raise HTTPError(404)
+        locations = sorted(map_areas[area])
+        metrics.observe('weather_fanout_width', len(locations), route='map')
+        slots = asyncio.Semaphore(MAP_FANOUT_LIMIT)
+
+        async def fetch(location):
+            async with slots:
+                return await getForecastAsync(await getCoordinatesAsync(location), lang)
+
+        forecasts = await asyncio.gather(*[fetch(location) for location in locations])
+        self.markStale(forecasts)
+        self.finish(dumpjson(mapSummary(locations, forecasts, query)))
+
+
+# /<lang>/map/<area>/stream, see darksky_api.map_stream
+class MapStreamHandler(WeatherHandler):
+    async def get(self, lang, area):
+        if area not in map_areas:
+            raise HTTPError(404)
+        getDarkSkySUFFIX(lang)
+        fields = fieldsQuery(self.get_argument('fields', None))
+        self.set_header('Content-Type', 'application/x-ndjson')
+        metrics.observe('weather_fanout_width', len(map_areas[area]), route='map')
+        slots = asyncio.Semaphore(MAP_FANOUT_LIMIT)
+
+        async def fetch(location):
+            async with slots:
+                try:
+                    return location, await getForecastAsync(await getCoordinatesAsync(location), lang)
+                except Exception as e:
+                    return location, e
+
+        failed = []
+        for task in asyncio.as_completed([fetch(location) for location in map_areas[area]]):
+            location, darkSky = await task
+            if isinstance(darkSky, Exception):
+                failed.append((location, darkSky))
+                continue
+            self.write(streamLine(location, darkSky, fields))
+            await self.flush()
+        self.finish(streamTrailer(failed))
+
+
+# /<lang>/grid/<bbox>/<resolution>, see darksky_api.grid
+class GridHandler(WeatherHandler):
+    async def get(self, lang, bbox, resolution):
+        area, fields = gridQuery(lang, bbox, resolution, self.get_argument('fields', None))
+        format = gridFormat(self.get_argument('format', None), self.request.headers.get('Accept', ''))
+        points = [formatCoordinates(lat, lng) for lat, lng in area.points()]
+        metrics.observe('weather_fanout_width', len(points), route='grid')
+        slots = asyncio.Semaphore(MAP_FANOUT_LIMIT)
+
+        async def fetch(point):
+            async with slots:
+                return await getNearbyForecastAsync(point, lang)
+
+        forecasts = gridForecasts(await asyncio.gather(*[fetch(point) for point in points], return_exceptions=True))
+        self.markStale([darkSky for darkSky in forecasts if darkSky is not None])
+        matched = self.notModified(gridVersion(fields, format, forecasts))
+        if matched is not None:
+            return self.sendNotModified(matched)
+        if format == 'binary':
+            self.set_header('Content-Type', 'application/octet-stream')
+        self.sendRendered(renderGrid(area, fields, format, forecasts))
+
+
+# /<lang>/batch, see darksky_api.batch
+class BatchHandler(WeatherHandler):
+    async def get(self, lang):
+        await self.run(lang,
+                       self.get_arguments('location'),
+                       self.get_arguments('coordinates'),
+                       self.get_argument('view', 'full'))
+
+    async def post(self, lang):
+        try:
+            query = json.loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400)
+        if not isinstance(query, dict):
+            raise HTTPError(400)
+        await self.run(lang, query.get('locations', []), query.get('coordinates', []), query.get('view', 'full'))
+
+    async def run(self, lang, locations, coordinates, view):
+        checkBatch(lang, locations, coordinates, view)
+        slots = asyncio.Semaphore(MAP_FANOUT_LIMIT)
+
+        async def bounded(coroutine):
+            async with slots:
+                return await coroutine
+
+        names = list(dict.fromkeys(location.lower() for location in locations))
+        checked = batchCoordinates(coordinates)
+        metrics.observe('weather_fanout_width', len(names) + len(checked), route='batch')
+        resolved = await asyncio.gather(*[bounded(getCoordinatesAsync(name)) for name in names],
+                                        return_exceptions=True)
+        resolved = dict(zip(names, resolved))
+
+        points = list(dict.fromkeys(value for value in list(resolved.values()) + list(checked.values())
+                                    if isinstance(value, str)))
+        forecasts = await asyncio.gather(*[bounded(getForecastAsync(point, lang)) for point in points],
+                                         return_exceptions=True)
+        forecasts = dict(zip(points, forecasts))
+
+        self.markStale(forecasts.values())
+        self.finish(dumpjson(batchResults(view, locations, coordinates, resolved, forecasts, checked)))
+
+
+def routes(prefix=''):
+    def route(rule):
+        return {'route': prefix + rule}
+
+    return [
+        (prefix + r'/([^/]+)/coordinates/([^/]+)', CoordinatesHandler, route('/<lang>/coordinates/<coordinates>')),
+        (prefix + r'/([^/]+)/coordinates/([^/]+)/([^/]+)', CoordinatesHandler,
+         route('/<lang>/coordinates/<coordinates>/<endpoint>')),
+        (prefix + r'/([^/]+)/map/([^/]+)', MapHandler, route('/<lang>/map/<area>')),
+        (prefix + r'/([^/]+)/map/([^/]+)/stream', MapStreamHandler, route('/<lang>/map/<area>/stream')),
+        (prefix + r'/([^/]+)/map/([^/]+)/summary', MapSummaryHandler, route('/<lang>/map/<area>/summary')),
+        (prefix + r'/([^/]+)/suggest/([^/]+)', SuggestHandler, route('/<lang>/suggest/<prefix>')),
+        (prefix + r'/([^/]+)/batch', BatchHandler, route('/<lang>/batch')),
+        (prefix + r'/([^/]+)/grid/([^/]+)/([^/]+)', GridHandler, route('/<lang>/grid/<bbox>/<resolution>')),
+        (prefix + r'/(?!error/)([^/]+)/([^/]+)', LocationHandler, route('/<lang>/<location>')),
+        (prefix + r'/(?!error/)([^/]+)/([^/]+)/([^/]+)', LocationHandler, route('/<lang>/<location>/<endpoint>')),
+    ]
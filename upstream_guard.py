@@ -0,0 +1,145 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Priority of upstream calls made on this thread, see background()
+local = threading.local()
+
+
+@contextmanager
+def background():
+    """Upstream calls made inside are background work (pre-warming, seeding) and yield to user requests"""
+    previous = getattr(local, 'background', False)
+    local.background = True
+    try:
+        yield
+    finally:
+        local.background = previous
+
+
+def inBackground():
+    """Whether upstream calls made on this thread are background work"""
+    return getattr(local, 'background', False)
+
+
+class UpstreamUnavailable(Exception):
+    """The call was not made, because the budget is spent or the circuit is open"""
+
+    def __init__(self, upstream, reason):
+        super(UpstreamUnavailable, self).__init__('%s: %s' % (upstream, reason))
+        self.upstream = upstream
+        self.reason = reason
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second, holding at most `burst`. A call takes
+    one token, but only if `reserve` tokens would still be left afterwards.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, reserve=0):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1 + reserve:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` failures in a row. While open no calls are made,
+    except one trial call every `reset` seconds; the circuit closes again
+    when a trial succeeds.
+    """
+
+    def __init__(self, failures=5, reset=30):
+        self.failures = failures
+        self.reset = reset
+        self.count = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self.opened is not None
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened < self.reset:
+                return False
+            # Let this one call through as the trial, the next waits for another reset
+            self.opened = now
+            return True
+
+    def success(self):
+        with self.lock:
+            self.count = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.count += 1
+            if self.opened is not None or self.count >= self.failures:
+                self.opened = time.monotonic()
+
+
+class UpstreamGuard:
+    """
+    Call budget and circuit breaker of one upstream API.
+
+    The budget is a token bucket of `budget` calls per minute, `burst` at
+    most at once. Background calls only use it while more than `reserve`
+    (a fraction of the burst) is left, so pre-warming never spends what
+    user requests need. `budget=0` means no budget.
+
+    :param name: Name of the upstream, used in errors
+    :type name: `str`
+    :param budget: Calls per minute
+    :type budget: `float`
+    :param burst: Most calls that can be made at once
+    :type burst: `int`
+    :param reserve: Fraction of the burst kept for user requests
+    :type reserve: `float`
+    :param failures: Failures in a row that open the circuit
+    :type failures: `int`
+    :param reset: Seconds the circuit stays open before a trial call
+    :type reset: `float`
+    """
+
+    def __init__(self, name, budget=0, burst=60, reserve=0.5, failures=5, reset=30):
+        self.name = name
+        self.bucket = TokenBucket(budget / 60.0, burst) if budget else None
+        self.reserve = reserve * burst
+        self.breaker = CircuitBreaker(failures, reset)
+
+    def acquire(self):
+        """Raise `UpstreamUnavailable` unless a call may be made now"""
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(self.name, 'circuit_open')
+        if self.bucket is not None:
+            reserve = self.reserve if inBackground() else 0
+            if not self.bucket.take(reserve):
+                raise UpstreamUnavailable(self.name, 'budget')
+
+    def record(self, status):
+        """Record the outcome of a call by its HTTP status. Server errors and 429 count as failures."""
+        if status >= 500 or status == 429:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+
+    def failure(self):
+        self.breaker.failure()
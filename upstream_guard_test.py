@@ -0,0 +1,147 @@
+import threading
+import unittest
+from unittest import mock
+
+from upstream_guard import CircuitBreaker, TokenBucket, UpstreamGuard, UpstreamUnavailable, background, inBackground
+
+
+class Clock:
+    """time.monotonic() that only moves when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class GuardTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('upstream_guard.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(GuardTestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for i in range(4)], [True, True, True, False])
+        # Half a second refills one token at 2 per second
+        self.clock.now += 0.5
+        self.assertEqual([bucket.take(), bucket.take()], [True, False])
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        for i in range(3):
+            bucket.take()
+        self.clock.now += 3600
+        self.assertEqual(sum(bucket.take() for i in range(10)), 3)
+
+    def test_reserve(self):
+        bucket = TokenBucket(rate=1, burst=4)
+        # Only taken while 2 would still be left
+        self.assertEqual([bucket.take(reserve=2) for i in range(3)], [True, True, False])
+        self.assertEqual([bucket.take(), bucket.take(), bucket.take()], [True, True, False])
+
+
+class CircuitBreakerTest(GuardTestCase):
+    def test_opens_after_failures_in_a_row(self):
+        breaker = CircuitBreaker(failures=3, reset=30)
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        self.assertFalse(breaker.open)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertTrue(breaker.open)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_trial(self):
+        breaker = CircuitBreaker(failures=1, reset=30)
+        breaker.failure()
+        self.clock.now += 29
+        self.assertFalse(breaker.allow())
+        self.clock.now += 1
+        # One trial call, the next one waits for it
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+    def test_failed_trial_opens_again(self):
+        breaker = CircuitBreaker(failures=1, reset=30)
+        breaker.failure()
+        self.clock.now += 30
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.clock.now += 29
+        self.assertFalse(breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(breaker.allow())
+
+    def test_successful_trial_closes(self):
+        breaker = CircuitBreaker(failures=1, reset=30)
+        breaker.failure()
+        self.clock.now += 30
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.open)
+        self.assertEqual([breaker.allow() for i in range(3)], [True, True, True])
+
+
+class UpstreamGuardTest(GuardTestCase):
+    def test_budget(self):
+        guard = UpstreamGuard('geonames', budget=60, burst=2)
+        guard.acquire()
+        guard.acquire()
+        with self.assertRaises(UpstreamUnavailable) as raised:
+            guard.acquire()
+        self.assertEqual((raised.exception.upstream, raised.exception.reason), ('geonames', 'budget'))
+        self.clock.now += 1
+        guard.acquire()
+
+    def test_no_budget(self):
+        guard = UpstreamGuard('darksky', budget=0, burst=1)
+        for i in range(100):
+            guard.acquire()
+
+    def test_background_keeps_the_reserve(self):
+        guard = UpstreamGuard('darksky', budget=60, burst=4, reserve=0.5)
+        with background():
+            self.assertTrue(inBackground())
+            guard.acquire()
+            guard.acquire()
+            self.assertRaises(UpstreamUnavailable, guard.acquire)
+        self.assertFalse(inBackground())
+        # What was kept back is there for user requests
+        guard.acquire()
+        guard.acquire()
+        self.assertRaises(UpstreamUnavailable, guard.acquire)
+
+    def test_background_is_per_thread(self):
+        seen = []
+        with background():
+            thread = threading.Thread(target=lambda: seen.append(inBackground()))
+            thread.start()
+            thread.join()
+        self.assertEqual(seen, [False])
+
+    def test_statuses(self):
+        guard = UpstreamGuard('nominatim', failures=2, reset=30)
+        guard.record(404)
+        guard.record(503)
+        guard.record(200)
+        guard.record(429)
+        guard.record(500)
+        with self.assertRaises(UpstreamUnavailable) as raised:
+            guard.acquire()
+        self.assertEqual(raised.exception.reason, 'circuit_open')
+        self.clock.now += 30
+        guard.acquire()
+        guard.record(200)
+        guard.acquire()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class FanOutPool:
+    """
+    Process-wide bounded thread pool for upstream fan-out.
+
+    All requests share the same `workers` threads. A single fan-out never has
+    more than `per_request` tasks queued or running at once, so one large
+    request (e.g. /map/europe) leaves room in the pool for everybody else.
+
+    :param workers: Number of threads in the shared pool
+    :type workers: `int`
+    :param per_request: Maximum number of concurrent tasks for one fan-out
+    :type per_request: `int`
+    """
+
+    def __init__(self, workers=16, per_request=8):
+        self.workers = workers
+        self.per_request = per_request
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='upstream')
+
+    def submit(self, function, *args):
+        """Run `function(*args)` on the pool, in a copy of the caller's context variables (e.g. its deadline)"""
+        return self.executor.submit(contextvars.copy_context().run, function, *args)
+
+    def submit_all(self, function, items, limit=None):
+        """Submit `function(item)` for every item, holding back tasks beyond the per-request limit"""
+        slots = threading.BoundedSemaphore(min(limit or self.per_request, self.per_request))
+        futures = []
+        for item in items:
+            slots.acquire()
+            future = self.submit(function, item)
+            future.add_done_callback(lambda f: slots.release())
+            futures.append(future)
+        return futures
+
+    def map(self, function, items, limit=None):
+        """Return `[function(item) for item in items]`, computed on the pool. The first exception is re-raised."""
+        return [future.result() for future in self.submit_all(function, items, limit)]
+
+    def as_completed(self, function, items, limit=None):
+        """Yield `(item, future)` pairs in completion order, keeping no more than the per-request limit in flight"""
+        limit = min(limit or self.per_request, self.per_request)
+        items = iter(items)
+        pending = {}
+        for item in items:
+            pending[self.submit(function, item)] = item
+            if len(pending) >= limit:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                for following in items:
+                    pending[self.submit(function, following)] = following
+                    break
+                yield item, future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)